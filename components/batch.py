@@ -0,0 +1,75 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List
+
+
+class BatchLoader:
+    """
+    在一个很短的时间窗口内合并并发的查询，一次性请求后再分发结果
+
+    同一分组（如同一个请求客户端）内不同 key 的查询会合并为一次批量请求，相同 key 的查询共享结果
+    """
+
+    def __init__(self,
+                 batch_fn: Callable[[Hashable, List[str]], Awaitable[Dict[str, Any]]],
+                 window: float = 0.005,
+                 max_size: int = 50
+                 ):
+        """
+        :param batch_fn: 批量查询函数，接收分组和 key 列表，返回 key 到结果的映射，缺失的 key 结果为 None
+        :param window: 合并窗口，单位秒
+        :param max_size: 单次批量查询的最大 key 数量，达到后立即发起请求
+        """
+        self.batch_fn = batch_fn
+        self.window = window
+        self.max_size = max_size
+        self._pending: Dict[Hashable, Dict[str, List[asyncio.Future]]] = {}
+        self._timers: Dict[Hashable, asyncio.TimerHandle] = {}
+        self._tasks = set()
+
+    async def load(self, group: Hashable, key: str) -> Any:
+        """
+        加入当前批次并等待结果
+
+        :param group: 批次分组，只有同一分组的 key 会被合并
+        :param key: 查询的 key
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._pending.setdefault(group, {})
+        batch.setdefault(key, []).append(future)
+
+        if len(batch) >= self.max_size:
+            self._dispatch(group)
+        elif group not in self._timers:
+            self._timers[group] = loop.call_later(self.window, self._dispatch, group)
+
+        return await future
+
+    def _dispatch(self, group: Hashable):
+        timer = self._timers.pop(group, None)
+        if timer is not None:
+            timer.cancel()
+
+        batch = self._pending.pop(group, None)
+        if not batch:
+            return
+
+        task = asyncio.create_task(self._run(group, batch))
+        # 保持引用，防止任务在完成前被回收
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, group: Hashable, batch: Dict[str, List[asyncio.Future]]):
+        try:
+            results = await self.batch_fn(group, list(batch))
+        except Exception as e:
+            for futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+
+        for key, futures in batch.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(results.get(key))
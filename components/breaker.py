@@ -0,0 +1,143 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from enum import StrEnum
+
+import fastapi
+from uvicorn.server import logger
+
+from config import *
+
+
+class BreakerState(StrEnum):
+    CLOSED = "Closed"
+    """ 正常请求 """
+    OPEN = "Open"
+    """ 上游不可用，请求直接失败 """
+    HALF_OPEN = "Half_Open"
+    """ 冷却结束，放行一个探测请求 """
+
+
+class CircuitOpenError(fastapi.HTTPException):
+    """熔断器打开，请求未发往上游"""
+
+    def __init__(self, name: str):
+        super().__init__(status_code=503, detail=f"{name} is unavailable, circuit breaker is open")
+        self.name = name
+
+
+class CircuitBreaker:
+    """
+    上游熔断器，统计请求耗时与失败
+
+    连续失败（超时、连接错误、5xx 响应，或启用时耗时超过 breaker_slow_call_seconds）达到 breaker_failure_threshold 次后打开，
+    打开期间请求直接失败；breaker_reset_timeout 秒后放行一个探测请求，成功则恢复。
+    4xx 响应（如错误的 API Key、不存在的 Item）由客户端导致，不计入统计
+    """
+
+    def __init__(self, name: str, smoothing: float = 0.2):
+        self.name = name
+        self.smoothing = smoothing
+        self.state = BreakerState.CLOSED
+        self.consecutive_failures = 0
+        self.total_failures = 0
+        self.rejected = 0
+        self.latency = 0.0
+        """ 平滑后的请求耗时，单位秒 """
+        self._opened_at = 0.0
+        self._probing = False
+
+    @property
+    def is_open(self) -> bool:
+        """熔断器当前是否会拒绝请求，不改变状态"""
+        if not enable_circuit_breaker or self.state == BreakerState.CLOSED:
+            return False
+        if self.state == BreakerState.OPEN:
+            return time.monotonic() - self._opened_at < breaker_reset_timeout
+        return self._probing
+
+    def _allow(self) -> bool:
+        if self.state == BreakerState.CLOSED:
+            return True
+        if self.state == BreakerState.OPEN:
+            if time.monotonic() - self._opened_at < breaker_reset_timeout:
+                return False
+            self.state = BreakerState.HALF_OPEN
+            logger.info(f"{self.name} circuit breaker half-open, probing.")
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def _record(self, elapsed: float, failed: bool):
+        self.latency += self.smoothing * (elapsed - self.latency)
+        if self.state == BreakerState.HALF_OPEN:
+            self._probing = False
+
+        if not failed:
+            if self.state != BreakerState.CLOSED:
+                logger.info(f"{self.name} circuit breaker closed, upstream recovered.")
+            self.state = BreakerState.CLOSED
+            self.consecutive_failures = 0
+            return
+
+        self.total_failures += 1
+        self.consecutive_failures += 1
+        if self.state == BreakerState.HALF_OPEN or self.consecutive_failures >= breaker_failure_threshold:
+            if self.state != BreakerState.OPEN:
+                logger.warning(f"{self.name} circuit breaker opened after {self.consecutive_failures} failure(s), "
+                               f"failing fast for {breaker_reset_timeout} seconds.")
+            self.state = BreakerState.OPEN
+            self._opened_at = time.monotonic()
+
+    @asynccontextmanager
+    async def guard(self):
+        """
+        保护一次上游请求：熔断时抛出 CircuitOpenError，超过 breaker_call_timeout 时抛出 504
+
+        用法：async with alist_breaker.guard(): ...
+        """
+        if not enable_circuit_breaker:
+            yield
+            return
+
+        if not self._allow():
+            self.rejected += 1
+            raise CircuitOpenError(self.name)
+
+        start = time.monotonic()
+        try:
+            async with asyncio.timeout(breaker_call_timeout):
+                yield
+        except TimeoutError:
+            self._record(time.monotonic() - start, failed=True)
+            logger.error(f"{self.name} request timeout after {breaker_call_timeout} seconds.")
+            raise fastapi.HTTPException(status_code=504, detail=f"{self.name} request timeout")
+        except asyncio.CancelledError:
+            # 客户端断开导致的取消与上游状态无关，不计入统计
+            self._probing = False
+            raise
+        except fastapi.HTTPException as e:
+            if e.status_code < 500:
+                self._probing = False
+            else:
+                self._record(time.monotonic() - start, failed=True)
+            raise
+        except Exception:
+            self._record(time.monotonic() - start, failed=True)
+            raise
+
+        elapsed = time.monotonic() - start
+        self._record(elapsed, failed=0 < breaker_slow_call_seconds < elapsed)
+
+    def status(self) -> dict:
+        return {
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'total_failures': self.total_failures,
+            'rejected': self.rejected,
+            'latency_ms': round(self.latency * 1000, 1),
+        }
+
+alist_breaker = CircuitBreaker("Alist")
+emby_breaker = CircuitBreaker("Emby")
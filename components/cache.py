@@ -1,6 +1,7 @@
 import asyncio
+import dataclasses
+import json
 import os
-from weakref import WeakValueDictionary
 
 import aiofiles
 import aiofiles.os
@@ -8,19 +9,18 @@ import httpx
 from uvicorn.server import logger
 
 from components.utils import *
-from main import get_or_cache_alist_raw_url, FileInfo, RequestInfo, CacheStatus
+from components.breaker import alist_breaker, emby_breaker
+from components.tier import get_cache_lock, lock_cache_dir, find_cache_dir, get_cache_dir, cache_tiers, iter_cache_dirs, tier_manager
+from components.headsize import head_advisor
+from components.jobs import job_queue, JobPriority
+from components.cluster import cluster
+from components.itemstate import item_states
 from typing import AsyncGenerator, Optional
 
-cache_locks = WeakValueDictionary()
-
-def get_cache_lock(subdirname, dirname):
-    # 为每个子目录创建一个锁, 防止不同文件名称的缓存同时写入，导致重复范围的文件
-    key = os.path.join(subdirname, dirname)  
-    if key not in cache_locks:
-        # 防止被weakref立即回收
-        lock = asyncio.Lock()
-        cache_locks[key] = lock
-    return cache_locks[key]
+# 缓存目录中记录源文件信息的元数据文件，用于按路径批量清理缓存
+CACHE_META_FILE = 'meta.json'
+# 限制同时落盘的写入数量，避免多个缓存任务并发写入导致磁盘随机IO
+cache_write_semaphore = asyncio.Semaphore(cache_write_concurrency)
 
 async def read_file(
     file_path: str, 
@@ -58,7 +58,69 @@ async def read_file(
     except Exception as e:
         logger.error(f"Unexpected error occurred while reading file: {e}")
         
-async def write_cache_file(item_id, request_info: RequestInfo, req_header=None, client: httpx.AsyncClient=None) -> bool:
+async def stream_to_file(response: httpx.Response, file_path: str, buffer_size: int = cache_write_buffer_size) -> int:
+    """
+    将上游响应流式写入文件，内存占用不超过 buffer_size 加一个网络分块
+    
+    数据先累积到缓冲区，满 buffer_size 后以其整数倍对齐写入；fsync 行为由 cache_fsync_policy 决定
+    
+    :param response: 以 stream 方式打开的 httpx 响应
+    :param file_path: 写入的文件路径
+    :param buffer_size: 缓冲区大小，也是单次写入的对齐单位
+    
+    :return: 写入的字节数
+    """
+    buffer = bytearray()
+    written = 0
+    
+    async def flush(data: bytes):
+        async with cache_write_semaphore:
+            await f.write(data)
+            if cache_fsync_policy == "always":
+                await f.flush()
+                await asyncio.to_thread(os.fsync, f.fileno())
+    
+    async with aiofiles.open(file_path, 'wb') as f:
+        async for chunk in response.aiter_bytes():
+            buffer += chunk
+            if len(buffer) >= buffer_size:
+                aligned = len(buffer) - len(buffer) % buffer_size
+                await flush(bytes(buffer[:aligned]))
+                del buffer[:aligned]
+                written += aligned
+        
+        if buffer:
+            await flush(bytes(buffer))
+            written += len(buffer)
+        
+        if cache_fsync_policy == "close":
+            await f.flush()
+            await asyncio.to_thread(os.fsync, f.fileno())
+    
+    return written
+
+async def write_cache_meta(cache_dir: str, item_id, request_info: RequestInfo):
+    """
+    在缓存目录中记录源文件路径等信息，已存在则跳过
+    
+    :param cache_dir: 缓存目录
+    :param item_id: Emby Item ID
+    :param request_info: 请求信息
+    """
+    meta_path = os.path.join(cache_dir, CACHE_META_FILE)
+    if await aiofiles.os.path.exists(meta_path):
+        return
+    
+    meta = {
+        'path': request_info.file_info.path,
+        'size': request_info.file_info.size,
+        'item_id': str(item_id),
+        'item_type': request_info.item_info.item_type,
+    }
+    async with aiofiles.open(meta_path, 'w') as f:
+        await f.write(json.dumps(meta, ensure_ascii=False))
+
+async def write_cache_file(item_id, request_info: RequestInfo, req_header=None, client: httpx.AsyncClient=None, cache_range: Optional[Tuple[int, int]] = None) -> bool:
     """
     写入缓存文件，end point通过cache_size计算得出
     
@@ -68,6 +130,7 @@ async def write_cache_file(item_id, request_info: RequestInfo, req_header=None,
     :param request_info: 请求信息
     :param req_header: 请求头，用于请求Alist Raw Url
     :param client: HTTPX异步客户端
+    :param cache_range: 指定缓存的起始点和结束点，如恢复播放位置附近的缓存；为空时根据缓存状态计算
     
     :return: 缓存是否成功
     """    
@@ -79,7 +142,9 @@ async def write_cache_file(item_id, request_info: RequestInfo, req_header=None,
     
     # 计算缓存文件的结束点
     # 如果 start_point 大于 cache_size，endPoint 为文件末尾（将缓存尾部元数据）
-    if request_info.cache_status in {CacheStatus.PARTIAL, CacheStatus.HIT}:
+    if cache_range is not None:
+        start_point, end_point = cache_range
+    elif request_info.cache_status in {CacheStatus.PARTIAL, CacheStatus.HIT}:
         start_point = 0
         end_point = cache_size - 1
     elif request_info.cache_status == CacheStatus.HIT_TAIL:
@@ -91,75 +156,270 @@ async def write_cache_file(item_id, request_info: RequestInfo, req_header=None,
     
     # 获取Alist Raw Url
     if request_info.raw_url is None:
-        raw_url = await request_info.raw_url_task
+        try:
+            raw_url = await request_info.raw_url_task
+        except fastapi.HTTPException as e:
+            logger.warning(f"Skip caching {start_point}-{end_point}: {item_id}, failed to get Alist Raw Url: {e.detail}")
+            return False
     else:
         raw_url = request_info.raw_url
     
-    # 根据起始点和缓存大小确定缓存文件路径
-    cache_file_name = f'cache_file_{start_point}_{end_point}'
-    cache_file_path = os.path.join(cache_path, subdirname, dirname, cache_file_name)
-    logger.debug(f"Start to cache file {start_point}-{end_point}: {item_id}, file path: {cache_file_path}")
-    
-    os.makedirs(os.path.dirname(cache_file_path), exist_ok=True)
-     
-    cache_write_tag_path = os.path.join(cache_path, subdirname, dirname, f'{cache_file_name}.tag')
     lock = get_cache_lock(subdirname, dirname)
     
     async with lock:
-        # 创建缓存写入标记文件
-        async with aiofiles.open(cache_write_tag_path, 'w') as f:
-            pass
-    
-        # 检查是否已有包含当前范围的缓存文件
-        for file in os.listdir(os.path.join(cache_path, subdirname, dirname)):
-            if file.startswith('cache_file_') and file.endswith('.tag') is False:
-                file_range_start, file_range_end = map(int, file.split('_')[2:4])
+        # 根据起始点和缓存大小确定缓存文件路径，已有缓存位于冷层时写入冷层，否则写入热层
+        cache_dir = get_cache_dir(subdirname, dirname)
+        cache_file_name = f'cache_file_{start_point}_{end_point}'
+        cache_file_path = os.path.join(cache_dir, cache_file_name)
+        cache_write_tag_path = os.path.join(cache_dir, f'{cache_file_name}.tag')
+        logger.debug(f"Start to cache file {start_point}-{end_point}: {item_id}, file path: {cache_file_path}")
+        
+        os.makedirs(cache_dir, exist_ok=True)
+        
+        # 写入期间持有目录的共享锁，其他工作进程不会在写入过程中将该目录移动到另一层
+        dir_lock = lock_cache_dir(cache_dir)
+        if dir_lock is False:
+            logger.debug("Cache dir is being moved to another tier, skip caching: %s", cache_dir)
+            return False
+        try:
+            # 创建缓存写入标记文件，多个工作进程同时写入同一范围时只有一个能创建成功
+            try:
+                os.close(os.open(cache_write_tag_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                logger.debug("Cache %s-%s is being written by another worker: %s", start_point, end_point, item_id)
+                return False
+        
+            await write_cache_meta(cache_dir, item_id, request_info)
+    
+            # 检查是否已有包含当前范围的缓存文件
+            for file in os.listdir(cache_dir):
+                if file.startswith('cache_file_') and file.endswith('.tag') is False:
+                    file_range_start, file_range_end = map(int, file.split('_')[2:4])
                 
-                if start_point >= file_range_start and end_point <= file_range_end:
-                    logger.warning(f"Cache Range Already Exists. Abort.")
-                    await aiofiles.os.remove(cache_write_tag_path)
-                    return False
-                elif start_point <= file_range_start and end_point >= file_range_end:
-                    logger.warning(f"Existing Cache Range within new range. Deleting old cache.")
-                    await aiofiles.os.remove(os.path.join(cache_path, subdirname, dirname, file))
+                    if start_point >= file_range_start and end_point <= file_range_end:
+                        logger.warning(f"Cache Range Already Exists. Abort.")
+                        await aiofiles.os.remove(cache_write_tag_path)
+                        return False
+                    elif start_point <= file_range_start and end_point >= file_range_end:
+                        logger.warning(f"Existing Cache Range within new range. Deleting old cache.")
+                        await aiofiles.os.remove(os.path.join(cache_dir, file))
         
-        # 请求Alist Raw Url，115会验证header中的UA，所以需要传入
-        if req_header is None:
-            req_header = {}
-        else:
-            req_header = dict(req_header) # Copy the headers
+            # 请求Alist Raw Url，115会验证header中的UA，所以需要传入
+            if req_header is None:
+                req_header = {}
+            else:
+                req_header = dict(req_header) # Copy the headers
             
-        req_header['host'] = raw_url.split('/')[2]
-        # Modify the range to startPoint-first50M
-        req_header['range'] = f"bytes={start_point}-{end_point}"
+            req_header['host'] = raw_url.split('/')[2]
+            # Modify the range to startPoint-first50M
+            req_header['range'] = f"bytes={start_point}-{end_point}"
 
-        try:
-            # 请求数据
-            resp = await client.get(raw_url, headers=req_header)
-            if resp.status_code != 206:
-                logger.error(f"Write Cache Error {start_point}-{end_point}: Upstream return code: {resp.status_code}")
-                raise ValueError("Upstream response code not 206")
+            try:
+                # 流式请求数据并写入缓存文件
+                async with client.stream("GET", raw_url, headers=req_header) as resp:
+                    if resp.status_code != 206:
+                        logger.error(f"Write Cache Error {start_point}-{end_point}: Upstream return code: {resp.status_code}")
+                        raise ValueError("Upstream response code not 206")
+                
+                    written = await stream_to_file(resp, cache_file_path)
             
-            # 写入缓存文件
-            async with aiofiles.open(cache_file_path, 'wb') as f:
-                async for chunk in resp.aiter_bytes(chunk_size=1024):
-                    await f.write(chunk)
-            logger.info(f"Write Cache file {start_point}-{end_point}: {item_id} has been written, file path: {cache_file_path}")
+                if written != end_point - start_point + 1:
+                    raise ValueError(f"Upstream returned {written} bytes, expected {end_point - start_point + 1}")
+                logger.info(f"Write Cache file {start_point}-{end_point}: {item_id} has been written, file path: {cache_file_path}")
             
-            # 删除写入标签文件并返回成功
-            await aiofiles.os.remove(cache_write_tag_path)
-            return True
-
-        except Exception as e:
-            # 错误处理并删除缓存文件和标签文件
-            logger.error(f"Write Cache Error {start_point}-{end_point}: {e}")
-            if await aiofiles.os.path.exists(cache_file_path):
-                await aiofiles.os.remove(cache_file_path)
-            if await aiofiles.os.path.exists(cache_write_tag_path):
+                # 删除写入标签文件并返回成功
                 await aiofiles.os.remove(cache_write_tag_path)
-            return False
+                return True
+
+            except Exception as e:
+                # 错误处理并删除缓存文件和标签文件
+                logger.error(f"Write Cache Error {start_point}-{end_point}: {e}")
+                if await aiofiles.os.path.exists(cache_file_path):
+                    await aiofiles.os.remove(cache_file_path)
+                if await aiofiles.os.path.exists(cache_write_tag_path):
+                    await aiofiles.os.remove(cache_write_tag_path)
+                return False
+        finally:
+            if dir_lock is not None:
+                os.close(dir_lock)
+
+    
+def find_cache_range(request_info: RequestInfo) -> Optional[Tuple[int, int]]:
+    """
+    查找包含请求起始点的缓存文件，有多个时取结束点最大的一个
+    
+    :param request_info: 请求信息
+    
+    :return: 缓存文件的起始点和结束点，不存在则返回 None
+    """
+    state = item_states.for_file(request_info.file_info, request_info.item_info.item_type)
+    state.refresh()
+    return state.find(request_info.start_byte)
+
+def find_cache_file_range(subdirname: str, dirname: str, start_byte: int, complete_only: bool = False) -> Optional[Tuple[int, int]]:
+    """
+    在缓存目录中查找包含 start_byte 的缓存文件，有多个时取结束点最大的一个
+    
+    :param complete_only: 是否跳过正在写入的缓存文件
+    
+    :return: 缓存文件的起始点和结束点，不存在则返回 None
+    """
+    state = item_states.get(subdirname, dirname)
+    state.refresh()
+    return state.find(start_byte, complete_only)
+
+async def lookup_cache(request_info: RequestInfo) -> bool:
+    """
+    检查请求起始点是否有缓存，集群模式下缓存属于其他节点时向该节点查询
+    
+    命中其他节点的缓存时设置 cache_node 和 cache_range，并按该缓存的范围调整 HIT/PARTIAL 状态
+    
+    :param request_info: 请求信息
+    """
+    state = item_states.for_file(request_info.file_info, request_info.item_info.item_type)
+    subdirname, dirname = state.subdirname, state.dirname
+    node = cluster.owner(dirname)
+    if node is None:
+        return get_cache_status(request_info)
+    
+    cache_range = await cluster.lookup(node, subdirname, dirname, request_info.start_byte)
+    if cache_range is None:
+        logger.debug("Cluster cache miss on %s: %s", node, os.path.join(subdirname, dirname))
+        return False
+    
+    logger.debug("Cluster cache hit on %s: %s-%s", node, *cache_range)
+    request_info.cache_node = node
+    request_info.cache_range = cache_range
+    if request_info.cache_status in {CacheStatus.HIT, CacheStatus.PARTIAL}:
+        if request_info.end_byte is not None and request_info.end_byte <= cache_range[1]:
+            request_info.cache_status = CacheStatus.HIT
+        else:
+            request_info.cache_status = CacheStatus.PARTIAL
+    return True
+
+async def fill_cache(item_id, request_info: RequestInfo, req_header=None, client: httpx.AsyncClient=None,
+                     cache_range: Optional[Tuple[int, int]] = None, job_priority: JobPriority = JobPriority.FOREGROUND,
+                     forward: bool = True) -> bool:
+    """
+    写入缓存；集群模式下缓存属于其他节点时，请求该节点写入
+    
+    参数同 write_cache_file
+    
+    :param job_priority: 转发给其他节点时使用的任务优先级
+    :param forward: 是否允许转发，其他节点转发来的请求总是写入本机
+    """
+    subdirname, dirname = get_hash_subdirectory_from_path(request_info.file_info.path, request_info.item_info.item_type)
+    node = cluster.owner(dirname) if forward else None
+    if node is None:
+        return await write_cache_file(item_id, request_info, req_header, client=client, cache_range=cache_range)
+    
+    ua = req_header.get('User-Agent') if req_header is not None else None
+    logger.debug("Forward cache writing to %s: %s", node, item_id)
+    return await cluster.request_fill(node, {
+        'item_id': str(item_id),
+        'file_info': dataclasses.asdict(request_info.file_info),
+        'item_info': dataclasses.asdict(request_info.item_info),
+        'host_url': request_info.host_url,
+        'user_agent': ua,
+        'start_byte': request_info.start_byte,
+        'cache_status': request_info.cache_status,
+        'cache_range': cache_range,
+        'priority': int(job_priority),
+    })
+
+def submit_cache_write(item_id, request_info: RequestInfo, req_header, client: httpx.AsyncClient,
+                       priority: JobPriority, cache_range: Optional[Tuple[int, int]] = None, forward: bool = True) -> bool:
+    """
+    将缓存写入提交到后台任务队列，同一文件的同一缓存范围在排队或写入期间只会提交一次
+    
+    参数同 fill_cache
+    
+    :param priority: 任务优先级
+    
+    :return: 是否加入了队列
+    """
+    if cache_range is not None:
+        part = cache_range
+    elif request_info.cache_status == CacheStatus.HIT_TAIL:
+        part = 'tail'
+    else:
+        part = 'head'
+    return job_queue.submit(
+        ('write', request_info.file_info.path, part),
+        priority,
+        fill_cache,
+        item_id,
+        request_info,
+        req_header,
+        client=client,
+        cache_range=cache_range,
+        job_priority=priority,
+        forward=forward
+        )
+
+def get_head_cache_size(file_info: FileInfo, item_type: str) -> Optional[int]:
+    """
+    获取已有开头缓存的大小，包括正在写入的
+    
+    :return: 开头缓存大小，单位 Byte，不存在时返回 None
+    """
+    state = item_states.for_file(file_info, item_type)
+    state.refresh()
+    for start, end, _ in state.segments:
+        if start == 0:
+            return end + 1
+    return None
+
+def resolve_head_size(file_info: FileInfo, item_type: str, ua: Optional[str]) -> FileInfo:
+    """
+    确定开头缓存大小：已有开头缓存时沿用其大小，否则使用 head_advisor 根据观测数据推荐的大小
+    
+    :param file_info: 文件信息
+    :param item_type: 视频类型，用于定位缓存目录
+    :param ua: 客户端 User-Agent
+    
+    :return: cache_file_size 调整后的文件信息，不修改传入的对象
+    """
+    cache_file_size = get_head_cache_size(file_info, item_type) or head_advisor.recommend(file_info, ua)
+    if cache_file_size == file_info.cache_file_size:
+        return file_info
+    # 同一次播放的多个 Range 请求传入的是同一个文件信息对象，结果相同时复用
+    state = item_states.for_file(file_info, item_type)
+    if state.file_infos is not None and state.file_infos[0] is file_info and state.file_infos[1].cache_file_size == cache_file_size:
+        return state.file_infos[1]
+    resolved = dataclasses.replace(file_info, cache_file_size=cache_file_size)
+    state.file_infos = (file_info, resolved)
+    return resolved
 
+def get_resume_cache_range(file_info: FileInfo, position_ticks: int) -> Optional[Tuple[int, int]]:
+    """
+    根据恢复播放位置计算需要缓存的范围
+    
+    通过码率将播放位置换算为字节位置，前后各扩展若干秒，并限制在开头缓存与末尾2MB之间
+    
+    :param file_info: 文件信息
+    :param position_ticks: Emby 播放位置，单位为 100 纳秒
+    
+    :return: 缓存的起始点和结束点，不需要缓存时返回 None
+    """
+    byte_rate = file_info.bitrate / 8
+    offset = int(position_ticks / 10_000_000 * byte_rate)
+    start_point = max(offset - int(resume_cache_before_seconds * byte_rate), file_info.cache_file_size)
+    end_point = min(offset + int(resume_cache_after_seconds * byte_rate), file_info.size - 2 * 1024 * 1024) - 1
     
+    if start_point >= end_point:
+        return None
+    return start_point, end_point
+
+async def read_tiered_file(subdirname: str, dirname: str, file: str, start_point: int, end_point: Optional[int]) -> AsyncGenerator[bytes, None]:
+    """在开始读取时才确定缓存所在的层，避免响应开始前缓存已被提升或降级"""
+    file_dir = find_cache_dir(subdirname, dirname)
+    if file_dir is None:
+        logger.error(f"File not found: {os.path.join(subdirname, dirname, file)}")
+        return
+    async for data in read_file(os.path.join(file_dir, file), start_point, end_point):
+        yield data
+
 def read_cache_file(request_info: RequestInfo) -> AsyncGenerator[bytes, None]:
     """
     读取缓存文件，该函数不是异步的，将直接返回一个异步生成器
@@ -168,20 +428,28 @@ def read_cache_file(request_info: RequestInfo) -> AsyncGenerator[bytes, None]:
     
     :return: function read_file
     """    
-    subdirname, dirname = get_hash_subdirectory_from_path(request_info.file_info.path, request_info.item_info.item_type)
-    file_dir = os.path.join(cache_path, subdirname, dirname)
+    state = item_states.for_file(request_info.file_info, request_info.item_info.item_type)
+    subdirname, dirname = state.subdirname, state.dirname
     
-    # 查找与 startPoint 匹配的缓存文件，endPoint 为文件名的一部分
-    for file in os.listdir(file_dir):
-        if file.startswith('cache_file_') and file.endswith('.tag') is False:
-            range_start, range_end = map(int, file.split('_')[2:4])
-            if range_start <= request_info.start_byte <= range_end:
-                # 调整 end_point 的值
-                adjusted_end_point = None if request_info.cache_status == CacheStatus.PARTIAL or request_info.cache_status == CacheStatus.HIT_TAIL else request_info.end_byte - request_info.start_byte
-                
-                logger.info(f"Read Cache: {os.path.join(file_dir, file)}")
+    if request_info.cache_node is not None:
+        # 缓存位于集群中的其他节点，读取到请求末尾或缓存文件末尾
+        range_end = request_info.cache_range[1] if request_info.end_byte is None else min(request_info.end_byte, request_info.cache_range[1])
+        logger.debug("Read Cache from %s: %s", request_info.cache_node, os.path.join(subdirname, dirname))
+        return cluster.read(request_info.cache_node, subdirname, dirname, request_info.start_byte, range_end)
+    
+    file_dir = state.refresh()
+    cache_range = request_info.cache_range or state.find(request_info.start_byte)
+    if file_dir is not None and cache_range is not None:
+        # 记录命中，冷层缓存在后台提升到热层，本次仍从当前位置读取
+        tier_manager.touch(file_dir)
+        range_start, range_end = cache_range
+        file = f'cache_file_{range_start}_{range_end}'
+        # 调整 end_point 的值，read_file 的起止点都是相对缓存文件开头的位置
+        adjusted_end_point = None if request_info.cache_status == CacheStatus.PARTIAL or request_info.cache_status == CacheStatus.HIT_TAIL else request_info.end_byte - range_start
+        
+        logger.debug("Read Cache: %s", os.path.join(file_dir, file))
 
-                return read_file(os.path.join(file_dir, file), request_info.start_byte - range_start, adjusted_end_point)
+        return read_tiered_file(subdirname, dirname, file, request_info.start_byte - range_start, adjusted_end_point)
             
     logger.error(f"Read Cache Error: There is no matched cache in the cache directory for this file: {request_info.file_info.path}.")
     return None
@@ -192,32 +460,30 @@ def get_cache_status(request_info: RequestInfo) -> bool:
     
     :param request_info: 请求信息
     """
-    subdirname, dirname = get_hash_subdirectory_from_path(request_info.file_info.path, request_info.item_info.item_type)
-    cache_dir = os.path.join(cache_path, subdirname, dirname)
+    state = item_states.for_file(request_info.file_info, request_info.item_info.item_type)
+    cache_dir = state.refresh()
     
-    if os.path.exists(cache_dir) is False:
-        logger.warning(f"Get Cache Error: Cache directory does not exist: {os.path.join(cache_path, subdirname, dirname)}")
+    if cache_dir is None:
+        logger.debug("Get Cache Error: Cache directory does not exist: %s", os.path.join(state.subdirname, state.dirname))
         return False
     
     # 检查是否有任何缓存文件正在写入
-    for file in os.listdir(cache_dir):
-        if file.endswith('.tag'):
-            logger.warning(f"Get Cache Error: Cache file is being written: {os.path.join(cache_path, subdirname, dirname, file)}")
-            return False
+    if state.writing:
+        logger.debug("Get Cache Error: Cache file is being written: %s", cache_dir)
+        return False
     
     # 查找与 startPoint 匹配的缓存文件，endPoint 为文件名的一部分
-    for file in os.listdir(cache_dir):
-        if file.startswith('cache_file_'):
-            range_start, range_end = map(int, file.split('_')[2:4])
-            if verify_cache_file(request_info.file_info, (range_start, range_end)):
-                if range_start <= request_info.start_byte <= range_end:
-                    return True
-            else:
-                logger.error(f"Get Cache Error: Cache file {file} is invalid, removing..")
-                os.remove(os.path.join(cache_dir, file))
-                return False
+    for range_start, range_end, _ in state.segments:
+        if verify_cache_file(request_info.file_info, (range_start, range_end)):
+            if range_start <= request_info.start_byte <= range_end:
+                return True
+        else:
+            file = f'cache_file_{range_start}_{range_end}'
+            logger.error(f"Get Cache Error: Cache file {file} is invalid, removing..")
+            os.remove(os.path.join(cache_dir, file))
+            return False
     
-    logger.error(f"Get Cache Error: Cache file for range {request_info.start_byte} not found.")
+    logger.debug("Get Cache Error: Cache file for range %s not found.", request_info.start_byte)
     return False
 
 async def cache_next_episode(request_info: RequestInfo, api_key: str, client: httpx.AsyncClient) -> bool:
@@ -232,34 +498,46 @@ async def cache_next_episode(request_info: RequestInfo, api_key: str, client: ht
         logger.debug(f"Skip caching next episode for non-episode item: {request_info.item_info.item_id}")
         return False
     
+    # 上游不可用时不做预缓存，避免给故障中的上游增加负载
+    if emby_breaker.is_open or alist_breaker.is_open:
+        logger.debug(f"Skip caching next episode while upstream circuit breaker is open: {request_info.item_info.item_id}")
+        return False
+    
     next_episode_id = request_info.item_info.item_id + 1
-    next_item_info = await get_item_info(next_episode_id, api_key, client)
-    # 如果找不到下一集，不缓存；非同季度，不缓存
-    if next_item_info is not None and next_item_info.season_id == request_info.item_info.season_id:
+    try:
+        next_item_info = await get_item_info(next_episode_id, api_key, client)
+        # 如果找不到下一集，不缓存；非同季度，不缓存
+        if next_item_info is None or next_item_info.season_id != request_info.item_info.season_id:
+            return False
         next_file_info = await get_file_info(next_item_info.item_id, api_key, media_source_id=None, client=client)
-        for file in next_file_info:
-            next_request_info = RequestInfo(
-                file_info=file,
-                item_info=next_item_info,
-                host_url=request_info.host_url,
-                start_byte=0,
-                end_byte=None,
-                cache_status=CacheStatus.PARTIAL,
-                raw_url_task=asyncio.create_task(
-                    get_or_cache_alist_raw_url(
-                        file_path=file.path, 
-                        host_url=request_info.host_url, 
-                        ua=request_info.headers.get("User-Agent"), 
-                        client=client
-                        )
-                    ),
-            )
-            if get_cache_status(next_request_info):
-                logger.debug(f"Skip caching next episode for existing cache: {next_request_info.item_info.item_id}")
-                return False
-            else:
-                await write_cache_file(next_episode_id, next_request_info, req_header=request_info.headers, client=client)
-        return True
+    except fastapi.HTTPException as e:
+        logger.warning(f"Skip caching next episode for {next_episode_id}: {e.detail}")
+        return False
+    
+    for file in next_file_info:
+        file = resolve_head_size(file, next_item_info.item_type, request_info.headers.get("User-Agent"))
+        next_request_info = RequestInfo(
+            file_info=file,
+            item_info=next_item_info,
+            host_url=request_info.host_url,
+            start_byte=0,
+            end_byte=None,
+            cache_status=CacheStatus.PARTIAL,
+            raw_url_task=asyncio.create_task(
+                get_or_cache_alist_raw_url(
+                    file_path=file.path, 
+                    host_url=request_info.host_url, 
+                    ua=request_info.headers.get("User-Agent"), 
+                    client=client
+                    )
+                ),
+        )
+        if get_cache_status(next_request_info):
+            logger.debug(f"Skip caching next episode for existing cache: {next_request_info.item_info.item_id}")
+            return False
+        else:
+            await fill_cache(next_episode_id, next_request_info, req_header=request_info.headers, client=client, job_priority=JobPriority.PREFETCH)
+    return True
     
 def verify_cache_file(file_info: FileInfo, cache_file_range: Tuple[int, int]) -> bool:
     """
@@ -273,42 +551,161 @@ def verify_cache_file(file_info: FileInfo, cache_file_range: Tuple[int, int]) ->
     :return: 缓存文件是否符合视频文件大小
     """
     start, end = cache_file_range
-    # 开头缓存文件
-    if start == 0 and end == file_info.cache_file_size - 1:
-        return True
+    size = file_info.size
+    # 码率未知时（如离线检查）只能按文件大小检查
+    byte_rate = file_info.bitrate / 8 if file_info.bitrate else None
+    
+    if start < 0 or end < start or end >= size:
+        return False
+    # 开头缓存文件：启用自适应时大小由 head_advisor 决定，不超过 cache_head_max_seconds；否则为默认大小
+    if start == 0:
+        if byte_rate is None:
+            return True
+        default_size = get_default_cache_file_size(file_info.bitrate)
+        if enable_adaptive_cache_head:
+            return end + 1 <= max(default_size, int(cache_head_max_seconds * byte_rate))
+        return end + 1 == min(default_size, size)
     # 末尾缓存文件
-    elif end == file_info.size - 1:
-        return True
+    elif end == size - 1:
+        return size - start <= 2 * 1024 * 1024
+    # 恢复播放位置附近的缓存文件，范围见 get_resume_cache_range
+    elif end < size - 2 * 1024 * 1024:
+        if byte_rate is None:
+            return True
+        return end - start + 1 <= int(resume_cache_before_seconds * byte_rate) + int(resume_cache_after_seconds * byte_rate)
     else:
         return False
     
-async def clean_cache(file_info: FileInfo, item_info: ItemInfo) -> bool:
+async def remove_cache_dir(subdirname: str, dirname: str) -> bool:
     """
-    根据webhook信息删除缓存文件，及缓存文件夹
+    删除各层中缓存目录下的缓存文件、元数据及目录本身
     
-    :param file_info: 文件信息
-    :param item_info: 视频信息
+    :param subdirname: 哈希子目录名称
+    :param dirname: 哈希目录名称
     
     :return: bool: 是否删除成功
     """
-    path = file_info.path
-    subdirname, dirname = get_hash_subdirectory_from_path(path, item_info.item_type)
-    cache_dir = os.path.join(cache_path, subdirname, dirname)
     lock = get_cache_lock(subdirname, dirname)
     async with lock:
         try:
-            for file in os.listdir(cache_dir):
-                if file.startswith('cache_file_'):
-                    await aiofiles.os.remove(os.path.join(cache_dir, file))
-            # 检查文件夹是否为空
-            if not os.listdir(cache_dir):
-                await aiofiles.os.rmdir(cache_dir)
-            else:
-                logger.error(f"Clean Cache Error: Cache directory is not empty: {cache_dir}")
-                raise Exception("Cache directory is not empty")
+            cache_dirs = [os.path.join(tier, subdirname, dirname) for tier in cache_tiers()]
+            cache_dirs = [cache_dir for cache_dir in cache_dirs if os.path.isdir(cache_dir)]
+            if not cache_dirs:
+                raise FileNotFoundError(f"Cache directory does not exist: {os.path.join(subdirname, dirname)}")
             
-            logger.info(f"Clean Cache: {cache_dir}")
+            for cache_dir in cache_dirs:
+                for file in os.listdir(cache_dir):
+                    if file.startswith('cache_file_') or file == CACHE_META_FILE:
+                        await aiofiles.os.remove(os.path.join(cache_dir, file))
+                # 检查文件夹是否为空
+                if not os.listdir(cache_dir):
+                    await aiofiles.os.rmdir(cache_dir)
+                else:
+                    logger.error(f"Clean Cache Error: Cache directory is not empty: {cache_dir}")
+                    raise Exception("Cache directory is not empty")
+                
+                logger.info(f"Clean Cache: {cache_dir}")
             return True
         except Exception as e:
             logger.error(f"Clean Cache Error: {e}")
-            return False
\ No newline at end of file
+            return False
+
+async def clean_cache(file_info: FileInfo, item_info: ItemInfo) -> bool:
+    """
+    根据webhook信息删除缓存文件，及缓存文件夹
+    
+    :param file_info: 文件信息
+    :param item_info: 视频信息
+    
+    :return: bool: 是否删除成功
+    """
+    subdirname, dirname = get_hash_subdirectory_from_path(file_info.path, item_info.item_type)
+    return await remove_cache_dir(subdirname, dirname)
+
+def find_cache_dirs_by_path_prefix(path_prefix: str) -> list:
+    """
+    根据缓存元数据查找源文件位于指定路径下的所有缓存目录
+    
+    :param path_prefix: 源文件路径前缀，即被删除的文件夹路径
+    
+    :return: (subdirname, dirname) 列表
+    """
+    path_prefix = path_prefix.rstrip('/') + '/'
+    matched = []
+    
+    for tier, subdirname, dirname in iter_cache_dirs():
+        meta_path = os.path.join(tier, subdirname, dirname, CACHE_META_FILE)
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if meta.get('path', '').startswith(path_prefix) and (subdirname, dirname) not in matched:
+            matched.append((subdirname, dirname))
+    return matched
+
+async def clean_cache_by_path_prefix(path_prefix: str) -> int:
+    """
+    删除源文件位于指定文件夹下的所有缓存，用于删除整部剧集或整季
+    
+    :param path_prefix: 被删除的文件夹路径
+    
+    :return: 删除的缓存目录数量
+    """
+    cache_dirs = await asyncio.to_thread(find_cache_dirs_by_path_prefix, path_prefix)
+    cleaned = 0
+    for subdirname, dirname in cache_dirs:
+        if await remove_cache_dir(subdirname, dirname):
+            cleaned += 1
+    return cleaned
+
+async def precache_item(item_id, host_url: str, req_header: dict, client: httpx.AsyncClient) -> bool:
+    """
+    为新入库的视频创建开头和末尾缓存
+    
+    :param item_id: Emby Item ID
+    :param host_url: 用于解析 Alist Raw Url 的 host url
+    :param req_header: 请求直链时使用的请求头，需包含 User-Agent
+    :param client: HTTPX异步客户端
+    
+    :return: 是否创建了缓存
+    """
+    item_info = await get_item_info(item_id, emby_key, client)
+    if item_info is None:
+        logger.debug(f"Skip precaching, item not found: {item_id}")
+        return False
+    
+    written = False
+    ua = req_header.get('User-Agent')
+    for file_info in await get_file_info(item_id, emby_key, media_source_id=None, client=client):
+        file_info = resolve_head_size(file_info, item_info.item_type, ua)
+        if not should_redirect_to_alist(file_info.path) or file_info.size <= file_info.cache_file_size:
+            continue
+        
+        raw_url_task = asyncio.create_task(
+            get_or_cache_alist_raw_url(
+                file_path=file_info.path,
+                host_url=host_url,
+                ua=ua,
+                client=client
+                )
+            )
+        # 开头缓存，以及覆盖文件末尾2MB的缓存
+        for cache_status, start_byte in (
+            (CacheStatus.PARTIAL, 0),
+            (CacheStatus.HIT_TAIL, max(file_info.size - 2 * 1024 * 1024, file_info.cache_file_size)),
+        ):
+            request_info = RequestInfo(
+                file_info=file_info,
+                item_info=item_info,
+                host_url=host_url,
+                start_byte=start_byte,
+                cache_status=cache_status,
+                raw_url_task=raw_url_task,
+                headers=req_header,
+            )
+            if not get_cache_status(request_info):
+                written |= await fill_cache(item_id, request_info, req_header, client=client, job_priority=JobPriority.WARMUP)
+    
+    logger.info(f"Precache for Item ID {item_id} finished.")
+    return written
@@ -0,0 +1,172 @@
+import bisect
+import hashlib
+import os
+import re
+import secrets
+import time
+from typing import AsyncGenerator, Dict, Iterator, List, Optional, Tuple
+
+import fastapi
+import httpx
+from uvicorn.server import logger
+
+from config import *
+
+CLUSTER_SECRET_HEADER = 'X-Cluster-Secret'
+# 多个节点共用一份配置文件时，通过该环境变量指定本节点的地址
+CLUSTER_SELF_ENV = 'EMBYTOALIST_CLUSTER_SELF'
+
+_SUBDIR_PATTERN = re.compile(r'^[0-9a-f]{2}$')
+_DIR_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+def _normalize(url: str) -> str:
+    return url.strip().rstrip('/')
+
+
+def _hash(value: str) -> int:
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing:
+    """一致性哈希环，每个节点对应 virtual_nodes 个虚拟节点，增减节点时只有相邻区间的缓存需要迁移"""
+
+    def __init__(self, nodes: List[str], virtual_nodes: int):
+        self.nodes = list(dict.fromkeys(nodes))
+        points = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(virtual_nodes))
+        self._hashes = [point[0] for point in points]
+        self._nodes = [point[1] for point in points]
+
+    def owners(self, key: str) -> Iterator[str]:
+        """从 key 在环上的位置顺时针依次返回各个不同的节点，第一个为主节点"""
+        if not self._nodes:
+            return
+        index = bisect.bisect(self._hashes, _hash(key))
+        seen = set()
+        for i in range(len(self._nodes)):
+            node = self._nodes[(index + i) % len(self._nodes)]
+            if node in seen:
+                continue
+            seen.add(node)
+            yield node
+            if len(seen) == len(self.nodes):
+                return
+
+
+class Cluster:
+    """
+    集群模式：按缓存目录的哈希（get_hash_subdirectory_from_path）通过一致性哈希将每个视频分配给一个节点，
+    缓存只写入该节点；其他节点通过内部接口从该节点读取缓存，未命中时请求该节点写入缓存
+
+    无法访问的节点在 cluster_node_retry_interval 秒内被跳过，其缓存由环上的下一个节点接管
+    """
+
+    def __init__(self):
+        self.self_url = _normalize(os.environ.get(CLUSTER_SELF_ENV) or cluster_self)
+        self.ring = HashRing([_normalize(node) for node in cluster_nodes], cluster_virtual_nodes)
+        # 未配置密钥时内部接口对任何人开放，不启用集群
+        self.enabled = len(self.ring.nodes) > 1 and self.self_url in self.ring.nodes and bool(cluster_secret)
+        self.client: Optional[httpx.AsyncClient] = None
+        self._down_until: Dict[str, float] = {}
+
+    def start(self, client: httpx.AsyncClient):
+        self.client = client
+        if cluster_nodes and self.self_url not in self.ring.nodes:
+            logger.warning(f"Cluster mode disabled: cluster_self {self.self_url!r} is not one of cluster_nodes.")
+        elif cluster_nodes and not cluster_secret:
+            logger.error("Cluster mode disabled: cluster_secret is not set.")
+        elif self.enabled:
+            logger.info(f"Cluster mode enabled, this node: {self.self_url}, {len(self.ring.nodes)} node(s)")
+
+    def owner(self, dirname: str) -> Optional[str]:
+        """
+        :param dirname: 缓存目录名，即文件路径的哈希
+
+        :return: 缓存所属的其他节点地址；属于本节点或未启用集群时返回 None
+        """
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        for node in self.ring.owners(dirname):
+            if node == self.self_url:
+                return None
+            if self._down_until.get(node, 0) <= now:
+                return node
+        return None
+
+    def _mark_down(self, node: str, error: Exception):
+        logger.warning(f"Cluster node {node} is unavailable, skip it for {cluster_node_retry_interval}s: {error}")
+        self._down_until[node] = time.monotonic() + cluster_node_retry_interval
+
+    def _headers(self) -> dict:
+        return {CLUSTER_SECRET_HEADER: cluster_secret}
+
+    def verify(self, request: fastapi.Request, subdirname: Optional[str] = None, dirname: Optional[str] = None):
+        """校验内部接口的请求，未启用集群时内部接口不可用"""
+        if not self.enabled:
+            raise fastapi.HTTPException(status_code=404, detail="Cluster mode is not enabled")
+        secret = request.headers.get(CLUSTER_SECRET_HEADER, '')
+        if not cluster_secret or not secrets.compare_digest(secret.encode('utf-8'), cluster_secret.encode('utf-8')):
+            raise fastapi.HTTPException(status_code=401, detail="Invalid cluster secret")
+        if subdirname is not None and not (_SUBDIR_PATTERN.match(subdirname) and _DIR_PATTERN.match(dirname)):
+            raise fastapi.HTTPException(status_code=400, detail="Invalid cache key")
+
+    async def lookup(self, node: str, subdirname: str, dirname: str, start_byte: int) -> Optional[Tuple[int, int]]:
+        """
+        查询节点上包含 start_byte 的缓存文件
+
+        :return: 缓存文件的起始点和结束点，不存在或节点不可用时返回 None
+        """
+        try:
+            resp = await self.client.get(
+                f"{node}/internal/cache/{subdirname}/{dirname}",
+                params={'start': start_byte},
+                headers=self._headers(),
+                timeout=cluster_timeout
+                )
+            if resp.status_code == 404:
+                return None
+            resp.raise_for_status()
+            data = resp.json()
+            return data['start'], data['end']
+        except (httpx.HTTPError, ValueError, KeyError) as e:
+            self._mark_down(node, e)
+            return None
+
+    async def read(self, node: str, subdirname: str, dirname: str, start: int, end: int) -> AsyncGenerator[bytes, None]:
+        """从节点读取缓存的指定范围，start 和 end 为文件中的位置"""
+        async with self.client.stream(
+            "GET",
+            f"{node}/internal/cache/{subdirname}/{dirname}/data",
+            headers={**self._headers(), 'Range': f"bytes={start}-{end}"},
+            timeout=cluster_timeout
+            ) as resp:
+            if resp.status_code != 206:
+                raise ValueError(f"Cluster node {node} returned {resp.status_code}")
+            async for chunk in resp.aiter_bytes():
+                yield chunk
+
+    async def request_fill(self, node: str, payload: dict) -> bool:
+        """
+        请求节点写入缓存
+
+        :return: 节点是否接受了请求
+        """
+        try:
+            resp = await self.client.post(f"{node}/internal/cache/fill", json=payload, headers=self._headers(), timeout=cluster_timeout)
+            resp.raise_for_status()
+            return resp.json().get('queued', False)
+        except (httpx.HTTPError, ValueError) as e:
+            self._mark_down(node, e)
+            return False
+
+    def status(self) -> dict:
+        now = time.monotonic()
+        return {
+            'enabled': self.enabled,
+            'self': self.self_url,
+            'nodes': self.ring.nodes,
+            'down': {node: round(until - now, 1) for node, until in self._down_until.items() if until > now},
+        }
+
+cluster = Cluster()
@@ -0,0 +1,161 @@
+import asyncio
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+from uvicorn.server import logger
+
+from config import *
+
+OpenUpstream = Callable[[int, Optional[int]], AsyncIterator[bytes]]
+""" 从指定字节位置打开上游流的函数，参数为起始和结束字节（HTTP Range，None 表示到文件末尾） """
+
+
+class _Detached(Exception):
+    """订阅者读取过慢或落后于窗口，需要改用独立的上游连接"""
+
+
+class _Subscriber:
+    __slots__ = ('position', 'end', 'detached')
+
+    def __init__(self, position: int, end: Optional[int]):
+        self.position = position
+        self.end = end
+        self.detached = False
+
+
+class SharedUpstream:
+    """
+    同一文件的一个上游连接，多个下游请求共享其滑动窗口内的数据
+
+    窗口保留最近 shared_upstream_window_size 字节，新请求的起始位置落在窗口内（或略超前）即可加入；
+    窗口被最慢的订阅者占满时上游暂停读取，超时后该订阅者被分离并改用独立连接
+    """
+
+    def __init__(self, key: str, start: int):
+        self.key = key
+        self.base = start
+        """ 窗口内第一个字节在文件中的位置 """
+        self.position = start
+        """ 上游下一个字节在文件中的位置 """
+        self.buffer = bytearray()
+        self.subscribers = set()
+        self.condition = asyncio.Condition()
+        self.finished = False
+        self.error: Optional[Exception] = None
+
+    def can_attach(self, start: int) -> bool:
+        return not self.finished and self.base <= start <= self.position + shared_upstream_attach_ahead
+
+    async def run(self, open_upstream: OpenUpstream):
+        try:
+            async for chunk in open_upstream(self.position, None):
+                async with self.condition:
+                    if not await self._wait_for_space():
+                        # 在确认没有订阅者的同一次持锁内结束，避免新请求在关闭上游前加入
+                        self.finished = True
+                        break
+                    self.buffer += chunk
+                    self.position += len(chunk)
+                    # 丢弃窗口之外的数据，但不丢弃任何订阅者尚未读取的部分
+                    slowest = min(s.position for s in self.subscribers)
+                    trim = min(self.position - shared_upstream_window_size, slowest) - self.base
+                    if trim > 0:
+                        del self.buffer[:trim]
+                        self.base += trim
+                    self.condition.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            async with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+            _unregister(self)
+
+    async def _wait_for_space(self) -> bool:
+        """
+        等待最慢的订阅者读取数据腾出窗口，超时则将其分离
+
+        :return: 是否还有订阅者，没有订阅者时上游停止读取
+        """
+        while self.subscribers:
+            slowest = min(s.position for s in self.subscribers)
+            if self.position - slowest < shared_upstream_window_size:
+                return True
+            try:
+                await asyncio.wait_for(self.condition.wait(), shared_upstream_wait_timeout)
+            except asyncio.TimeoutError:
+                for s in [s for s in self.subscribers if s.position == slowest]:
+                    s.detached = True
+                    self.subscribers.discard(s)
+                self.condition.notify_all()
+        return False
+
+    async def read(self, sub: _Subscriber, chunk_size: int = 256 * 1024) -> AsyncIterator[bytes]:
+        while sub.end is None or sub.position <= sub.end:
+            async with self.condition:
+                while not sub.detached and sub.position >= self.position and not self.finished:
+                    await self.condition.wait()
+
+                if sub.detached or sub.position < self.base:
+                    raise _Detached()
+                if sub.position >= self.position:
+                    # 上游已结束
+                    if self.error is not None:
+                        raise self.error
+                    if sub.position > self.position:
+                        raise _Detached()
+                    return
+
+                offset = sub.position - self.base
+                limit = len(self.buffer) if sub.end is None else min(len(self.buffer), sub.end + 1 - self.base)
+                data = bytes(self.buffer[offset:min(limit, offset + chunk_size)])
+                sub.position += len(data)
+                self.condition.notify_all()
+            yield data
+
+
+_upstreams: Dict[str, List[SharedUpstream]] = {}
+_tasks = set()
+
+
+def _unregister(upstream: SharedUpstream):
+    upstreams = _upstreams.get(upstream.key)
+    if upstreams is not None and upstream in upstreams:
+        upstreams.remove(upstream)
+        if not upstreams:
+            del _upstreams[upstream.key]
+
+
+async def shared_stream(key: str, start: int, end: Optional[int], open_upstream: OpenUpstream) -> AsyncIterator[bytes]:
+    """
+    读取文件的指定范围，与其他范围重叠的请求共享同一个上游连接
+
+    :param key: 文件的唯一标识，如文件路径
+    :param start: 起始字节
+    :param end: 结束字节，None 表示文件末尾
+    :param open_upstream: 打开上游流的函数，共享连接及分离后的独立连接都通过它打开
+    """
+    for upstream in _upstreams.get(key, []):
+        if upstream.can_attach(start):
+            logger.debug(f"Attach to shared upstream at {upstream.base}-{upstream.position}: {key}")
+            break
+    else:
+        upstream = SharedUpstream(key, start)
+        _upstreams.setdefault(key, []).append(upstream)
+        task = asyncio.create_task(upstream.run(open_upstream))
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+
+    sub = _Subscriber(start, end)
+    upstream.subscribers.add(sub)
+    try:
+        async for data in upstream.read(sub):
+            yield data
+    except _Detached:
+        logger.debug(f"Detached from shared upstream at {sub.position}, open a dedicated upstream: {key}")
+        upstream.subscribers.discard(sub)
+        async for data in open_upstream(sub.position, end):
+            yield data
+    finally:
+        upstream.subscribers.discard(sub)
+        async with upstream.condition:
+            upstream.condition.notify_all()
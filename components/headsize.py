@@ -0,0 +1,164 @@
+import json
+import os
+import re
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+from uvicorn.server import logger
+
+from config import *
+from components.models import FileInfo
+
+# 按 User-Agent 将客户端归类，同一类客户端的起播读取方式相近
+CLIENT_FAMILIES = [
+    ('infuse', re.compile(r'infuse', re.I)),
+    ('vlc', re.compile(r'vlc|libvlc', re.I)),
+    ('mpv', re.compile(r'mpv|libmpv', re.I)),
+    ('kodi', re.compile(r'kodi', re.I)),
+    ('exoplayer', re.compile(r'exoplayer|okhttp|dalvik', re.I)),
+    ('avfoundation', re.compile(r'applecoremedia|avfoundation|apple ?tv|cfnetwork', re.I)),
+    ('emby', re.compile(r'emby', re.I)),
+    ('browser', re.compile(r'mozilla', re.I)),
+]
+
+# 文件末尾2MB内的请求为读取末尾元数据，不计入起播读取范围
+TAIL_SIZE = 2 * 1024 * 1024
+
+
+def client_family(ua: Optional[str]) -> str:
+    for family, pattern in CLIENT_FAMILIES:
+        if ua and pattern.search(ua):
+            return family
+    return 'other'
+
+
+class _Session:
+    __slots__ = ('container', 'family', 'byte_rate', 'started', 'reach')
+
+    def __init__(self, container: str, family: str, byte_rate: float, started: float):
+        self.container = container
+        self.family = family
+        self.byte_rate = byte_rate
+        self.started = started
+        self.reach = 0
+        """ 起播阶段读取到的最远位置，单位 Byte """
+
+
+class HeadSizeAdvisor:
+    """
+    开头缓存大小自适应
+
+    记录播放器起播阶段（从文件开头请求起 cache_head_observe_window 秒内）读取到的最远位置，
+    包括有结束位置的分段请求以及重新发起请求的起始位置，末尾元数据请求和超出 cache_head_max_seconds 的跳转不计入；
+    只请求一次 bytes=0- 并持续读取的播放器不产生观测数据。
+
+    观测值按码率换算为秒数，按 (容器格式, 客户端类型) 分组保留最近 cache_head_samples 个，
+    取 cache_head_percentile 分位数并限制在 cache_head_min_seconds ~ cache_head_max_seconds 之间作为新缓存的开头大小
+    """
+
+    def __init__(self):
+        self.samples: Dict[Tuple[str, str], Deque[float]] = {}
+        self.sessions: Dict[Tuple[str, Optional[str], Optional[str]], _Session] = {}
+
+    @property
+    def state_path(self) -> str:
+        return os.path.join(cache_path, 'head_advisor.json')
+
+    def observe(self, file_info: FileInfo, ua: Optional[str], client: Optional[str], start_byte: int, end_byte: Optional[int]):
+        """
+        记录一次视频请求
+
+        :param file_info: 文件信息
+        :param ua: 客户端 User-Agent
+        :param client: 客户端地址，与 UA、文件路径一起区分不同的播放会话
+        :param start_byte: 请求的起始位置
+        :param end_byte: 请求的结束位置，None 表示到文件末尾
+        """
+        if not enable_adaptive_cache_head or not file_info.bitrate:
+            return
+
+        now = time.monotonic()
+        self._finish_expired(now)
+
+        key = (file_info.path, client, ua)
+        session = self.sessions.get(key)
+        if session is None:
+            if start_byte != 0:
+                return
+            session = _Session(file_info.container or 'unknown', client_family(ua), file_info.bitrate / 8, now)
+            self.sessions[key] = session
+
+        max_bytes = cache_head_max_seconds * session.byte_rate
+        if start_byte >= file_info.size - TAIL_SIZE or start_byte >= max_bytes:
+            return
+        reach = start_byte if end_byte is None else end_byte + 1
+        session.reach = max(session.reach, min(reach, max_bytes))
+
+    def _finish_expired(self, now: float):
+        for key, session in list(self.sessions.items()):
+            if now - session.started < cache_head_observe_window:
+                continue
+            del self.sessions[key]
+            if session.reach > 0:
+                group = (session.container, session.family)
+                self.samples.setdefault(group, deque(maxlen=cache_head_samples)).append(session.reach / session.byte_rate)
+
+    def recommend_seconds(self, container: str, family: str) -> Optional[float]:
+        """
+        :return: 推荐的开头缓存秒数，观测数据不足时返回 None
+        """
+        samples = self.samples.get((container, family))
+        if not samples or len(samples) < cache_head_min_samples:
+            return None
+        ordered = sorted(samples)
+        seconds = ordered[min(int(len(ordered) * cache_head_percentile), len(ordered) - 1)]
+        return min(max(seconds, cache_head_min_seconds), cache_head_max_seconds)
+
+    def recommend(self, file_info: FileInfo, ua: Optional[str]) -> int:
+        """
+        :return: 推荐的开头缓存大小，单位 Byte，未启用或观测数据不足时返回原有的 cache_file_size
+        """
+        if not enable_adaptive_cache_head or not file_info.bitrate:
+            return file_info.cache_file_size
+        seconds = self.recommend_seconds(file_info.container or 'unknown', client_family(ua))
+        if seconds is None:
+            return file_info.cache_file_size
+        return min(int(file_info.bitrate / 8 * seconds), file_info.size)
+
+    def status(self) -> dict:
+        return {
+            f"{container}/{family}": {
+                'samples': len(samples),
+                'recommended_seconds': self.recommend_seconds(container, family),
+            }
+            for (container, family), samples in self.samples.items()
+        }
+
+    def load(self):
+        if not enable_adaptive_cache_head:
+            return
+        try:
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to load head advisor state: {e}")
+            return
+        for group, samples in state.items():
+            container, family = group.split('/', 1)
+            self.samples[(container, family)] = deque(samples, maxlen=cache_head_samples)
+
+    def save(self):
+        """保存观测数据，重启后继续使用；多个工作进程时以最后退出的进程为准"""
+        if not enable_adaptive_cache_head or not self.samples:
+            return
+        try:
+            os.makedirs(cache_path, exist_ok=True)
+            with open(self.state_path, 'w') as f:
+                json.dump({f"{container}/{family}": list(samples) for (container, family), samples in self.samples.items()}, f)
+        except OSError as e:
+            logger.warning(f"Failed to save head advisor state: {e}")
+
+head_advisor = HeadSizeAdvisor()
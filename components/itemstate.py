@@ -0,0 +1,164 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from config import *
+from components.models import FileInfo
+from components.utils import get_hash_subdirectory_from_path, get_content_type
+from components.tier import find_cache_dir
+
+# 最多保留状态的视频数量，超出时淘汰最久未使用的
+MAX_ITEM_STATES = 1024
+# 目录的修改时间距读取时不足该值时，同一时间片内的后续修改不一定会改变修改时间，下次使用时重新读取
+_RACY_NS = 1_000_000_000
+
+
+class ItemState:
+    """
+    单个视频在一次播放的多个 Range 请求间复用的状态：缓存目录哈希、Content-Type、响应头模板及缓存文件列表
+
+    缓存文件列表按缓存目录的修改时间失效，写入、删除缓存文件或分层移动后的第一次使用会重新读取目录，
+    其余请求只需要一次 stat
+    """
+    __slots__ = ('subdirname', 'dirname', 'content_type', '_headers', 'cache_dir', '_mtime_ns', 'writing', 'segments', 'file_infos')
+
+    def __init__(self, subdirname: str, dirname: str):
+        self.subdirname = subdirname
+        self.dirname = dirname
+        self.content_type: Optional[str] = None
+        self._headers: Optional[dict] = None
+        self.cache_dir: Optional[str] = None
+        self._mtime_ns: Optional[int] = None
+        self.writing = False
+        """ 是否有缓存文件正在写入 """
+        self.segments: Tuple[Tuple[int, int, bool], ...] = ()
+        """ 缓存文件的 (起始点, 结束点, 是否正在写入)，按起始点排序，包括正在写入的 """
+        self.file_infos: Optional[Tuple[FileInfo, FileInfo]] = None
+        """ 上次调整开头缓存大小前后的文件信息，见 resolve_head_size """
+
+    def set_container(self, container: Optional[str]):
+        self.content_type = get_content_type(container or '')
+        self._headers = {
+            'Content-Type': self.content_type,
+            'Accept-Ranges': 'bytes',
+            'Cache-Control': 'private, no-transform, no-cache',
+        }
+
+    def range_headers(self, start: int, end: int, size: int, cache: str = 'Hit') -> dict:
+        """
+        由模板生成 206 响应头
+
+        :param start: 响应的起始字节
+        :param end: 响应的结束字节
+        :param size: 文件大小
+        :param cache: X-EmbyToAList-Cache 的值
+        """
+        headers = self._headers.copy()
+        headers['Content-Range'] = f"bytes {start}-{end}/{size}"
+        headers['Content-Length'] = str(end - start + 1)
+        headers['X-EmbyToAList-Cache'] = cache
+        return headers
+
+    def refresh(self) -> Optional[str]:
+        """
+        确认缓存文件列表仍然有效，目录变化时重新读取
+
+        :return: 缓存目录，不存在时返回 None
+        """
+        if self._mtime_ns is not None:
+            try:
+                if os.stat(self.cache_dir).st_mtime_ns == self._mtime_ns:
+                    return self.cache_dir
+            except FileNotFoundError:
+                pass
+        self._load()
+        return self.cache_dir
+
+    def _load(self):
+        self.cache_dir = find_cache_dir(self.subdirname, self.dirname)
+        self._mtime_ns = None
+        self.writing = False
+        self.segments = ()
+        if self.cache_dir is None:
+            return
+        try:
+            # 先 stat 再读取目录，读取期间的修改会使下次检查时的修改时间不一致
+            mtime_ns = os.stat(self.cache_dir).st_mtime_ns
+            files = os.listdir(self.cache_dir)
+        except FileNotFoundError:
+            self.cache_dir = None
+            return
+
+        tags = {file[:-len('.tag')] for file in files if file.endswith('.tag')}
+        segments = []
+        for file in tags.union(files):
+            if not file.startswith('cache_file_') or file.endswith('.tag'):
+                continue
+            try:
+                start, end = map(int, file.split('_')[2:4])
+            except ValueError:
+                continue
+            segments.append((start, end, file in tags))
+        self.segments = tuple(sorted(segments))
+        self.writing = bool(tags)
+        if time.time_ns() - mtime_ns >= _RACY_NS:
+            self._mtime_ns = mtime_ns
+
+    def find(self, start_byte: int, complete_only: bool = False) -> Optional[Tuple[int, int]]:
+        """
+        查找包含 start_byte 的缓存文件，有多个时取结束点最大的一个
+
+        :param complete_only: 是否跳过正在写入的缓存文件
+
+        :return: 缓存文件的起始点和结束点，不存在则返回 None
+        """
+        matched = None
+        for start, end, writing in self.segments:
+            if start > start_byte:
+                break
+            if complete_only and writing:
+                continue
+            if start_byte <= end and (matched is None or end > matched[1]):
+                matched = (start, end)
+        return matched
+
+
+class ItemStates:
+    """按缓存目录保存 ItemState，同时记住文件路径对应的缓存目录，避免每个请求重新计算 MD5"""
+
+    def __init__(self, max_size: int = MAX_ITEM_STATES):
+        self.max_size = max_size
+        self._states: OrderedDict[Tuple[str, str], ItemState] = OrderedDict()
+        self._paths: OrderedDict[Tuple[str, str], ItemState] = OrderedDict()
+
+    def get(self, subdirname: str, dirname: str) -> ItemState:
+        key = (subdirname, dirname)
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = ItemState(subdirname, dirname)
+            if len(self._states) > self.max_size:
+                self._states.popitem(last=False)
+        else:
+            self._states.move_to_end(key)
+        return state
+
+    def for_file(self, file_info: FileInfo, item_type: str) -> ItemState:
+        """
+        :param file_info: 文件信息
+        :param item_type: 视频类型，用于定位缓存目录
+        """
+        key = (file_info.path, item_type)
+        state = self._paths.get(key)
+        if state is None:
+            state = self.get(*get_hash_subdirectory_from_path(file_info.path, item_type))
+            self._paths[key] = state
+            if len(self._paths) > self.max_size:
+                self._paths.popitem(last=False)
+        else:
+            self._paths.move_to_end(key)
+        if state.content_type is None:
+            state.set_container(file_info.container)
+        return state
+
+item_states = ItemStates()
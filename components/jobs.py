@@ -0,0 +1,192 @@
+import asyncio
+import heapq
+import itertools
+import time
+from enum import IntEnum
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional
+
+from uvicorn.server import logger
+
+from config import *
+from components.monitor import load_monitor
+
+
+class JobPriority(IntEnum):
+    """ 后台任务优先级，数值越小越先执行 """
+
+    FOREGROUND = 0
+    """ 当前播放请求触发的缓存填充 """
+    PREFETCH = 1
+    """ 下一集、PlaybackInfo 及恢复播放位置的预缓存 """
+    WARMUP = 2
+    """ 新入库媒体的预缓存 """
+
+
+class _Job:
+    __slots__ = ('key', 'priority', 'seq', 'func', 'args', 'kwargs', 'submitted', 'started', 'cancelled')
+
+    def __init__(self, key: Hashable, priority: JobPriority, seq: int, func: Callable[..., Awaitable], args: tuple, kwargs: dict):
+        self.key = key
+        self.priority = priority
+        self.seq = seq
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.submitted = time.monotonic()
+        self.started: Optional[float] = None
+        self.cancelled = False
+
+    def __lt__(self, other: '_Job') -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def describe(self, now: float) -> dict:
+        info = {
+            'key': [str(part) for part in self.key] if isinstance(self.key, tuple) else str(self.key),
+            'priority': self.priority.name,
+            'func': getattr(self.func, '__name__', repr(self.func)),
+        }
+        if self.started is None:
+            info['waiting_ms'] = round((now - self.submitted) * 1000, 1)
+        else:
+            info['running_ms'] = round((now - self.started) * 1000, 1)
+        return info
+
+
+class JobQueue:
+    """
+    缓存相关后台任务的有界优先级队列
+
+    由 lifespan 启动 job_workers 个工作协程按优先级执行任务，同一 key 的任务在排队或执行期间只保留一个，
+    重复提交时只会提升排队中任务的优先级；队列满时丢弃优先级最低、最晚提交的任务。
+    执行中的任务不会被抢占，因此有多个工作协程时至少保留一个只执行 FOREGROUND 任务，
+    避免当前播放的缓存排在预缓存之后。本机反代负载超过阈值时（见 load_monitor），只执行 FOREGROUND 任务
+    """
+
+    def __init__(self):
+        self._heap: List[_Job] = []
+        self._queued: Dict[Hashable, _Job] = {}
+        self._running: Dict[Hashable, _Job] = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._workers: List[asyncio.Task] = []
+        self.stats = {'submitted': 0, 'deduplicated': 0, 'dropped': 0, 'completed': 0, 'failed': 0}
+
+    def submit(self, key: Hashable, priority: JobPriority, func: Callable[..., Awaitable], *args, **kwargs) -> bool:
+        """
+        提交后台任务
+
+        :param key: 去重键，如 ('write', 文件路径, 缓存范围)
+        :param priority: 优先级
+        :param func: 异步函数
+
+        :return: 是否加入了队列，重复或被丢弃时返回 False
+        """
+        if key in self._running:
+            self.stats['deduplicated'] += 1
+            return False
+
+        queued = self._queued.get(key)
+        if queued is not None:
+            self.stats['deduplicated'] += 1
+            if priority < queued.priority:
+                # 堆中的旧任务作废，以新的优先级重新排队
+                queued.cancelled = True
+                self._push(_Job(key, priority, queued.seq, queued.func, queued.args, queued.kwargs))
+            return False
+
+        if len(self._queued) >= job_queue_max_size:
+            lowest = max(self._queued.values())
+            if not priority < lowest.priority:
+                self.stats['dropped'] += 1
+                logger.warning(f"Job queue is full, dropped {priority.name} job: {key}")
+                return False
+            lowest.cancelled = True
+            del self._queued[lowest.key]
+            self.stats['dropped'] += 1
+            logger.warning(f"Job queue is full, dropped {lowest.priority.name} job: {lowest.key}")
+
+        self.stats['submitted'] += 1
+        self._push(_Job(key, priority, next(self._seq), func, args, kwargs))
+        return True
+
+    def _push(self, job: _Job):
+        self._queued[job.key] = job
+        heapq.heappush(self._heap, job)
+        self._wakeup.set()
+
+    def _peek(self) -> Optional[_Job]:
+        while self._heap and self._heap[0].cancelled:
+            heapq.heappop(self._heap)
+        return self._heap[0] if self._heap else None
+
+    def _background_running(self) -> int:
+        return sum(1 for job in self._running.values() if job.priority != JobPriority.FOREGROUND)
+
+    async def _next_job(self) -> _Job:
+        while True:
+            job = self._peek()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            if job.priority == JobPriority.FOREGROUND:
+                heapq.heappop(self._heap)
+                del self._queued[job.key]
+                return job
+            if self._background_running() >= max(len(self._workers) - 1, 1):
+                # 其余工作协程留给 FOREGROUND 任务，等待低优先级任务执行完毕或有新任务提交
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            if load_monitor.overload_reason() is None:
+                heapq.heappop(self._heap)
+                del self._queued[job.key]
+                return job
+            # 负载过高，低优先级任务等待负载下降或有新任务提交
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self):
+        while True:
+            job = await self._next_job()
+            job.started = time.monotonic()
+            self._running[job.key] = job
+            try:
+                await job.func(*job.args, **job.kwargs)
+                self.stats['completed'] += 1
+            except Exception as e:
+                self.stats['failed'] += 1
+                logger.error(f"Job {job.key} failed: {e}")
+            finally:
+                self._running.pop(job.key, None)
+                self._wakeup.set()
+                logger.debug("Job %s finished in %.0fms", job.key, (time.monotonic() - job.started) * 1000)
+
+    def start(self):
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker(), name=f"job-worker-{i}") for i in range(job_workers)]
+
+    async def stop(self):
+        """停止工作协程，排队中的任务被丢弃，执行中的任务被取消"""
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._queued:
+            logger.info(f"Discarded {len(self._queued)} queued job(s).")
+        self._heap.clear()
+        self._queued.clear()
+
+    def status(self) -> dict:
+        now = time.monotonic()
+        return {
+            'workers': len(self._workers),
+            'running': [job.describe(now) for job in self._running.values()],
+            'queued': [job.describe(now) for job in sorted(self._queued.values())],
+            **self.stats,
+        }
+
+job_queue = JobQueue()
@@ -0,0 +1,200 @@
+import importlib.util
+import json
+import logging.config
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from typing import List, Optional
+
+import uvicorn
+from uvicorn.server import logger
+
+from config import *
+
+APP = "main:app"
+# 工作进程运行不足该秒数就退出视为启动失败，重新拉起前按指数退避等待
+WORKER_MIN_UPTIME = 10
+WORKER_RESTART_BACKOFF = 1
+WORKER_RESTART_BACKOFF_MAX = 60
+# 同一工作进程连续启动失败该次数后不再重试，主进程退出
+WORKER_MAX_QUICK_EXITS = 8
+
+
+def _server_config(**kwargs) -> uvicorn.Config:
+    """根据配置文件生成 uvicorn 配置，单进程和每个工作进程共用"""
+    return uvicorn.Config(
+        kwargs.pop('app', APP),
+        host=server_host,
+        port=server_port,
+        loop=server_loop,
+        http=server_http,
+        limit_max_requests=server_limit_max_requests or None,
+        timeout_graceful_shutdown=server_graceful_shutdown_timeout,
+        log_config="logger_config.json",
+        log_level=log_level.lower(),
+        **kwargs
+    )
+
+
+def _log_backends():
+    """uvloop 和 httptools 是可选依赖，auto 模式下安装了才会使用"""
+    loop = server_loop
+    if loop == "auto":
+        loop = "uvloop" if importlib.util.find_spec("uvloop") is not None else "asyncio"
+    http = server_http
+    if http == "auto":
+        http = "httptools" if importlib.util.find_spec("httptools") is not None else "h11"
+    logger.info(f"Event loop: {loop}, HTTP protocol: {http}")
+
+
+def _bind_socket(reuse_port: bool = False) -> socket.socket:
+    family = socket.AF_INET6 if ':' in server_host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((server_host, server_port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _serve(sock: Optional[socket.socket]):
+    """
+    工作进程入口，每个进程独立导入 main:app 并运行 lifespan，初始化自己的请求客户端、日志队列和后台任务
+
+    :param sock: prefork 模式下由主进程监听的 socket；reuseport 模式下为 None，由工作进程自行监听
+    """
+    if sock is None:
+        sock = _bind_socket(reuse_port=True)
+    server = uvicorn.Server(_server_config())
+    server.run(sockets=[sock])
+
+
+class Supervisor:
+    """
+    多进程主进程：启动工作进程，工作进程退出（如达到 server_limit_max_requests）后重新拉起，
+    收到 SIGINT/SIGTERM 时通知所有工作进程优雅退出
+
+    启动后很快退出的工作进程（如导入或 lifespan 失败）按指数退避重新拉起，连续失败过多时主进程退出
+    """
+
+    def __init__(self, workers: int, reuse_port: bool):
+        self.workers = workers
+        self.reuse_port = reuse_port
+        self.sock = None if reuse_port else _bind_socket()
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * workers
+        """ 工作进程，等待重新拉起时为 None """
+        self._started_at = [0.0] * workers
+        self._quick_exits = [0] * workers
+        self._restart_at = [0.0] * workers
+        self.should_exit = False
+        self.failed = False
+        """ 工作进程连续启动失败，主进程放弃重试 """
+        self._context = multiprocessing.get_context('spawn')
+
+    def _spawn(self, index: int):
+        process = self._context.Process(target=_serve, args=(self.sock,), name=f"worker-{index}")
+        process.start()
+        self.processes[index] = process
+        self._started_at[index] = time.monotonic()
+        logger.info(f"Started worker process [{process.pid}]")
+
+    def _handle_worker_exit(self, index: int, process: multiprocessing.Process):
+        """工作进程退出后安排重新拉起，启动后很快退出时按指数退避延迟"""
+        uptime = time.monotonic() - self._started_at[index]
+        pid, exitcode = process.pid, process.exitcode
+        process.close()
+        self.processes[index] = None
+
+        if uptime >= WORKER_MIN_UPTIME:
+            self._quick_exits[index] = 0
+            logger.info(f"Worker process [{pid}] exited with code {exitcode}, restarting.")
+            self._restart_at[index] = 0.0
+            return
+
+        self._quick_exits[index] += 1
+        if self._quick_exits[index] >= WORKER_MAX_QUICK_EXITS:
+            logger.error(f"Worker process exited {self._quick_exits[index]} times in a row right after starting "
+                         f"(last exit code {exitcode}), giving up.")
+            self.failed = True
+            self.should_exit = True
+            return
+        delay = min(WORKER_RESTART_BACKOFF * 2 ** (self._quick_exits[index] - 1), WORKER_RESTART_BACKOFF_MAX)
+        logger.warning(f"Worker process [{pid}] exited with code {exitcode} after {uptime:.1f}s, "
+                       f"restarting in {delay}s.")
+        self._restart_at[index] = time.monotonic() + delay
+
+    def _handle_exit(self, sig, frame):
+        self.should_exit = True
+
+    def run(self):
+        logger.info(f"Started parent process [{os.getpid()}], {self.workers} workers, "
+                    f"{'SO_REUSEPORT' if self.reuse_port else 'shared socket'} on {server_host}:{server_port}")
+        signal.signal(signal.SIGINT, self._handle_exit)
+        signal.signal(signal.SIGTERM, self._handle_exit)
+
+        for index in range(self.workers):
+            self._spawn(index)
+
+        while not self.should_exit:
+            time.sleep(0.5)
+            for index, process in enumerate(self.processes):
+                if self.should_exit:
+                    break
+                if process is None:
+                    if time.monotonic() >= self._restart_at[index]:
+                        self._spawn(index)
+                    continue
+                if process.is_alive():
+                    continue
+                self._handle_worker_exit(index, process)
+
+        logger.info("Shutting down, waiting for workers to finish in-flight requests.")
+        processes = [process for process in self.processes if process is not None]
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+        deadline = time.monotonic() + server_graceful_shutdown_timeout + 5
+        for process in processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"Worker process [{process.pid}] did not exit in time, killing.")
+                process.kill()
+                process.join()
+
+        if self.sock is not None:
+            self.sock.close()
+        logger.info(f"Stopped parent process [{os.getpid()}]")
+        if self.failed:
+            raise SystemExit(1)
+
+
+def run(app=None):
+    """
+    按配置启动服务
+
+    单进程且不回收时与原来一样直接运行 app；否则由 Supervisor 管理多个工作进程，
+    工作进程通过 "main:app" 重新导入应用
+
+    :param app: 单进程模式下直接运行的应用对象
+    """
+    workers = server_workers or os.cpu_count() or 1
+    reuse_port = server_socket_mode == "reuseport"
+    if reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+        logger.warning("SO_REUSEPORT is not supported on this platform, fallback to prefork.")
+        reuse_port = False
+
+    if workers == 1 and not server_limit_max_requests:
+        server = uvicorn.Server(_server_config(app=app or APP))
+        _log_backends()
+        server.run()
+        return
+
+    with open("logger_config.json", "r", encoding="utf-8") as f:
+        logging.config.dictConfig(json.load(f))
+    logger.setLevel(log_level.upper())
+    _log_backends()
+    Supervisor(workers, reuse_port).run()
@@ -0,0 +1,131 @@
+import contextvars
+import functools
+import logging
+import logging.handlers
+import queue
+import random
+import time
+
+import fastapi
+from uvicorn.server import logger
+
+from config import *
+from components.monitor import load_monitor
+from components.trace import trace_recorder
+
+# 当前请求是否记录调试日志，由 access_logged 在每个请求开始时决定
+_debug_sampled = contextvars.ContextVar("debug_sampled", default=None)
+_listeners = []
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """不在调用方格式化日志，格式化和写入都交给 QueueListener 的线程"""
+
+    def prepare(self, record):
+        return record
+
+
+class _SampleFilter(logging.Filter):
+    """按 log_debug_sample_rate 对 DEBUG 日志采样，同一请求内的调试日志全部保留或全部丢弃"""
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or log_debug_sample_rate >= 1:
+            return True
+        sampled = _debug_sampled.get()
+        if sampled is None:
+            return random.random() < log_debug_sample_rate
+        return sampled
+
+
+def setup_queue_logging(logger_names=("uvicorn", "uvicorn.access")):
+    """
+    将 uvicorn 的日志处理器替换为队列，实际的格式化和写入在后台线程中进行
+
+    需要在 uvicorn 加载 logger_config.json 之后调用，每个进程调用一次
+
+    :param logger_names: 需要替换处理器的 logger 名称
+    """
+    for name in logger_names:
+        target = logging.getLogger(name)
+        handlers = target.handlers[:]
+        if not handlers:
+            continue
+
+        log_queue = queue.SimpleQueue()
+        queue_handler = _DeferredQueueHandler(log_queue)
+        queue_handler.addFilter(_SampleFilter())
+        listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+
+        for handler in handlers:
+            target.removeHandler(handler)
+        target.addHandler(queue_handler)
+        listener.start()
+        _listeners.append(listener)
+
+
+def stop_queue_logging():
+    """停止后台线程，并写出队列中剩余的日志"""
+    while _listeners:
+        _listeners.pop().stop()
+
+
+class InFlightMiddleware:
+    """
+    在响应发送结束后移出 access_logged 登记的进行中请求
+
+    流式响应在路由返回后才开始传输，客户端可能在传输开始前断开，因此不能依赖响应生成器的 finally
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        # 预先创建 state，路由中的 request.state 与这里引用同一个字典
+        state = scope.setdefault("state", {})
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            request_id = state.pop("in_flight_request_id", None)
+            if request_id is not None:
+                load_monitor.request_finished(request_id)
+
+
+def access_logged(func):
+    """
+    为视频请求记录一条结构化访问日志及请求轨迹，并决定该请求的调试日志是否采样
+
+    被装饰的路由需要将 RequestInfo 存放在 request.state.request_info 中
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, request: fastapi.Request, **kwargs):
+        _debug_sampled.set(random.random() < log_debug_sample_rate)
+        start = time.perf_counter()
+        status_code = 500
+        request_id = load_monitor.request_started(
+            item_id=kwargs.get("item_id"),
+            range=request.headers.get("Range"),
+            ua=request.headers.get("User-Agent"),
+        )
+        # 由 InFlightMiddleware 在响应发送结束后移出
+        request.state.in_flight_request_id = request_id
+        try:
+            response = await func(*args, request=request, **kwargs)
+            status_code = response.status_code
+            return response
+        except fastapi.HTTPException as e:
+            status_code = e.status_code
+            raise
+        finally:
+            request_info = getattr(request.state, "request_info", None)
+            trace_recorder.record(request, kwargs.get("item_id"), status_code, request_info, start)
+            if log_access_records:
+                logger.info(
+                    "Access: item=%s status=%s cache=%s range=%s ua=\"%s\" time=%.1fms",
+                    kwargs.get("item_id"),
+                    status_code,
+                    request_info.cache_status if request_info is not None else "-",
+                    request.headers.get("Range", "-"),
+                    request.headers.get("User-Agent", "-"),
+                    (time.perf_counter() - start) * 1000,
+                )
+    return wrapper
@@ -0,0 +1,350 @@
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from uvicorn.server import logger
+
+from config import *
+from components.models import FileInfo
+from components.utils import get_hash_subdirectory_from_path, transform_file_path
+from components.tier import cache_tiers, iter_cache_dirs, lock_cache_dir
+from components.cache import CACHE_META_FILE, verify_cache_file
+
+# 报告中最多列出的操作数量
+MAX_REPORTED_ACTIONS = 500
+
+
+async def fetch_emby_index(client: httpx.AsyncClient, page_size: int = 500) -> Dict[Tuple[str, str], dict]:
+    """
+    分页获取 Emby 媒体库中所有电影和剧集的 MediaSource，按缓存目录索引
+
+    :return: (subdirname, dirname) 到缓存元数据（path、size、item_id、item_type）的映射
+    """
+    index = {}
+    start_index = 0
+    while True:
+        items_api = (f"{emby_server}/emby/Items?api_key={emby_key}&Recursive=true&IncludeItemTypes=Movie,Episode"
+                     f"&Fields=Path,MediaSources&StartIndex={start_index}&Limit={page_size}")
+        req = await client.get(items_api, timeout=60)
+        req.raise_for_status()
+        items = req.json().get('Items') or []
+        for item in items:
+            item_type = 'movie' if item.get('Type', '').lower() == 'movie' else 'episode'
+            for media_source in item.get('MediaSources') or []:
+                if not media_source.get('Path'):
+                    continue
+                path = transform_file_path(media_source['Path'])
+                index[get_hash_subdirectory_from_path(path, item_type)] = {
+                    'path': path,
+                    'size': media_source.get('Size', 0),
+                    'item_id': str(item['Id']),
+                    'item_type': item_type,
+                }
+        if len(items) < page_size:
+            return index
+        start_index += page_size
+
+
+def _file_sha256(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(4 * 1024 * 1024):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class _DirVerifier:
+    """检查并修复单个缓存目录，在线程池中执行"""
+
+    def __init__(self, cache_dir: str, emby_entry: Optional[dict], use_emby: bool,
+                 checksum: bool, dry_run: bool, remove_orphans: bool, tag_max_age: float):
+        self.cache_dir = cache_dir
+        self.emby_entry = emby_entry
+        self.use_emby = use_emby
+        self.checksum = checksum
+        self.dry_run = dry_run
+        self.remove_orphans = remove_orphans
+        self.tag_max_age = tag_max_age
+        self.counts = Counter()
+        self.actions: List[dict] = []
+
+    def _act(self, action: str, path: str, reason: str):
+        self.counts[action] += 1
+        self.actions.append({'action': action, 'path': path, 'reason': reason})
+
+    def _remove_file(self, path: str, reason: str, action: str = 'removed_files'):
+        self._act(action, path, reason)
+        if not self.dry_run:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _remove_dir(self, reason: str):
+        self._act('removed_dirs', self.cache_dir, reason)
+        if not self.dry_run:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def _read_meta(self) -> Optional[dict]:
+        try:
+            with open(os.path.join(self.cache_dir, CACHE_META_FILE), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            self.counts['invalid_meta'] += 1
+            return None
+
+    def _write_meta(self, meta: dict):
+        if self.dry_run:
+            return
+        meta_path = os.path.join(self.cache_dir, CACHE_META_FILE)
+        tmp = f"{meta_path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(meta, ensure_ascii=False))
+        os.replace(tmp, meta_path)
+
+    def run(self):
+        self.counts['dirs'] += 1
+        if self.dry_run:
+            self._check()
+            return
+        # 与分层移动相同，持有目录的排他锁：写入缓存文件期间持有共享锁，检查期间不会有新的写入开始
+        fd = lock_cache_dir(self.cache_dir, exclusive=True)
+        if fd is False:
+            # 正在写入或移动到另一层，下次检查
+            self.counts['skipped_dirs'] += 1
+            return
+        try:
+            self._check()
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def _check(self):
+        meta = self._read_meta()
+        meta_changed = False
+
+        if self.use_emby:
+            if self.emby_entry is None:
+                self.counts['orphan_dirs'] += 1
+                if self.remove_orphans:
+                    self._remove_dir("not found in Emby library")
+                    return
+            elif meta is not None and meta.get('size') != self.emby_entry['size']:
+                # 源文件已被替换，缓存内容不再可信
+                self._remove_dir(f"size changed in Emby: {meta.get('size')} -> {self.emby_entry['size']}")
+                return
+            elif meta is None or any(meta.get(k) != v for k, v in self.emby_entry.items()):
+                self._act('rebuilt_meta', self.cache_dir, "missing or outdated meta.json")
+                meta = {**(meta or {}), **self.emby_entry}
+                meta_changed = True
+
+        file_size = (meta or {}).get('size') or None
+        checksums = dict((meta or {}).get('checksums') or {})
+        now = time.time()
+
+        try:
+            files = os.listdir(self.cache_dir)
+        except FileNotFoundError:
+            return
+
+        writing = set()
+        for file in list(files):
+            if not file.endswith('.tag'):
+                continue
+            tag_path = os.path.join(self.cache_dir, file)
+            try:
+                age = now - os.stat(tag_path).st_mtime
+            except FileNotFoundError:
+                continue
+            if age < self.tag_max_age:
+                writing.add(file[:-len('.tag')])
+                continue
+            # 写入进程已退出留下的标记，对应的缓存文件可能不完整
+            data_file = file[:-len('.tag')]
+            self._remove_file(tag_path, f"orphaned write tag, {age:.0f}s old", 'removed_tags')
+            if data_file in files:
+                self._remove_file(os.path.join(self.cache_dir, data_file), "incomplete write")
+                files.remove(data_file)
+
+        valid = set()
+        for file in files:
+            if not file.startswith('cache_file_') or file.endswith('.tag') or file in writing:
+                continue
+            path = os.path.join(self.cache_dir, file)
+            try:
+                start, end = map(int, file.split('_')[2:4])
+            except ValueError:
+                self._remove_file(path, "invalid file name")
+                continue
+            try:
+                size = os.stat(path).st_size
+            except FileNotFoundError:
+                continue
+            self.counts['files'] += 1
+            self.counts['bytes'] += size
+
+            if size != end - start + 1:
+                # 删除前再次确认没有进程开始重新写入该文件
+                if not os.path.exists(f"{path}.tag"):
+                    self._remove_file(path, f"length {size} does not match range {start}-{end}")
+                continue
+            if file_size and not verify_cache_file(FileInfo(path='', bitrate=0, size=file_size, container='', cache_file_size=0), (start, end)):
+                self._remove_file(path, f"range {start}-{end} is outside file size {file_size}")
+                continue
+            if self.checksum:
+                digest = _file_sha256(path)
+                if file not in checksums:
+                    checksums[file] = digest
+                    meta_changed = True
+                elif checksums[file] != digest:
+                    self._remove_file(path, "checksum mismatch")
+                    del checksums[file]
+                    meta_changed = True
+                    continue
+            valid.add(file)
+
+        if not valid and not writing:
+            self._remove_dir("no valid cache files")
+            return
+
+        # 清理已删除文件的校验值
+        for file in [file for file in checksums if file not in valid]:
+            del checksums[file]
+            meta_changed = True
+        if meta is not None and meta_changed:
+            if checksums:
+                meta['checksums'] = checksums
+            else:
+                meta.pop('checksums', None)
+            self._write_meta(meta)
+
+
+def verify_cache(emby_index: Optional[Dict[Tuple[str, str], dict]] = None,
+                 checksum: bool = False,
+                 dry_run: bool = False,
+                 remove_orphans: bool = False,
+                 workers: int = maintenance_workers,
+                 tag_max_age: float = maintenance_tag_max_age) -> dict:
+    """
+    并行检查并修复各层中的所有缓存目录
+
+    - 缓存文件的实际长度与文件名中的范围不一致、范围超出源文件大小时删除
+    - 超过 tag_max_age 秒的写入标记（写入进程已退出）及对应的不完整文件删除
+    - 没有有效缓存文件的目录、空的哈希子目录、中断的分层移动（*.moving-*）删除
+    - 提供 emby_index 时：源文件大小已变化的目录整个删除，缺失或过时的 meta.json 重建，
+      不在媒体库中的目录计为 orphan_dirs，remove_orphans 为 True 时删除
+    - checksum 为 True 时计算 SHA-256，首次记录到 meta.json，之后不一致时删除
+    - 检查期间持有目录的排他锁，正在写入或移动的目录跳过，计为 skipped_dirs
+
+    :param emby_index: fetch_emby_index 的结果，为 None 时不与 Emby 比对
+    :param checksum: 是否校验文件内容
+    :param dry_run: 只报告，不修改文件
+    :param remove_orphans: 是否删除不在媒体库中的缓存目录
+    :param workers: 线程数
+    :param tag_max_age: 写入标记超过该秒数视为残留
+
+    :return: 统计及操作列表
+    """
+    started = time.monotonic()
+    counts = Counter()
+    actions = []
+    verifiers = []
+    now = time.time()
+
+    for tier, subdirname, dirname in iter_cache_dirs():
+        cache_dir = os.path.join(tier, subdirname, dirname)
+        if '.moving-' in dirname:
+            try:
+                stale = now - os.stat(cache_dir).st_mtime > tag_max_age
+            except FileNotFoundError:
+                continue
+            if stale:
+                counts['removed_dirs'] += 1
+                actions.append({'action': 'removed_dirs', 'path': cache_dir, 'reason': "interrupted tier move"})
+                if not dry_run:
+                    shutil.rmtree(cache_dir, ignore_errors=True)
+            continue
+        emby_entry = emby_index.get((subdirname, dirname)) if emby_index is not None else None
+        verifiers.append(_DirVerifier(cache_dir, emby_entry, emby_index is not None, checksum, dry_run, remove_orphans, tag_max_age))
+
+    def run(verifier: _DirVerifier):
+        try:
+            verifier.run()
+        except Exception as e:
+            verifier.counts['errors'] += 1
+            verifier.actions.append({'action': 'errors', 'path': verifier.cache_dir, 'reason': str(e)})
+        return verifier
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='verify-cache') as executor:
+        for verifier in executor.map(run, verifiers):
+            counts.update(verifier.counts)
+            actions.extend(verifier.actions)
+
+    # 删除空的哈希子目录
+    for tier in cache_tiers():
+        if not os.path.isdir(tier):
+            continue
+        for subdir in os.scandir(tier):
+            if subdir.is_dir() and not os.listdir(subdir.path):
+                counts['removed_dirs'] += 1
+                actions.append({'action': 'removed_dirs', 'path': subdir.path, 'reason': "empty hash directory"})
+                if not dry_run:
+                    try:
+                        os.rmdir(subdir.path)
+                    except OSError:
+                        pass
+
+    return {
+        'dry_run': dry_run,
+        'elapsed_seconds': round(time.monotonic() - started, 2),
+        **{key: counts.get(key, 0) for key in (
+            'dirs', 'files', 'bytes', 'removed_files', 'removed_tags', 'removed_dirs',
+            'rebuilt_meta', 'orphan_dirs', 'invalid_meta', 'skipped_dirs', 'errors')},
+        'actions': actions[:MAX_REPORTED_ACTIONS],
+    }
+
+
+class CacheMaintenance:
+    """在线执行缓存检查，记录最近一次的结果，供 /admin/maintenance 查询"""
+
+    def __init__(self):
+        self.running = False
+        self.last_report: Optional[dict] = None
+
+    async def run(self, client: httpx.AsyncClient, use_emby: bool = True, **kwargs) -> dict:
+        """
+        :param client: 请求 Emby 的客户端
+        :param use_emby: 是否与 Emby 媒体库比对
+        :param kwargs: 传给 verify_cache 的参数
+        """
+        self.running = True
+        try:
+            emby_index = None
+            if use_emby:
+                try:
+                    emby_index = await fetch_emby_index(client)
+                except (httpx.HTTPError, ValueError) as e:
+                    # 媒体库不完整时比对会误判，跳过 Emby 相关检查
+                    logger.warning(f"Failed to fetch Emby library, skip Emby checks: {e}")
+            report = await asyncio.to_thread(verify_cache, emby_index, **kwargs)
+            report['emby_checked'] = emby_index is not None
+            self.last_report = dict(report, finished_at=time.time())
+            logger.info(f"Cache maintenance finished: {report['dirs']} dir(s), {report['removed_files']} file(s), "
+                        f"{report['removed_tags']} tag(s), {report['removed_dirs']} dir(s) removed")
+            return report
+        finally:
+            self.running = False
+
+    def status(self) -> dict:
+        return {'running': self.running, 'last_report': self.last_report}
+
+cache_maintenance = CacheMaintenance()
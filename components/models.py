@@ -1,7 +1,7 @@
 from dataclasses import dataclass
 from enum import StrEnum
 import asyncio
-from typing import Optional
+from typing import Optional, Tuple
 
 class CacheStatus(StrEnum):
     """ 本地缓存状态 """
@@ -17,7 +17,7 @@ class CacheStatus(StrEnum):
     UNKNOWN = "Unknown"
     """ 未知状态 """
 
-@dataclass
+@dataclass(slots=True)
 class ItemInfo:
     """ 视频信息，如果type是movie，则season_id为None """
     
@@ -25,7 +25,7 @@ class ItemInfo:
     item_type: str
     season_id: int
 
-@dataclass
+@dataclass(slots=True)
 class FileInfo:
     # status: bool
     path: str
@@ -34,7 +34,7 @@ class FileInfo:
     container: str
     cache_file_size: int
     
-@dataclass
+@dataclass(slots=True)
 class RequestInfo:
     file_info: FileInfo
     item_info: ItemInfo
@@ -45,4 +45,9 @@ class RequestInfo:
     api_key: Optional[str] = None
     raw_url: Optional[str] = None
     raw_url_task: Optional[asyncio.Task[str]] = None
-    headers: Optional[dict] = None
\ No newline at end of file
+    headers: Optional[dict] = None
+    cache_range: Optional[Tuple[int, int]] = None
+    fallback_url: Optional[str] = None
+    """ Alist 不可用时的降级地址，即通过 preventRedirect 由 Emby 直接提供原始文件 """
+    cache_node: Optional[str] = None
+    """ 集群模式下命中的缓存所在的节点，为 None 时缓存位于本机 """
\ No newline at end of file
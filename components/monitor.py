@@ -0,0 +1,120 @@
+import asyncio
+import re
+import time
+from typing import Dict, Optional
+
+from uvicorn.server import logger
+
+from config import *
+
+
+class LoadMonitor:
+    """
+    统计本机反代负载：反代带宽、活跃反代流数量、事件循环延迟，以及进行中的请求
+
+    由 lifespan 启动一个后台采样任务，按固定间隔计算带宽与事件循环延迟
+    """
+
+    def __init__(self, interval: float = 0.5, smoothing: float = 0.3):
+        """
+        :param interval: 采样间隔，单位秒
+        :param smoothing: 指数平滑系数，越大对瞬时变化越敏感
+        """
+        self.interval = interval
+        self.smoothing = smoothing
+        self.active_streams = 0
+        self.total_bytes = 0
+        self.bandwidth = 0.0
+        """ 平滑后的反代带宽，单位 Byte/s """
+        self.event_loop_lag = 0.0
+        """ 平滑后的事件循环延迟，单位秒 """
+        self.in_flight: Dict[int, dict] = {}
+        """ 进行中的视频请求，由 access_logged 登记，InFlightMiddleware 在响应结束后移出 """
+        self._task: Optional[asyncio.Task] = None
+        self._next_request_id = 0
+
+    def request_started(self, **info) -> int:
+        """
+        登记一个进行中的请求
+
+        :return: 请求编号，请求结束时传给 request_finished
+        """
+        self._next_request_id += 1
+        self.in_flight[self._next_request_id] = dict(info, started=time.perf_counter())
+        return self._next_request_id
+
+    def request_finished(self, request_id: int):
+        self.in_flight.pop(request_id, None)
+
+    def stream_started(self):
+        self.active_streams += 1
+
+    def stream_finished(self):
+        self.active_streams -= 1
+
+    def add_bytes(self, size: int):
+        self.total_bytes += size
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._sample())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _sample(self):
+        last_time = time.monotonic()
+        last_bytes = self.total_bytes
+        while True:
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            elapsed = now - last_time
+            # 实际睡眠时间超出预期的部分即为事件循环延迟
+            lag = max(0.0, elapsed - self.interval)
+            rate = (self.total_bytes - last_bytes) / elapsed if elapsed > 0 else 0.0
+
+            self.event_loop_lag += self.smoothing * (lag - self.event_loop_lag)
+            self.bandwidth += self.smoothing * (rate - self.bandwidth)
+            last_time, last_bytes = now, self.total_bytes
+
+    def overload_reason(self) -> Optional[str]:
+        """
+        检查当前负载是否超过配置的阈值
+
+        :return: 超出阈值的原因，未超出则返回 None
+        """
+        if load_max_proxy_bandwidth and self.bandwidth > load_max_proxy_bandwidth:
+            return f"proxy bandwidth {self.bandwidth / 1024 / 1024:.1f}MB/s"
+        if load_max_active_streams and self.active_streams >= load_max_active_streams:
+            return f"{self.active_streams} active streams"
+        if load_max_event_loop_lag and self.event_loop_lag > load_max_event_loop_lag:
+            return f"event loop lag {self.event_loop_lag * 1000:.0f}ms"
+        return None
+
+    def should_redirect(self, ua: Optional[str]) -> bool:
+        """
+        负载过高时，是否应将本应反代的请求降级为302重定向
+
+        :param ua: 客户端 User-Agent，无法正确处理302的客户端始终反代
+        """
+        if not enable_load_adaptive_redirect:
+            return False
+
+        reason = self.overload_reason()
+        if reason is None:
+            return False
+
+        if ua is not None and any(re.search(pattern, ua) for pattern in redirect_incompatible_user_agents):
+            logger.debug(f"Node overloaded ({reason}), but client can't handle 302: {ua}")
+            return False
+
+        logger.info(f"Node overloaded ({reason}), degrade to redirect.")
+        return True
+
+load_monitor = LoadMonitor()
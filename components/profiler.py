@@ -0,0 +1,116 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from components.monitor import load_monitor
+from components.breaker import alist_breaker, emby_breaker
+from components.headsize import head_advisor
+from components.cluster import cluster
+
+
+class StackSampler:
+    """
+    采样分析器：在后台线程中定时读取所有线程的调用栈，输出 flamegraph 可用的折叠栈格式
+
+    只读取 sys._current_frames()，不需要重启进程或挂载调试器，事件循环线程的开销只有 GIL 切换
+    """
+
+    def __init__(self, interval: float = 0.005):
+        """
+        :param interval: 采样间隔，单位秒
+        """
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    def run(self, seconds: float) -> str:
+        """
+        阻塞采样指定秒数，应通过 asyncio.to_thread 调用
+
+        :param seconds: 采样时长
+        :return: 折叠栈文本，每行 "frame;frame;... count"
+        """
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("Profiler is already running")
+        try:
+            self.stacks.clear()
+            self.samples = 0
+            own_thread = threading.get_ident()
+            thread_names = {t.ident: t.name for t in threading.enumerate()}
+
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own_thread:
+                        continue
+                    self.stacks[self._fold(thread_names.get(thread_id, str(thread_id)), frame)] += 1
+                self.samples += 1
+                time.sleep(self.interval)
+
+            return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+        finally:
+            self._lock.release()
+
+    @staticmethod
+    def _fold(thread_name: str, frame) -> str:
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        frames.append(thread_name.replace(';', '_'))
+        return ';'.join(reversed(frames))
+
+stack_sampler = StackSampler()
+
+
+def describe_task(task: asyncio.Task) -> dict:
+    """返回后台任务的名称及当前挂起位置"""
+    coro = task.get_coro()
+    location = None
+    stack = task.get_stack(limit=1)
+    if stack:
+        code = stack[-1].f_code
+        location = f"{code.co_name} ({os.path.basename(code.co_filename)}:{stack[-1].f_lineno})"
+    return {
+        'name': task.get_name(),
+        'coro': getattr(coro, '__qualname__', repr(coro)),
+        'location': location,
+    }
+
+
+def get_runtime_status(task_limit: int = 200) -> dict:
+    """
+    汇总当前进程状态：进行中的请求、后台任务、事件循环延迟及反代负载
+
+    :param task_limit: 最多列出的任务数量
+    """
+    now = time.perf_counter()
+    current = asyncio.current_task()
+    tasks = [t for t in asyncio.all_tasks() if t is not current]
+    return {
+        'pid': os.getpid(),
+        'event_loop_lag_ms': round(load_monitor.event_loop_lag * 1000, 2),
+        'proxy_bandwidth': round(load_monitor.bandwidth),
+        'active_streams': load_monitor.active_streams,
+        'overload_reason': load_monitor.overload_reason(),
+        'circuit_breakers': {b.name: b.status() for b in (alist_breaker, emby_breaker)},
+        'cache_head': head_advisor.status(),
+        'cluster': cluster.status(),
+        'in_flight_requests': [
+            {**{k: v for k, v in info.items() if k != 'started'}, 'age_ms': round((now - info['started']) * 1000, 1)}
+            for info in load_monitor.in_flight.values()
+        ],
+        'task_count': len(tasks),
+        'tasks': [describe_task(t) for t in tasks[:task_limit]],
+        'threads': [t.name for t in threading.enumerate()],
+        'profiler_running': stack_sampler.running,
+    }
@@ -0,0 +1,193 @@
+import asyncio
+import calendar
+import time
+import urllib.parse
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+import httpx
+from uvicorn.server import logger
+
+from config import *
+
+
+def _parse_compact_time(value: str) -> float:
+    """解析 20240101T000000Z 格式的 UTC 时间"""
+    return calendar.timegm(time.strptime(value, "%Y%m%dT%H%M%SZ"))
+
+
+def _parse_iso_time(value: str) -> float:
+    """解析 2024-01-01T00:00:00Z 格式的 UTC 时间"""
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+def parse_url_expiry(url: str) -> Optional[float]:
+    """
+    从签名直链的查询参数中解析过期时间
+
+    支持 Alist 签名（sign=xxx:过期时间戳）、S3/CloudFront/OSS v1（Expires）、S3 v4（X-Amz-Date + X-Amz-Expires）、
+    OSS v4（x-oss-date + x-oss-expires）、GCS（X-Goog-Date + X-Goog-Expires）、Azure SAS（se）
+
+    :return: 过期时间的 Unix 时间戳，无法解析或永不过期时返回 None
+    """
+    query = {k.lower(): v[0] for k, v in urllib.parse.parse_qs(urllib.parse.urlparse(url).query).items()}
+    expiries = []
+    try:
+        if 'x-amz-date' in query and 'x-amz-expires' in query:
+            expiries.append(_parse_compact_time(query['x-amz-date']) + int(query['x-amz-expires']))
+        if 'x-goog-date' in query and 'x-goog-expires' in query:
+            expiries.append(_parse_compact_time(query['x-goog-date']) + int(query['x-goog-expires']))
+        if 'x-oss-expires' in query:
+            if 'x-oss-date' in query:
+                expiries.append(_parse_compact_time(query['x-oss-date']) + int(query['x-oss-expires']))
+            else:
+                expiries.append(int(query['x-oss-expires']))
+        if 'expires' in query and query['expires'].isdigit():
+            expiries.append(int(query['expires']))
+        if 'se' in query:
+            expiries.append(_parse_iso_time(query['se']))
+        if 'sign' in query and ':' in query['sign']:
+            expire = int(query['sign'].rsplit(':', 1)[1])
+            # Alist 签名过期时间为 0 表示永不过期
+            if expire > 0:
+                expiries.append(expire)
+    except (ValueError, OverflowError) as e:
+        logger.debug("Failed to parse raw url expiry: %s", e)
+
+    return min(expiries) if expiries else None
+
+
+class _Entry:
+    __slots__ = ('url', 'resolved_at', 'usable_until', 'refresh_at', 'last_used')
+
+    def __init__(self, url: str, expires_at: Optional[float]):
+        now = time.time()
+        self.url = url
+        self.resolved_at = now
+        self.last_used = now
+        if expires_at is None:
+            self.usable_until = now + raw_url_default_ttl
+            self.refresh_at = self.usable_until - min(raw_url_refresh_ahead, raw_url_default_ttl / 2)
+            return
+        # 有效期很短的直链按比例缩小余量，避免刚解析就被视为过期
+        lifetime = max(expires_at - now, 0)
+        self.usable_until = expires_at - min(raw_url_expiry_margin, lifetime / 4)
+        self.refresh_at = expires_at - min(raw_url_refresh_ahead, lifetime / 2)
+
+
+class RawUrlCache:
+    """
+    按直链自身的过期时间缓存 Alist Raw Url
+
+    过期时间从签名参数中解析，无法解析时使用 raw_url_default_ttl；
+    最近被使用过的直链在过期前由后台任务提前刷新，播放中的拖动和新连接不需要等待重新解析；
+    同一直链的并发解析会合并为一次请求
+    """
+
+    def __init__(self, resolve: Callable[..., Awaitable[str]], max_entries: int = 10000):
+        """
+        :param resolve: 解析直链的函数，参数为 file_path、host_url、ua、client
+        :param max_entries: 最多缓存的直链数量
+        """
+        self.resolve = resolve
+        self.max_entries = max_entries
+        self._entries: Dict[Hashable, _Entry] = {}
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self._clients: Dict[Hashable, httpx.AsyncClient] = {}
+        self._generations: Dict[str, Tuple[int, float]] = {}
+        """ 文件直链缓存被 invalidate 的次数及最后一次的时间，用于丢弃 invalidate 之前开始的解析结果 """
+        self._task: Optional[asyncio.Task] = None
+
+    async def get(self, file_path: str, host_url: str, ua: Optional[str], client: httpx.AsyncClient) -> str:
+        key = (file_path, host_url, ua)
+        entry = self._entries.get(key)
+        now = time.time()
+        if entry is not None and now < entry.usable_until:
+            entry.last_used = now
+            if now >= entry.refresh_at:
+                self._resolve(key, client)
+            return entry.url
+        # 多个请求共用同一个解析任务，其中一个请求被取消（如客户端断开）时不能取消共用的任务
+        return await asyncio.shield(self._resolve(key, client))
+
+    def _resolve(self, key: Tuple[str, str, Optional[str]], client: httpx.AsyncClient) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._do_resolve(key, client))
+            self._inflight[key] = task
+            # 后台刷新失败时没有等待者，避免未读取的任务异常
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return task
+
+    async def _do_resolve(self, key: Tuple[str, str, Optional[str]], client: httpx.AsyncClient) -> str:
+        file_path, host_url, ua = key
+        generation = self._generations.get(file_path, (0, 0))[0]
+        try:
+            url = await self.resolve(file_path, host_url=host_url, ua=ua, client=client)
+        finally:
+            if self._inflight.get(key) is asyncio.current_task():
+                del self._inflight[key]
+
+        if self._generations.get(file_path, (0, 0))[0] != generation:
+            # 解析期间直链缓存已被 invalidate，结果可能是被拒绝的旧直链，只返回给已在等待的请求
+            logger.debug("Discard raw url resolved before invalidation: %s", file_path)
+            return url
+
+        previous = self._entries.get(key)
+        entry = _Entry(url, parse_url_expiry(url))
+        if previous is not None:
+            entry.last_used = previous.last_used
+        self._entries[key] = entry
+        self._clients[key] = client
+        if len(self._entries) > self.max_entries:
+            self._evict()
+        logger.debug("Alist Raw Url: %s, usable for %.0fs", url, entry.usable_until - entry.resolved_at)
+        return url
+
+    def invalidate(self, file_path: str):
+        """删除文件的所有直链缓存，如直链被存储拒绝时；正在进行的解析结果不再写入缓存，之后的请求重新解析"""
+        self._generations[file_path] = (self._generations.get(file_path, (0, 0))[0] + 1, time.monotonic())
+        for key in [key for key in self._entries if key[0] == file_path]:
+            self._entries.pop(key, None)
+            self._clients.pop(key, None)
+        for key in [key for key in self._inflight if key[0] == file_path]:
+            del self._inflight[key]
+
+    def _evict(self):
+        now = time.time()
+        for key in [key for key, entry in self._entries.items() if entry.usable_until <= now]:
+            del self._entries[key]
+            self._clients.pop(key, None)
+        if len(self._entries) > self.max_entries:
+            for key in sorted(self._entries, key=lambda k: self._entries[k].last_used)[:len(self._entries) - self.max_entries]:
+                del self._entries[key]
+                self._clients.pop(key, None)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _refresh_loop(self, interval: float = 5):
+        """提前刷新最近 raw_url_active_window 秒内被使用过、即将过期的直链"""
+        while True:
+            await asyncio.sleep(interval)
+            now = time.time()
+            # invalidate 计数只对当时正在进行的解析有意义，解析不会持续这么久
+            for path, (_, invalidated_at) in list(self._generations.items()):
+                if time.monotonic() - invalidated_at > 600:
+                    del self._generations[path]
+            for key, entry in list(self._entries.items()):
+                if entry.usable_until <= now and now - entry.last_used > raw_url_active_window:
+                    self._entries.pop(key, None)
+                    self._clients.pop(key, None)
+                elif now >= entry.refresh_at and now - entry.last_used <= raw_url_active_window and key in self._clients:
+                    self._resolve(key, self._clients[key])
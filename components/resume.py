@@ -0,0 +1,84 @@
+import asyncio
+import time
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+import fastapi
+import httpx
+from uvicorn.server import logger
+
+from config import *
+
+OpenStream = Callable[[int, Optional[int], bool], AsyncIterator[bytes]]
+""" 打开上游流的函数，参数为起始字节、结束字节（None 表示到文件末尾）及是否为续传 """
+
+
+class UpstreamStalled(Exception):
+    """上游在 upstream_stall_timeout 秒内没有数据，或吞吐量低于 upstream_min_throughput"""
+
+
+# 可以通过重新请求恢复的错误：网络错误、上游状态码错误、直链解析失败及停滞
+RESUMABLE_ERRORS = (httpx.HTTPError, ValueError, UpstreamStalled, fastapi.HTTPException)
+
+
+async def resumable_stream(open_stream: OpenStream,
+                           start: int,
+                           end: Optional[int],
+                           reresolve: Optional[Callable[[], Awaitable[None]]] = None
+                           ) -> AsyncIterator[bytes]:
+    """
+    读取上游的指定范围，上游中断或停滞时从已读取的位置重新请求，调用方收到的是连续的数据
+
+    第一次重试复用原直链；之后的重试，或上游返回错误状态码（直链过期、被拒绝）、直链解析失败时先通过 reresolve 重新解析直链。
+    每个流最多重试 upstream_resume_retries 次，超出后抛出最后一次的错误
+
+    :param open_stream: 打开上游流的函数
+    :param start: 起始字节
+    :param end: 结束字节，None 表示文件末尾
+    :param reresolve: 重新解析直链的函数，为 None 时总是复用原直链
+    """
+    position = start
+    retries = 0
+    refresh = False
+
+    while True:
+        if refresh and reresolve is not None:
+            try:
+                await reresolve()
+            except fastapi.HTTPException as e:
+                logger.warning(f"Failed to re-resolve upstream url, reuse the previous one: {e.detail}")
+
+        stream = open_stream(position, end, position != start)
+        waited = 0.0
+        received = 0
+        try:
+            while True:
+                began = time.monotonic()
+                try:
+                    async with asyncio.timeout(upstream_stall_timeout):
+                        chunk = await anext(stream)
+                except StopAsyncIteration:
+                    return
+                except TimeoutError:
+                    raise UpstreamStalled(f"no data in {upstream_stall_timeout}s")
+
+                # 只统计等待上游的时间，客户端读取慢导致的暂停不算作停滞
+                waited += time.monotonic() - began
+                received += len(chunk)
+                if waited >= upstream_stall_timeout:
+                    if received / waited < upstream_min_throughput:
+                        raise UpstreamStalled(f"throughput {received / waited / 1024:.0f}KB/s")
+                    waited = 0.0
+                    received = 0
+
+                position += len(chunk)
+                yield chunk
+        except RESUMABLE_ERRORS as e:
+            if retries >= upstream_resume_retries:
+                raise
+            retries += 1
+            refresh = retries > 1 or isinstance(e, (httpx.HTTPStatusError, fastapi.HTTPException))
+            logger.warning(f"Upstream interrupted at byte {position} ({type(e).__name__}: {e}), "
+                           f"resuming ({retries}/{upstream_resume_retries})")
+            await asyncio.sleep(min(0.5 * retries, 2))
+        finally:
+            await stream.aclose()
@@ -0,0 +1,276 @@
+import asyncio
+import os
+import shutil
+import time
+from typing import List, Optional, Tuple
+from weakref import WeakValueDictionary
+
+from uvicorn.server import logger
+
+from config import *
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+cache_locks = WeakValueDictionary()
+# 命中时最多每隔该秒数更新一次缓存目录的修改时间：降级只需要粗略的访问时间，
+# 而目录修改时间变化会使 ItemState 重新读取缓存文件列表
+TOUCH_INTERVAL = 60
+
+
+def get_cache_lock(subdirname, dirname):
+    # 为每个子目录创建一个锁, 防止不同文件名称的缓存同时写入，导致重复范围的文件
+    key = os.path.join(subdirname, dirname)
+    if key not in cache_locks:
+        # 防止被weakref立即回收
+        lock = asyncio.Lock()
+        cache_locks[key] = lock
+    return cache_locks[key]
+
+
+def cache_tiers() -> List[str]:
+    """缓存层级目录，第一个为热层（cache_path），未配置 cache_cold_path 时只有一层"""
+    if cache_cold_path:
+        return [cache_path, cache_cold_path]
+    return [cache_path]
+
+
+def find_cache_dir(subdirname: str, dirname: str) -> Optional[str]:
+    """
+    在各层中查找已存在的缓存目录，热层优先
+
+    :return: 缓存目录路径，不存在则返回 None
+    """
+    for tier in cache_tiers():
+        cache_dir = os.path.join(tier, subdirname, dirname)
+        if os.path.isdir(cache_dir):
+            return cache_dir
+    return None
+
+
+def get_cache_dir(subdirname: str, dirname: str) -> str:
+    """
+    获取缓存目录路径：已存在则返回所在层的路径，否则返回热层路径
+
+    新视频的缓存写入热层；已位于冷层的视频，新的缓存文件也写入冷层，使同一视频的缓存文件总是位于同一层，下次命中时一起提升到热层
+    """
+    return find_cache_dir(subdirname, dirname) or os.path.join(cache_path, subdirname, dirname)
+
+
+def is_cold(cache_dir: str) -> bool:
+    return bool(cache_cold_path) and os.path.commonpath([cache_dir, cache_cold_path]) == os.path.normpath(cache_cold_path)
+
+
+def iter_cache_dirs(tiers: Optional[List[str]] = None):
+    """
+    遍历各层中的所有缓存目录
+
+    :return: 生成 (tier, subdirname, dirname) 元组
+    """
+    for tier in tiers or cache_tiers():
+        if not os.path.isdir(tier):
+            continue
+        for subdir in os.scandir(tier):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.is_dir():
+                    yield tier, subdir.name, entry.name
+
+
+def _move_dir(src: str, dst: str):
+    """
+    将缓存目录移动到另一层，跨文件系统时先复制到临时目录再重命名，读取中的旧文件不受影响
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if not os.path.exists(dst):
+        try:
+            os.rename(src, dst)
+            return
+        except OSError:
+            pass
+
+    tmp = f"{dst}.moving-{os.getpid()}"
+    shutil.copytree(src, tmp, ignore=shutil.ignore_patterns('*.tag'))
+    if os.path.exists(dst):
+        for file in os.listdir(tmp):
+            os.replace(os.path.join(tmp, file), os.path.join(dst, file))
+        os.rmdir(tmp)
+    else:
+        os.rename(tmp, dst)
+    shutil.rmtree(src, ignore_errors=True)
+
+
+def _has_tag(cache_dir: str) -> bool:
+    return any(file.endswith('.tag') for file in os.listdir(cache_dir))
+
+
+def lock_cache_dir(cache_dir: str, exclusive: bool = False):
+    """
+    非阻塞地获取缓存目录的进程间锁：写入缓存文件期间持有共享锁，在层之间移动时持有排他锁，
+    避免其他工作进程在移动过程中开始写入，写入的文件随旧目录被删除
+
+    :param exclusive: 是否获取排他锁
+
+    :return: 使用结束后需要关闭的文件描述符；目录不存在、已被移动或锁被其他进程持有时返回 False；平台不支持文件锁时返回 None
+    """
+    if fcntl is None:
+        return None
+    try:
+        fd = os.open(cache_dir, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        fcntl.flock(fd, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+        # 获取锁之前目录可能已被其他进程移动
+        if os.stat(cache_dir).st_ino == os.fstat(fd).st_ino:
+            return fd
+    except OSError:
+        pass
+    os.close(fd)
+    return False
+
+
+def _move_locked(src: str, dst: str) -> bool:
+    """持有排他锁移动缓存目录，有缓存文件正在写入时跳过"""
+    fd = lock_cache_dir(src, exclusive=True)
+    if fd is False:
+        return False
+    try:
+        if _has_tag(src):
+            return False
+        _move_dir(src, dst)
+        return True
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+
+class TierManager:
+    """
+    热层/冷层缓存管理
+
+    命中冷层缓存时在后台提升到热层；由 lifespan 启动后台任务，热层超过 cache_hot_max_size 时
+    按最近访问时间（缓存目录的 mtime，命中时更新）将最久未使用的缓存降级到冷层
+    """
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._promoting = set()
+        self._tasks = set()
+
+    def touch(self, cache_dir: str):
+        """记录一次命中，冷层缓存会在后台提升到热层"""
+        if not cache_cold_path:
+            return
+        try:
+            if time.time() - os.stat(cache_dir).st_mtime >= TOUCH_INTERVAL:
+                os.utime(cache_dir)
+        except OSError:
+            return
+        if not is_cold(cache_dir) or cache_dir in self._promoting:
+            return
+
+        self._promoting.add(cache_dir)
+        task = asyncio.create_task(self._promote(cache_dir))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _promote(self, cache_dir: str):
+        subdirname, dirname = os.path.split(os.path.relpath(cache_dir, cache_cold_path))
+        try:
+            async with get_cache_lock(subdirname, dirname):
+                if not await asyncio.to_thread(_move_locked, cache_dir, os.path.join(cache_path, subdirname, dirname)):
+                    return
+            logger.debug("Promoted cache to hot tier: %s", cache_dir)
+        except Exception as e:
+            logger.error(f"Promote cache error: {cache_dir}, {e}")
+        finally:
+            self._promoting.discard(cache_dir)
+
+    def start(self):
+        if cache_cold_path and cache_hot_max_size and self._task is None:
+            self._task = asyncio.create_task(self._demote_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _demote_loop(self):
+        while True:
+            await asyncio.sleep(cache_tier_check_interval)
+            try:
+                await self.demote()
+            except Exception as e:
+                logger.error(f"Demote cache error: {e}")
+
+    async def demote(self) -> int:
+        """
+        将热层中最久未使用的缓存降级到冷层，直到热层大小低于 cache_hot_max_size 的 90%
+
+        多个工作进程时通过文件锁保证同一时间只有一个进程执行
+
+        :return: 降级的缓存目录数量
+        """
+        lock_file = _try_lock(os.path.join(cache_path, '.tier.lock'))
+        if lock_file is False:
+            return 0
+        try:
+            entries, total = await asyncio.to_thread(_scan_hot_tier)
+            if total <= cache_hot_max_size:
+                return 0
+
+            target = cache_hot_max_size * 0.9
+            demoted = 0
+            for mtime, size, subdirname, dirname in sorted(entries):
+                if total <= target:
+                    break
+                src = os.path.join(cache_path, subdirname, dirname)
+                async with get_cache_lock(subdirname, dirname):
+                    if not await asyncio.to_thread(_move_locked, src, os.path.join(cache_cold_path, subdirname, dirname)):
+                        continue
+                total -= size
+                demoted += 1
+            logger.info(f"Demoted {demoted} cache dir(s) to cold tier, hot tier size: {total / 1024 / 1024:.0f}MB")
+            return demoted
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+
+
+def _scan_hot_tier() -> Tuple[List[Tuple[float, int, str, str]], int]:
+    entries = []
+    total = 0
+    for tier, subdirname, dirname in iter_cache_dirs([cache_path]):
+        cache_dir = os.path.join(tier, subdirname, dirname)
+        size = sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.is_file())
+        entries.append((os.stat(cache_dir).st_mtime, size, subdirname, dirname))
+        total += size
+    return entries, total
+
+
+def _try_lock(path: str):
+    """
+    非阻塞地获取进程间文件锁，进程退出时自动释放
+
+    :return: 成功返回需要保持打开的文件对象；已被其他进程持有返回 False；平台不支持文件锁时返回 None
+    """
+    if fcntl is None:
+        return None
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    f = open(path, 'w')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+    return f
+
+tier_manager = TierManager()
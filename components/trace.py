@@ -0,0 +1,113 @@
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import secrets
+import time
+from typing import Optional
+
+import fastapi
+
+from config import *
+from components.models import *
+
+
+def anonymize(value, salt: str) -> str:
+    """对 Item ID、客户端地址等信息加盐哈希，同一个值在同一份记录中保持一致"""
+    return hashlib.sha256(f"{salt}{value}".encode('utf-8')).hexdigest()[:12]
+
+
+def _load_or_create_salt(path: str) -> str:
+    """
+    读取轨迹文件对应的随机盐，不存在时创建；多个工作进程写入同一份轨迹时使用同一个盐
+
+    盐只保存在服务器上，分享轨迹文件时不要一起分享
+    """
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+    except FileExistsError:
+        # 其他工作进程刚创建文件时可能还没有写入
+        for _ in range(50):
+            with open(path, 'r') as f:
+                salt = f.read().strip()
+            if salt:
+                return salt
+            time.sleep(0.01)
+        raise RuntimeError(f"Trace salt file is empty: {path}")
+    salt = secrets.token_hex(16)
+    with os.fdopen(fd, 'w') as f:
+        f.write(salt)
+    return salt
+
+
+class TraceRecorder:
+    """
+    记录匿名化的视频请求轨迹，用于 tools/replay.py 回放
+
+    每行一条 JSON 记录，写入在后台线程中进行
+    """
+
+    def __init__(self):
+        self._logger = logging.getLogger("embytoalist.trace")
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        self._listener: Optional[logging.handlers.QueueListener] = None
+        self._salt = request_trace_salt
+
+    def start(self):
+        if not enable_request_trace or self._listener is not None:
+            return
+
+        os.makedirs(os.path.dirname(os.path.abspath(request_trace_path)), exist_ok=True)
+        # 未配置盐时短哈希可以通过枚举 Item ID 和 IPv4 地址反推，为每份轨迹文件生成随机盐
+        self._salt = request_trace_salt or _load_or_create_salt(f"{request_trace_path}.salt")
+        file_handler = logging.FileHandler(request_trace_path, encoding='utf-8')
+        file_handler.setFormatter(logging.Formatter("%(message)s"))
+
+        log_queue = queue.SimpleQueue()
+        self._logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        self._listener = logging.handlers.QueueListener(log_queue, file_handler)
+        self._listener.start()
+
+    def stop(self):
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+    def record(self, request: fastapi.Request, item_id, status_code: int, request_info: Optional[RequestInfo], started: float):
+        """
+        记录一次视频请求
+
+        :param request: 客户端请求
+        :param item_id: Emby Item ID
+        :param status_code: 响应状态码
+        :param request_info: 请求信息，请求在获取文件信息前失败时为 None
+        :param started: 请求开始时间，time.perf_counter()
+        """
+        if self._listener is None:
+            return
+
+        ua = request.headers.get('User-Agent', '')
+        trace = {
+            # 多个工作进程写入同一份轨迹，使用各进程一致的系统时间，回放时以第一条记录为起点
+            't': round(time.time(), 4),
+            'client': anonymize(request.client.host if request.client else '', self._salt),
+            'item': anonymize(item_id, self._salt),
+            'ua': ua.split(' ')[0],
+            'range': request.headers.get('Range'),
+            'status': status_code,
+            'cache': request_info.cache_status if request_info is not None else None,
+            'duration_ms': round((time.perf_counter() - started) * 1000, 2),
+        }
+        if request_info is not None:
+            trace.update({
+                'item_type': request_info.item_info.item_type if request_info.item_info is not None else None,
+                'size': request_info.file_info.size,
+                'bitrate': request_info.file_info.bitrate,
+                'container': request_info.file_info.container,
+            })
+        self._logger.info(json.dumps(trace))
+
+trace_recorder = TraceRecorder()
@@ -1,7 +1,9 @@
 import hashlib
 import os
 import re
+import secrets
 import urllib.parse
+from collections import OrderedDict
 
 import fastapi
 import httpx
@@ -10,7 +12,14 @@ from aiolimiter import AsyncLimiter
 
 from config import *
 from components.models import *
-from typing import AsyncGenerator, Tuple
+from components.monitor import load_monitor
+from components.batch import BatchLoader
+from components.fanout import shared_stream
+from components.breaker import alist_breaker, emby_breaker
+from components.warmup import connection_warmer
+from components.rawurl import RawUrlCache
+from components.resume import resumable_stream
+from typing import AsyncGenerator, Awaitable, Callable, Optional, Tuple
 
 # a wrapper function to get the time of the function
 def get_time(func):
@@ -19,7 +28,7 @@ def get_time(func):
         start = time.time()
         result = func(*args, **kwargs)
         end = time.time()
-        logger.info(f"Function {func.__name__} takes: {end - start} seconds")
+        logger.debug("Function %s takes: %s seconds", func.__name__, end - start)
         return result
     return wrapper
 
@@ -119,6 +128,29 @@ def extract_api_key(request: fastapi.Request):
                 api_key = match_token.group(1)
     return api_key or emby_key
 
+def extract_user_id(request: fastapi.Request):
+    """从请求中提取 Emby 用户 ID，不存在则返回 None"""
+    user_id = request.query_params.get('UserId') or request.query_params.get('userId')
+    if not user_id:
+        auth_header = request.headers.get('X-Emby-Authorization')
+        if auth_header:
+            match_user = re.search(r'UserId="([^"]+)"', auth_header)
+            if match_user:
+                user_id = match_user.group(1)
+    return user_id
+
+def verify_admin_token(request: fastapi.Request):
+    """
+    校验管理接口的令牌，未配置 admin_token 时管理接口不可用
+
+    只接受 X-Admin-Token 请求头，查询参数会被写入访问日志
+    """
+    if not admin_token:
+        raise fastapi.HTTPException(status_code=404, detail="Admin API is not enabled")
+    token = request.headers.get('X-Admin-Token') or ''
+    if not secrets.compare_digest(token.encode('utf-8'), admin_token.encode('utf-8')):
+        raise fastapi.HTTPException(status_code=401, detail="Invalid admin token")
+
 async def get_alist_raw_url(file_path, host_url, ua, client: httpx.AsyncClient) -> str:
     """根据文件路径获取Alist Raw Url"""
     
@@ -136,18 +168,23 @@ async def get_alist_raw_url(file_path, host_url, ua, client: httpx.AsyncClient)
     if ua is not None:
         header['User-Agent'] = ua
     
-    try:
-        req = await client.post(alist_api_url, json=body, headers=header)
-        req.raise_for_status()
-        req = req.json()
-    except httpx.ReadTimeout:
-        logger.error("Alist server response timeout, please check your network connectivity to Alist server")
-        raise fastapi.HTTPException(status_code=500, detail="Alist server response timeout")
-    except Exception as e:
-        logger.error(f"Error: get_alist_raw_url failed, {e}")
-        logger.error(f"Alist Server Return a {req.status_code} Error")
-        logger.error(f"info: {req.text}")
-        raise fastapi.HTTPException(status_code=500, detail="Failed to request Alist server, {e}")
+    async with alist_breaker.guard():
+        try:
+            req = await client.post(alist_api_url, json=body, headers=header)
+            req.raise_for_status()
+            req = req.json()
+        except httpx.ReadTimeout:
+            logger.error("Alist server response timeout, please check your network connectivity to Alist server")
+            raise fastapi.HTTPException(status_code=500, detail="Alist server response timeout")
+        except httpx.HTTPStatusError as e:
+            logger.error(f"Error: get_alist_raw_url failed, {e}")
+            logger.error(f"Alist Server Return a {e.response.status_code} Error")
+            logger.error(f"info: {e.response.text}")
+            raise fastapi.HTTPException(status_code=500, detail=f"Failed to request Alist server, {e}")
+        except (httpx.HTTPError, ValueError) as e:
+            # 连接失败、DNS 解析失败等没有响应的错误，以及无法解析的响应
+            logger.error(f"Error: get_alist_raw_url failed, {e}")
+            raise fastapi.HTTPException(status_code=500, detail=f"Failed to request Alist server, {e}")
     
     code = req['code']
     
@@ -177,6 +214,7 @@ async def get_alist_raw_url(file_path, host_url, ua, client: httpx.AsyncClient)
                     # 替换原始URL为反向代理URL
                     raw_url = re.sub(r'https?:\/\/[^\/]+\/', url, raw_url)
         
+        connection_warmer.remember(raw_url)
         return raw_url
                
     elif code == 403:
@@ -188,6 +226,67 @@ async def get_alist_raw_url(file_path, host_url, ua, client: httpx.AsyncClient)
         # return 500, req['message']        
         raise fastapi.HTTPException(status_code=500, detail="Alist Server Error")
     
+# 按直链自身的过期时间缓存，并在过期前提前刷新
+raw_url_cache = RawUrlCache(get_alist_raw_url)
+
+# return Alist Raw Url
+@get_time
+async def get_or_cache_alist_raw_url(file_path, host_url, ua, client: httpx.AsyncClient) -> str:
+    """创建或获取Alist Raw Url缓存，缓存时间由直链的签名过期时间决定"""
+    return await raw_url_cache.get(file_path, host_url, ua, client)
+
+async def reresolve_alist_raw_url(request_info: RequestInfo, client: httpx.AsyncClient) -> str:
+    """丢弃文件已缓存的直链并重新解析，用于直链被存储拒绝或上游连接中断后"""
+    raw_url_cache.invalidate(request_info.file_info.path)
+    return await get_or_cache_alist_raw_url(
+        file_path=request_info.file_info.path,
+        host_url=request_info.host_url,
+        ua=request_info.headers.get('User-Agent'),
+        client=client
+        )
+
+def get_default_cache_file_size(bitrate: int) -> int:
+    """默认的开头缓存大小：15秒的视频，并取整"""
+    return int(bitrate / 8 * 15)
+
+def build_file_info(media_source: dict) -> FileInfo:
+    """
+    根据 Emby PlaybackInfo 中的 MediaSource 构建文件信息
+    
+    :param media_source: PlaybackInfo 返回的 MediaSources 中的一项
+    """
+    return FileInfo(
+        path=transform_file_path(media_source.get('Path')),
+        bitrate=media_source.get('Bitrate', 27962026),
+        size=media_source.get('Size', 0),
+        container=media_source.get('Container', None),
+        cache_file_size=get_default_cache_file_size(media_source.get('Bitrate', 27962026))
+    )
+
+# 最近获取到的 Emby 文件及视频信息，Emby 不可用时用于继续响应已缓存的内容
+# 文件信息保存为 (MediaSource 的关键字段, FileInfo)
+_last_file_infos = OrderedDict()
+_last_item_infos = OrderedDict()
+
+def _remember(store: OrderedDict, key, value, max_size: int = 4096):
+    store[key] = value
+    store.move_to_end(key)
+    while len(store) > max_size:
+        store.popitem(last=False)
+
+def raise_emby_status_error(e: httpx.HTTPStatusError):
+    """
+    将 Emby 返回的错误状态转换为 HTTPException
+
+    4xx 由请求本身导致（如 API Key 错误、Item 不存在），原样返回给客户端且不计入熔断统计；5xx 视为 Emby 故障
+    """
+    status_code = e.response.status_code
+    if 400 <= status_code < 500:
+        logger.warning(f"Emby server returned {status_code} for {e.request.url.path}")
+        raise fastapi.HTTPException(status_code=status_code, detail=f"Emby server returned {status_code}")
+    logger.error(f"Error: failed to request Emby server, {e}")
+    raise fastapi.HTTPException(status_code=500, detail=f"Failed to request Emby server, {e}")
+
 # used to get the file info from emby server
 async def get_file_info(item_id, api_key, media_source_id, client: httpx.AsyncClient) -> FileInfo:
     """
@@ -199,107 +298,265 @@ async def get_file_info(item_id, api_key, media_source_id, client: httpx.AsyncCl
     :return: 包含文件信息的字典
     """
     media_info_api = f"{emby_server}/emby/Items/{item_id}/PlaybackInfo?MediaSourceId={media_source_id}&api_key={api_key}"
-    logger.info(f"Requested Info URL: {media_info_api}")
+    logger.debug("Requested Info URL: %s", media_info_api.replace(f"api_key={api_key}", "api_key=***"))
     try:
-        media_info = await client.get(media_info_api)
-        media_info.raise_for_status()
-        media_info = media_info.json()
-    except Exception as e:
-        logger.error(f"Error: failed to request Emby server, {e}")
-        raise fastapi.HTTPException(status_code=500, detail=f"Failed to request Emby server, {e}")
+        async with emby_breaker.guard():
+            try:
+                media_info = await client.get(media_info_api)
+                media_info.raise_for_status()
+                media_info = media_info.json()
+            except httpx.HTTPStatusError as e:
+                raise_emby_status_error(e)
+            except Exception as e:
+                logger.error(f"Error: failed to request Emby server, {e}")
+                raise fastapi.HTTPException(status_code=500, detail=f"Failed to request Emby server, {e}")
+    except fastapi.HTTPException as e:
+        # Emby 不可用时使用最近一次获取到的文件信息，以便继续从本地缓存响应；4xx 由请求本身导致，不使用
+        last = _last_file_infos.get((str(item_id), media_source_id))
+        if last is None or e.status_code < 500:
+            raise
+        file_info = last[1]
+        logger.warning(f"Emby server unavailable, use last known file info for Item ID {item_id}.")
+        return file_info
 
     if media_source_id is None:
-        all_source = []
-        for i in media_info['MediaSources']:
-            all_source.append(FileInfo(
-                path=transform_file_path(i.get('Path')),
-                bitrate=i.get('Bitrate', 27962026),
-                size=i.get('Size', 0),
-                container=i.get('Container', None),
-                # 获取15秒的缓存文件大小， 并取整
-                cache_file_size=int(i.get('Bitrate', 27962026) / 8 * 15)
-            ))
-        return all_source
+        return [build_file_info(i) for i in media_info['MediaSources']]
 
     for i in media_info['MediaSources']:
         if i['Id'] == media_source_id:
-            return FileInfo(
-                path=transform_file_path(i.get('Path')),
-                bitrate=i.get('Bitrate', 27962026),
-                size=i.get('Size', 0),
-                container=i.get('Container', None),
-                # 获取15秒的缓存文件大小， 并取整
-                cache_file_size=int(i.get('Bitrate', 27962026) / 8 * 15)
-            )
+            # MediaSource 未变化时沿用上次构建的文件信息，同一次播放的多个 Range 请求共享同一个对象
+            key = (str(item_id), media_source_id)
+            source = (i.get('Path'), i.get('Bitrate'), i.get('Size'), i.get('Container'))
+            last = _last_file_infos.get(key)
+            if last is not None and last[0] == source:
+                file_info = last[1]
+            else:
+                file_info = build_file_info(i)
+            _remember(_last_file_infos, key, (source, file_info))
+            return file_info
     # can't find the matched MediaSourceId in MediaSources
     raise fastapi.HTTPException(status_code=500, detail="Can't match MediaSourceId")
     
 
+def build_item_info(item: dict) -> ItemInfo:
+    """根据 Emby Items 接口返回的单个 Item 构建视频信息"""
+    item_type = item['Type'].lower()
+    if item_type != 'movie': item_type = 'episode'
+    season_id = int(item['SeasonId']) if item_type == 'episode' else None
+
+    return ItemInfo(
+        item_id=int(item['Id']),
+        item_type=item_type,
+        season_id=season_id
+    )
+
+async def get_item_infos(api_key, item_ids: list, client) -> dict:
+    """
+    通过一次 Emby Items 请求批量获取视频信息
+    
+    :param api_key: Emby API Key
+    :param item_ids: Emby Item ID 列表
+    :param client: httpx异步请求客户端
+    
+    :return: Item ID 到 ItemInfo 的映射，找不到的 Item 不包含在内
+    """
+    item_info_api = f"{emby_server}/emby/Items?api_key={api_key}&Ids={','.join(map(str, item_ids))}"
+    logger.debug("Requesting Item Info: %s", item_info_api.replace(f"api_key={api_key}", "api_key=***"))
+    async with emby_breaker.guard():
+        try:
+            req = await client.get(item_info_api)
+            req.raise_for_status()
+            req = req.json()
+        except httpx.HTTPStatusError as e:
+            raise_emby_status_error(e)
+        except Exception as e:
+            logger.error(f"Error: get_item_info failed, {e}")
+            raise fastapi.HTTPException(status_code=500, detail=f"Failed to request Emby server, {e}")
+    
+    item_infos = {str(item['Id']): build_item_info(item) for item in req['Items']}
+    for item_id, item_info in item_infos.items():
+        _remember(_last_item_infos, item_id, item_info)
+    return item_infos
+
+async def _load_item_infos(client, item_ids: list) -> dict:
+    return await get_item_infos(emby_key, item_ids, client)
+
+# 合并短时间内的并发 Items 请求，统一使用服务端的 emby_key 查询，不同用户的请求也能合并为一次
+# 用户的 API Key 仍由 get_file_info 的 PlaybackInfo 请求校验
+item_info_loader = BatchLoader(_load_item_infos, window=emby_batch_window, max_size=emby_batch_max_size)
+
 async def get_item_info(item_id, api_key, client) -> ItemInfo:
-    item_info_api = f"{emby_server}/emby/Items?api_key={api_key}&Ids={item_id}"
-    logger.debug(f"Requesting Item Info: {item_info_api}")
     try:
-        req = await client.get(item_info_api)
+        if emby_batch_window > 0:
+            item_info = await item_info_loader.load(client, str(item_id))
+        else:
+            item_info = (await get_item_infos(api_key, [item_id], client)).get(str(item_id))
+    except fastapi.HTTPException as e:
+        item_info = _last_item_infos.get(str(item_id))
+        if item_info is None or e.status_code < 500:
+            raise
+        logger.warning(f"Emby server unavailable, use last known item info for Item ID {item_id}.")
+    
+    if item_info is None: 
+        logger.debug(f"Item not found: {item_id};")
+    return item_info
+
+async def get_playback_position_ticks(item_id, user_id, api_key, client) -> int:
+    """
+    获取用户在该视频的播放进度
+    
+    :param item_id: Emby Item ID
+    :param user_id: Emby 用户 ID
+    :param api_key: Emby API Key
+    :param client: httpx异步请求客户端
+    
+    :return: 播放位置，单位为 100 纳秒，获取失败或未播放返回 0
+    """
+    user_item_api = f"{emby_server}/emby/Users/{user_id}/Items/{item_id}?api_key={api_key}"
+    try:
+        req = await client.get(user_item_api)
         req.raise_for_status()
         req = req.json()
     except Exception as e:
-        logger.error(f"Error: get_item_info failed, {e}")
-        raise fastapi.HTTPException(status_code=500, detail="Failed to request Emby server, {e}")
+        logger.error(f"Error: get_playback_position_ticks failed, {e}")
+        return 0
     
-    if not req['Items']: 
-        logger.debug(f"Item not found: {item_id};")
-        return None
+    return (req.get('UserData') or {}).get('PlaybackPositionTicks', 0)
+
+async def get_child_item_ids(parent_id, api_key, client, limit: int = 50) -> list:
+    """
+    获取文件夹（剧集、季）下的所有视频 Item ID
     
-    item_type = req['Items'][0]['Type'].lower()
-    if item_type != 'movie': item_type = 'episode'
-    season_id = int(req['Items'][0]['SeasonId']) if item_type == 'episode' else None
+    :param parent_id: 文件夹的 Emby Item ID
+    :param api_key: Emby API Key
+    :param client: httpx异步请求客户端
+    :param limit: 最多返回的数量
+    """
+    items_api = f"{emby_server}/emby/Items?api_key={api_key}&ParentId={parent_id}&Recursive=true&IncludeItemTypes=Movie,Episode&Limit={limit}"
+    try:
+        req = await client.get(items_api)
+        req.raise_for_status()
+        req = req.json()
+    except Exception as e:
+        logger.error(f"Error: get_child_item_ids failed, {e}")
+        raise fastapi.HTTPException(status_code=500, detail=f"Failed to request Emby server, {e}")
+    
+    return [item['Id'] for item in req['Items']]
 
-    return ItemInfo(
-        item_id=int(item_id),
-        item_type=item_type,
-        season_id=season_id
-    )
+def parse_range_header(range_header: str) -> Tuple[int, Optional[int]]:
+    """
+    解析 HTTP Range 请求头，仅支持单个范围
+    
+    :param range_header: 如 bytes=0-、bytes=100-199
+    
+    :return: 起始字节和结束字节，结束字节为 None 表示到文件末尾
+    """
+    bytes_range = range_header.split('=')[1]
+    if bytes_range.endswith('-'):
+        return int(bytes_range[:-1]), None
+    start_byte, end_byte = map(int, bytes_range.split('-'))
+    return start_byte, end_byte
+
+def build_upstream_headers(request_header) -> dict:
+    """
+    由客户端请求头生成请求直链的请求头模板，每个请求只构建一次
+
+    去掉 host 和 range：host 由 httpx 根据直链设置，range 由 stream_upstream 按请求范围单独添加
+
+    :param request_header: 客户端请求头
+    """
+    return {k: v for k, v in request_header.items() if k.lower() not in {'host', 'range'}}
+
+async def stream_upstream(url_task,
+                          request_header: dict,
+                          start: int,
+                          end: Optional[int],
+                          client: httpx.AsyncClient,
+                          expect_206: bool = True
+                          ) -> AsyncGenerator[bytes, None]:
+    """
+    请求直链的指定范围，返回异步生成器
+    
+    :param url_task: 源文件的URL的异步任务，或已解析的URL
+    :param request_header: build_upstream_headers 生成的请求头模板，不会被修改
+    :param start: 起始字节
+    :param end: 结束字节，None 表示文件末尾
+    :param client: HTTPX异步客户端
+    :param expect_206: 是否要求上游返回206
+    """
+    raw_url = url_task if isinstance(url_task, str) else await url_task
+    headers = {**request_header, 'range': f"bytes={start}-{'' if end is None else end}"}
+    async with client.stream("GET", raw_url, headers=headers) as response:
+        response.raise_for_status()
+        if expect_206 and response.status_code != 206:
+            raise ValueError(f"Expected 206 response, got {response.status_code}")
+        async for chunk in response.aiter_bytes():
+            yield chunk
 
 async def reverse_proxy(cache: AsyncGenerator[bytes, None],
                         url_task: str,
                         request_header: dict,
+                        start: int,
+                        end: Optional[int],
                         response_headers: dict,
                         client: httpx.AsyncClient,
-                        status_code: int = 206
+                        status_code: int = 206,
+                        share_key: Optional[str] = None,
+                        reresolve_url: Optional[Callable[[], Awaitable[str]]] = None
                         ):
     """
     读取缓存数据和URL，返回合并后的流
 
     :param cache: 缓存数据
     :param url_task: 源文件的URL的异步任务
-    :param request_header: 请求头，用于请求直链，包含host和range
+    :param request_header: build_upstream_headers 生成的请求头模板，用于请求直链
+    :param start: 需要从直链读取的起始字节
+    :param end: 需要从直链读取的结束字节，None 表示文件末尾
     :param response_headers: 返回的响应头，包含调整过的range以及content-type
     :param client: HTTPX异步客户端
     :param status_code: HTTP响应状态码，默认为206
+    :param share_key: 文件的唯一标识，启用 enable_shared_upstream 时范围重叠的请求共享同一个上游连接
+    :param reresolve_url: 重新解析直链的函数，上游中断后续传时使用
     
     :return: fastapi.responses.StreamingResponse
     """
     limiter = AsyncLimiter(10*1024*1024, 1)
+    
+    async def reresolve():
+        nonlocal url_task
+        url_task = await reresolve_url()
+    
+    def open_once(upstream_start: int, upstream_end: Optional[int], resumed: bool):
+        # 续传总是要求206，避免上游忽略 Range 从头返回
+        return stream_upstream(url_task, request_header, upstream_start, upstream_end, client, expect_206=resumed or status_code == 206)
+    
+    def open_upstream(upstream_start: int, upstream_end: Optional[int]):
+        # 上游中断或停滞时从当前位置续传，客户端的响应不中断
+        return resumable_stream(open_once, upstream_start, upstream_end, reresolve if reresolve_url is not None else None)
+    
     async def merged_stream():
+        load_monitor.stream_started()
         try:
             if cache is not None:
                 async for chunk in cache:
                     await limiter.acquire(len(chunk))
                     yield chunk
-                logger.info("Cache exhausted, streaming from source")
-            raw_url = await url_task
+                logger.debug("Cache exhausted, streaming from source")
             
-            request_header['host'] = raw_url.split('/')[2]
-            async with client.stream("GET", raw_url, headers=request_header) as response:
-                response.raise_for_status()
-                if status_code == 206 and response.status_code != 206:
-                    raise ValueError(f"Expected 206 response, got {response.status_code}")
-                async for chunk in response.aiter_bytes():
-                    await limiter.acquire(len(chunk))
-                    yield chunk
+            if enable_shared_upstream and share_key is not None and status_code == 206:
+                upstream = shared_stream(share_key, start, end, open_upstream)
+            else:
+                upstream = open_upstream(start, end)
+            
+            async for chunk in upstream:
+                await limiter.acquire(len(chunk))
+                load_monitor.add_bytes(len(chunk))
+                yield chunk
         except Exception as e:
             logger.error(f"Reverse_proxy failed, {e}")
             raise fastapi.HTTPException(status_code=500, detail="Reverse Proxy Failed")
+        finally:
+            load_monitor.stream_finished()
 
     return fastapi.responses.StreamingResponse(
         merged_stream(), 
@@ -0,0 +1,95 @@
+import asyncio
+import time
+import urllib.parse
+from typing import Dict, Optional
+
+import httpx
+from uvicorn.server import logger
+
+from config import *
+
+
+def get_origin(url: str) -> Optional[str]:
+    """返回 URL 的 scheme://host[:port]，无法解析时返回 None"""
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme not in {'http', 'https'} or not parsed.netloc:
+        return None
+    return f"{parsed.scheme}://{parsed.netloc}"
+
+
+class ConnectionWarmer:
+    """
+    连接预热：定期向 Alist、alist_download_url_replacement_map 中的地址及最近出现过的直链域名发送 HEAD 请求，
+    使连接池中始终保留已完成 DNS、TCP、TLS 握手的连接，播放请求到达时可以直接复用
+
+    需要 httpx 客户端的 keepalive_expiry 大于预热间隔，见 connection_keepalive_expiry
+    """
+
+    def __init__(self):
+        self.client: Optional[httpx.AsyncClient] = None
+        self.recent_origins: Dict[str, float] = {}
+        """ 最近出现过的直链域名及最后出现时间 """
+        self._task: Optional[asyncio.Task] = None
+
+    def remember(self, url: str):
+        """记录直链所在的域名，之后的预热会包含它"""
+        if not enable_connection_warmup:
+            return
+        origin = get_origin(url)
+        if origin is not None:
+            self.recent_origins[origin] = time.monotonic()
+
+    def origins(self) -> set:
+        origins = {get_origin(alist_server)}
+        for urls in alist_download_url_replacement_map.values():
+            for url in urls if isinstance(urls, list) else [urls]:
+                # {host_url} 为客户端请求的域名，即本服务自身，不需要预热
+                if "{host_url}" not in url:
+                    origins.add(get_origin(url))
+
+        expired = time.monotonic() - connection_warmup_host_ttl
+        for origin, last_seen in list(self.recent_origins.items()):
+            if last_seen < expired:
+                del self.recent_origins[origin]
+            else:
+                origins.add(origin)
+        origins.discard(None)
+        return origins
+
+    def start(self, client: httpx.AsyncClient):
+        if enable_connection_warmup and self._task is None:
+            self.client = client
+            self._task = asyncio.create_task(self._warmup_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _warmup_loop(self):
+        while True:
+            await self.warmup()
+            await asyncio.sleep(connection_warmup_interval)
+
+    async def warmup(self):
+        """对每个域名并发发送 connection_warmup_per_host 个 HEAD 请求，建立或刷新连接池中的连接"""
+        origins = self.origins()
+        results = await asyncio.gather(
+            *(self._head(origin) for origin in origins for _ in range(connection_warmup_per_host)),
+            return_exceptions=True
+        )
+        failed = sum(1 for result in results if isinstance(result, Exception))
+        logger.debug("Warmed up connections to %s host(s), %s request(s) failed", len(origins), failed)
+
+    async def _head(self, origin: str):
+        try:
+            await self.client.head(f"{origin}/", timeout=10)
+        except httpx.HTTPError as e:
+            logger.debug("Warm up connection to %s failed: %s", origin, e)
+            raise
+
+connection_warmer = ConnectionWarmer()
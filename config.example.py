@@ -38,11 +38,174 @@ convert_mount_path = False
 mount_path_prefix_remove = "/"
 mount_path_prefix_add = ""
 
+# 合并并发的 Emby Items 查询：在该时间窗口（秒）内的查询合并为一次请求，设置为 0 则不合并
+emby_batch_window = 0.005
+# 单次合并查询的最大 Item 数量
+emby_batch_max_size = 50
+
 # 是否缓存视频前15秒用于起播加速
 enable_cache = False
 enable_cache_next_episode = False
 cache_path = "/app/cache"
+# 冷层缓存路径，留空则不分层。配置后 cache_path 作为热层（如 NVMe），新缓存写入热层，
+# 热层超出容量时按最近访问时间将最久未使用的缓存降级到冷层（如 HDD），命中冷层时再提升回热层
+cache_cold_path = ""
+# 热层容量上限，单位 Byte，0 为不限制（不降级）
+cache_hot_max_size = 0
+# 检查热层容量的间隔，单位秒
+cache_tier_check_interval = 600
+# 开头缓存大小自适应：记录播放器起播阶段实际读取到的位置，按容器格式和客户端类型调整新缓存的开头大小（默认为15秒）
+# 已有的开头缓存不受影响，观测数据保存在 cache_path 下的 head_advisor.json
+enable_adaptive_cache_head = False
+# 开头缓存的最小、最大秒数（通过码率计算）
+cache_head_min_seconds = 5
+cache_head_max_seconds = 60
+# 从请求文件开头起，观测多少秒内的请求作为起播阶段
+cache_head_observe_window = 30
+# 每组保留的观测数量，以及开始调整前需要的最少观测数量
+cache_head_samples = 50
+cache_head_min_samples = 5
+# 取观测值的分位数作为开头缓存大小
+cache_head_percentile = 0.9
+# 透传 PlaybackInfo 请求时提前解析 Alist 直链，需要在 Nginx 中将 PlaybackInfo 反代到本程序
+enable_playback_info_preresolve = False
+# 提前解析直链的同时检查并创建开头缓存，需要同时启用 enable_cache
+playback_info_precache = False
+# 恢复播放预缓存：透传 PlaybackInfo 时根据用户的播放进度，缓存恢复播放位置附近的内容，需要同时启用 enable_playback_info_preresolve
+enable_resume_precache = False
+# 恢复播放位置之前、之后缓存的秒数（通过码率计算）
+resume_cache_before_seconds = 5
+resume_cache_after_seconds = 15
+# 写入缓存时的内存缓冲区大小，单位 Byte，缓冲区满后整块写入磁盘
+cache_write_buffer_size = 4 * 1024 * 1024
+# 同时写入磁盘的缓存任务数量
+cache_write_concurrency = 2
+# 缓存写入的 fsync 策略："never" 交给系统决定，"close" 写入完成后 fsync，"always" 每次写入后 fsync
+cache_fsync_policy = "close"
+# Emby Webhook：删除媒体后清理对应缓存，支持删除整部剧集或整季
+clean_cache_after_remove_media = False
+# Emby Webhook：新媒体入库后预先创建开头和末尾缓存，需要同时启用 enable_cache
+enable_webhook_precache = False
+# 新入库的是文件夹（剧集、季）时，最多预缓存的视频数量
+webhook_precache_max_items = 50
+# 缓存后台任务队列：同时执行的任务数量，以及最多排队的任务数量
+# 任务按优先级执行：当前播放的缓存 > 下一集、PlaybackInfo 预缓存 > 新入库预缓存，同一文件的同一缓存范围只会排队一次
+# 大于 1 时保留一个只执行当前播放缓存任务的工作协程
+job_workers = 2
+job_queue_max_size = 100
+# 缓存检查（tools/verify_cache.py 及 /admin/maintenance）使用的线程数
+maintenance_workers = 4
+# 写入标记超过该秒数视为写入进程异常退出后的残留
+maintenance_tag_max_age = 3600
+# 集群模式：多个节点按一致性哈希分担缓存，每个视频的缓存只保存在一个节点上，其他节点通过内部接口读取
+# 所有节点的地址，需要能被其他节点访问，例如 ["http://10.0.0.1:60001", "http://10.0.0.2:60001"]，为空时不启用
+cluster_nodes = []
+# 本节点的地址，需要与 cluster_nodes 中的一项相同，也可以通过环境变量 EMBYTOALIST_CLUSTER_SELF 指定
+cluster_self = ""
+# 节点之间通信的密钥，所有节点需要相同，未设置时不启用集群模式
+cluster_secret = ""
+# 每个节点在哈希环上的虚拟节点数量
+cluster_virtual_nodes = 100
+# 请求其他节点的超时时间，单位：秒
+cluster_timeout = 3
+# 无法访问的节点在该秒数内被跳过，其缓存由环上的下一个节点接管
+cluster_node_retry_interval = 30
 # 缓存文件名称黑名单，文件名称包含以下字符串的文件不会被缓存，支持正则表达式
 cache_blacklist = []
 
-log_level = "INFO"
\ No newline at end of file
+# 共享上游连接：同一文件范围重叠的反代请求共用一个上游连接，减少重复从云盘拉取相同的数据
+enable_shared_upstream = False
+# 每个共享上游连接保留的滑动窗口大小，单位 Byte，新请求的起始位置在窗口内即可加入
+shared_upstream_window_size = 32 * 1024 * 1024
+# 新请求的起始位置超前于上游当前位置不超过该值时也可以加入，单位 Byte
+shared_upstream_attach_ahead = 2 * 1024 * 1024
+# 窗口被最慢的请求占满时等待的秒数，超时后该请求改用独立的上游连接
+shared_upstream_wait_timeout = 5
+
+# 上游续传：反代过程中上游连接中断或停滞时，从当前位置重新请求（必要时重新解析直链），客户端的响应不中断
+# 每个响应最多续传的次数，设置为 0 则不续传
+upstream_resume_retries = 3
+# 等待上游数据超过该秒数视为停滞
+upstream_stall_timeout = 15
+# 上游吞吐量下限，单位 Byte/s，每 upstream_stall_timeout 秒的等待时间内低于该值视为停滞，设置为 0 则不检查
+upstream_min_throughput = 0
+
+# 负载自适应：本机反代负载超过任一阈值时，未命中缓存的请求将降级为302重定向，不再通过本机反代
+enable_load_adaptive_redirect = False
+# 反代带宽上限，单位 Byte/s，设置为 0 则不限制
+load_max_proxy_bandwidth = 100 * 1024 * 1024
+# 同时反代的流数量上限，设置为 0 则不限制
+load_max_active_streams = 50
+# 事件循环延迟上限，单位秒，设置为 0 则不限制
+load_max_event_loop_lag = 0.2
+# 无法正确处理302的客户端 User-Agent，这些客户端始终反代，支持正则表达式
+redirect_incompatible_user_agents = ["VLC"]
+
+# 服务监听地址和端口
+server_host = "0.0.0.0"
+server_port = 60001
+# 工作进程数量，0 为 CPU 核心数
+# 多进程时每个进程独立维护直链缓存、负载统计、熔断器等内存状态，管理接口只返回处理该请求的进程的信息
+server_workers = 1
+# 多进程监听方式："prefork" 主进程监听，工作进程共享同一个 socket；"reuseport" 每个工作进程通过 SO_REUSEPORT 各自监听，由内核分配连接（仅 Linux）
+server_socket_mode = "prefork"
+# 事件循环："auto" 安装了 uvloop 时使用 uvloop，也可指定 "asyncio"、"uvloop"
+server_loop = "auto"
+# HTTP 协议实现："auto" 安装了 httptools 时使用 httptools，也可指定 "h11"、"httptools"
+server_http = "auto"
+# 工作进程处理多少个请求后优雅退出并由主进程重新拉起，0 为不限制；建议与多个工作进程一起使用
+server_limit_max_requests = 0
+# 退出时等待进行中的请求（包括正在传输的视频流）的最长秒数
+server_graceful_shutdown_timeout = 30
+
+# Alist 直链缓存：过期时间从直链的签名参数（Expires、X-Amz-Expires、sign 等）中解析，无法解析时使用 raw_url_default_ttl
+raw_url_default_ttl = 600
+# 直链在过期前多少秒停止使用
+raw_url_expiry_margin = 30
+# 直链在过期前多少秒由后台提前刷新
+raw_url_refresh_ahead = 120
+# 最近多少秒内被使用过的直链才会提前刷新
+raw_url_active_window = 600
+
+# 连接预热：定期向 Alist、alist_download_url_replacement_map 中的地址及最近出现过的直链域名发送 HEAD 请求，
+# 保持已完成握手的连接，减少起播时的 DNS、TCP、TLS 耗时
+enable_connection_warmup = False
+# 预热间隔，单位秒，需要小于 connection_keepalive_expiry
+connection_warmup_interval = 60
+# 每个域名保持的连接数
+connection_warmup_per_host = 2
+# 直链域名多久未出现后不再预热，单位秒
+connection_warmup_host_ttl = 1800
+# 空闲连接的保持时间，单位秒
+connection_keepalive_expiry = 120
+
+# Emby 和 Alist 熔断器：上游连续失败后直接失败，不再等待超时
+# Alist 熔断时，命中缓存的请求照常从缓存响应，其余请求重定向到 Emby 原始地址（preventRedirect）
+# Emby 熔断时，使用最近一次获取到的文件信息继续响应
+enable_circuit_breaker = True
+# 连续失败多少次后熔断
+breaker_failure_threshold = 5
+# 单次请求超过该秒数视为失败，0 为不启用（Emby 扫描媒体库时请求可能较慢）
+breaker_slow_call_seconds = 0
+# 单次请求的超时时间，单位秒
+breaker_call_timeout = 10
+# 熔断后多少秒放行一个探测请求
+breaker_reset_timeout = 30
+
+# 管理接口令牌（/admin/status、/admin/profile），留空则关闭管理接口
+# 请求时通过 X-Admin-Token 请求头传入
+admin_token = ""
+# 单次采样分析的最长时间，单位秒
+admin_profile_max_seconds = 60
+
+# 记录匿名化的视频请求轨迹（Range、时间、缓存状态等），可通过 tools/replay.py 回放
+enable_request_trace = False
+request_trace_path = "/app/trace/requests.jsonl"
+# 匿名化 Item ID 和客户端地址时使用的盐，留空时自动生成随机盐，保存在轨迹文件旁的 .salt 文件中
+request_trace_salt = ""
+
+log_level = "INFO"
+# 每个视频请求记录一条访问日志，包含请求的 Item、状态码、缓存状态、Range 和耗时
+log_access_records = True
+# DEBUG 日志的采样率，0~1，按请求采样，同一请求的调试日志全部保留或全部丢弃
+log_debug_sample_rate = 1.0
\ No newline at end of file
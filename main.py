@@ -1,50 +1,88 @@
+import asyncio
+import dataclasses
 from contextlib import asynccontextmanager
 
 import fastapi
 import httpx
-import uvicorn
 from uvicorn.server import logger
-from aiocache import cached, Cache
 
 from config import *
 from components.utils import *
 from components.cache import *
 from components.models import *
+from components.monitor import load_monitor
+from components.log import setup_queue_logging, stop_queue_logging, access_logged, InFlightMiddleware
+from components.trace import trace_recorder
+from components.profiler import stack_sampler, get_runtime_status
+from components.breaker import alist_breaker
+from components.tier import tier_manager
+from components.warmup import connection_warmer
+from components.headsize import head_advisor
+from components.jobs import job_queue, JobPriority
+from components.maintenance import cache_maintenance
+from components.cluster import cluster
+from components.itemstate import item_states
 
 # 使用上下文管理器，创建异步请求客户端
 @asynccontextmanager
 async def lifespan(app: fastapi.FastAPI):
-    app.requests_client = httpx.AsyncClient()
+    setup_queue_logging()
+    trace_recorder.start()
+    head_advisor.load()
+    # 保持空闲连接的时间需要大于预热间隔，否则预热建立的连接会在使用前过期
+    app.requests_client = httpx.AsyncClient(limits=httpx.Limits(
+        max_connections=100,
+        max_keepalive_connections=20,
+        keepalive_expiry=connection_keepalive_expiry
+        ))
+    load_monitor.start()
+    tier_manager.start()
+    connection_warmer.start(app.requests_client)
+    cluster.start(app.requests_client)
+    raw_url_cache.start()
+    job_queue.start()
     yield
+    await job_queue.stop()
+    await raw_url_cache.stop()
+    await connection_warmer.stop()
+    await tier_manager.stop()
+    await load_monitor.stop()
     await app.requests_client.aclose()
+    head_advisor.save()
+    trace_recorder.stop()
+    stop_queue_logging()
 
 app = fastapi.FastAPI(lifespan=lifespan)
+app.add_middleware(InFlightMiddleware)
 
-# return Alist Raw Url
-@get_time
-@cached(ttl=600, cache=Cache.MEMORY, key_builder=lambda f, file_path, host_url, ua, client: file_path + host_url + ua)
-async def get_or_cache_alist_raw_url(file_path, host_url, ua, client: httpx.AsyncClient) -> str:
-    """创建或获取Alist Raw Url缓存，缓存时间为5分钟"""    
-    raw_url = await get_alist_raw_url(file_path, host_url=host_url, ua=ua, client=client)
-    logger.info("Alist Raw Url: " + raw_url)
-    return raw_url
+async def redirect_to_raw_url(request_info: RequestInfo) -> fastapi.Response:
+    """重定向到 Alist 直链，获取直链失败时降级到 Emby 原始地址"""
+    try:
+        raw_url = await request_info.raw_url_task
+    except fastapi.HTTPException as e:
+        if request_info.fallback_url is None:
+            raise
+        logger.warning(f"Failed to get Alist Raw Url ({e.detail}), fallback to Emby original url.")
+        return fastapi.responses.RedirectResponse(url=request_info.fallback_url, status_code=302)
+    return fastapi.responses.RedirectResponse(url=raw_url, status_code=302)
 
 # 可以在第一个请求到达时就异步创建alist缓存
 # 重定向：
 # 1. 未启用缓存
 # 2. 请求头不包含Range
-# 3. 中间恢复播放
+# 3. 中间恢复播放（恢复播放位置附近的缓存尚未创建时）
 # 反代：
 # 1. 无缓存文件（should，目前只是重新代理。todo：缓存重利用）
 # 2. 缓存拼接
 # 只需返回缓存（不需要alist直链）：
 # 1. 请求范围在缓存范围内
 # 2. 请求范围在文件末尾2MB内
+# 3. 请求范围在恢复播放位置附近的缓存内（enable_resume_precache）
 async def request_handler(expected_status_code: int,
                           cache: AsyncGenerator[bytes, None]=None,
                           request_info: RequestInfo=None,
                           resp_header: dict=None,
-                          background_tasks: fastapi.BackgroundTasks=None,
+                          cache_next: bool=False,
                           client: httpx.AsyncClient=None
                           ) -> fastapi.Response:
     """决定反代还是重定向，创建alist缓存
@@ -53,20 +91,33 @@ async def request_handler(expected_status_code: int,
     :param cache: 内部缓存数据
     :param request_info: 请求信息
     :param resp_header: 需要返回的响应头
+    :param cache_next: 是否提交缓存下一集的后台任务
     :param client: httpx异步请求客户端
     
     :return fastapi.Response: 返回重定向或反代的响应
     """
     
-    if request_info.cache_status != CacheStatus.UNKNOWN and background_tasks is not None and enable_cache_next_episode is True:
-        background_tasks.add_task(cache_next_episode, request_info=request_info, api_key=request_info.api_key, client=client)
-        logger.info("Started background task to cache next episode.")
+    if request_info.cache_status != CacheStatus.UNKNOWN and cache_next and enable_cache_next_episode is True:
+        job_queue.submit(
+            ('next_episode', request_info.item_info.item_id),
+            JobPriority.PREFETCH,
+            cache_next_episode,
+            request_info=request_info,
+            api_key=request_info.api_key,
+            client=client
+            )
+        logger.debug("Queued caching next episode.")
         
     alist_raw_url_task = request_info.raw_url_task
 
     if expected_status_code == 302:
-        raw_url = await alist_raw_url_task
-        return fastapi.responses.RedirectResponse(url=raw_url, status_code=302)
+        return await redirect_to_raw_url(request_info)
+    
+    # Alist 熔断时无法获取直链，需要上游数据的请求直接降级到 Emby 原始地址
+    if expected_status_code in {200, 206} and request_info.cache_status not in {CacheStatus.HIT, CacheStatus.HIT_TAIL} \
+            and alist_breaker.is_open and request_info.fallback_url is not None:
+        logger.info("Alist circuit breaker is open, fallback to Emby original url.")
+        return fastapi.responses.RedirectResponse(url=request_info.fallback_url, status_code=302)
     
     if expected_status_code == 206:
         start_byte = request_info.start_byte
@@ -75,54 +126,53 @@ async def request_handler(expected_status_code: int,
         cache_status = request_info.cache_status
 
         if cache_status == CacheStatus.MISS:
+            # 本机反代负载过高时降级为302，无法正确处理302的客户端除外
+            if load_monitor.should_redirect(request_info.headers.get('User-Agent')):
+                return await redirect_to_raw_url(request_info)
+            
             # Case 1: Requested range is entirely beyond the cache
-            # Prepare Range header
-            if end_byte is not None:
-                source_range_header = f"bytes={start_byte}-{end_byte - 1}"
-            else:
-                source_range_header = f"bytes={start_byte}-"
-
-            headers = dict(request_info.headers)
-            headers["Range"] = source_range_header
             return await reverse_proxy(
                 cache=None, 
                 url_task=alist_raw_url_task, 
-                request_header=headers,
+                request_header=build_upstream_headers(request_info.headers),
+                start=start_byte,
+                end=end_byte,
                 response_headers=resp_header,
-                client=client
+                client=client,
+                share_key=request_info.file_info.path,
+                reresolve_url=lambda: reresolve_alist_raw_url(request_info, client)
                 )
         elif cache_status in {CacheStatus.HIT, CacheStatus.HIT_TAIL}:
             # Case 2: Requested range is entirely within the cache
             return fastapi.responses.StreamingResponse(cache, headers=resp_header, status_code=206)
         else:
             # Case 3: Requested range overlaps cache and extends beyond it
-            source_start = local_cache_size
-            
-            if end_byte is not None:
-                source_range_header = f"bytes={source_start}-{end_byte}"
-            else:
-                source_range_header = f"bytes={source_start}-"
+            source_start = request_info.cache_range[1] + 1 if request_info.cache_range is not None else local_cache_size
             
-            headers = dict(request_info.headers)
-            headers["Range"] = source_range_header
             return await reverse_proxy(
                 cache=cache, 
                 url_task=alist_raw_url_task, 
-                request_header=headers,
+                request_header=build_upstream_headers(request_info.headers),
+                start=source_start,
+                end=end_byte,
                 response_headers=resp_header,
-                client=client
+                client=client,
+                share_key=request_info.file_info.path,
+                reresolve_url=lambda: reresolve_alist_raw_url(request_info, client)
                 )
         
     if expected_status_code == 200:
-        headers = dict(request_info.headers)
-        headers["Range"] = f"bytes={request_info.file_info.cache_file_size}-"
+        source_start = request_info.cache_range[1] + 1 if request_info.cache_range is not None else request_info.file_info.cache_file_size
         return await reverse_proxy(
             cache=cache,
             url_task=alist_raw_url_task,
-            request_header=headers,
+            request_header=build_upstream_headers(request_info.headers),
+            start=source_start,
+            end=None,
             response_headers=resp_header,
             client=client,
-            status_code=200
+            status_code=200,
+            reresolve_url=lambda: reresolve_alist_raw_url(request_info, client)
             )
                 
     if expected_status_code == 416:
@@ -136,7 +186,8 @@ async def request_handler(expected_status_code: int,
 @app.get('/videos/{item_id}/{filename}')
 @app.get('/emby/Videos/{item_id}/{filename}')
 @app.get('/emby/videos/{item_id}/{filename}')
-async def redirect(item_id, filename, request: fastapi.Request, background_tasks: fastapi.BackgroundTasks):
+@access_logged
+async def redirect(item_id, filename, request: fastapi.Request):
     # Example: https://emby.example.com/emby/Videos/xxxxx/original.mp4?MediaSourceId=xxxxx&api_key=xxxxx
     
     api_key = extract_api_key(request)
@@ -150,6 +201,7 @@ async def redirect(item_id, filename, request: fastapi.Request, background_tasks
     # host_url example: https://emby.example.com:8096/
     host_url = str(request.base_url)
     ua = request.headers.get('User-Agent')
+    file_info = resolve_head_size(file_info, item_info.item_type, ua)
     request_info = RequestInfo(
         file_info=file_info, 
         item_info=item_info, 
@@ -158,15 +210,16 @@ async def redirect(item_id, filename, request: fastapi.Request, background_tasks
         headers=request.headers,
         )
     
-    logger.info(f"Requested Item ID: {item_id}")
-    logger.info("MediaFile Mount Path: " + file_info.path)
+    request.state.request_info = request_info
+    logger.debug("Requested Item ID: %s, MediaFile Mount Path: %s", item_id, file_info.path)
+    
+    # 拼接完整的URL，如果query为空则不加问号
+    request_info.fallback_url = f"{host_url}preventRedirect{request.url.path}{'?' + request.url.query if request.url.query else ''}"
     
     # if checkFilePath return False：return Emby originalUrl
     if not should_redirect_to_alist(file_info.path):
-        # 拼接完整的URL，如果query为空则不加问号
-        redirected_url = f"{host_url}preventRedirect{request.url.path}{'?' + request.url.query if request.url.query else ''}"
-        logger.info("Redirected Url: " + redirected_url)
-        return fastapi.responses.RedirectResponse(url=redirected_url, status_code=302)
+        logger.debug("Redirected Url: %s", request_info.fallback_url)
+        return fastapi.responses.RedirectResponse(url=request_info.fallback_url, status_code=302)
     
     if not cache_blacklist:
         if any(match_with_regex(file_info.path, pattern) for pattern in cache_blacklist):
@@ -186,6 +239,8 @@ async def redirect(item_id, filename, request: fastapi.Request, background_tasks
             client=app.requests_client
             )
         )
+    # 命中缓存时不会等待直链，避免 Alist 不可用时产生未读取的任务异常
+    request_info.raw_url_task.add_done_callback(lambda t: t.cancelled() or t.exception())
     
     # 如果没有启用缓存，直接返回Alist Raw Url
     if not enable_cache:
@@ -198,13 +253,14 @@ async def redirect(item_id, filename, request: fastapi.Request, background_tasks
     range_header = request.headers.get('Range', '')
     if not range_header.startswith('bytes='):
         logger.warning("Range header is not correctly formatted.")
-        logger.debug(f"Request Headers: {request.headers}")
+        logger.debug("Request Headers: %s", request.headers)
         
         request_info.cache_status = CacheStatus.PARTIAL
         request_info.start_byte = 0
+        head_advisor.observe(file_info, ua, request.client.host if request.client else None, 0, None)
         
-        if get_cache_status(request_info):
-            logger.info("Cached file exists and is valid, response 200.")
+        if await lookup_cache(request_info):
+            logger.debug("Cached file exists and is valid, response 200.")
             resp_headers = {
             'Cache-Control': 'private, no-transform, no-cache',
             'Content-Length': str(file_info.size),
@@ -215,19 +271,13 @@ async def redirect(item_id, filename, request: fastapi.Request, background_tasks
                 cache=read_cache_file(request_info),
                 request_info=request_info,
                 resp_header=resp_headers,
-                background_tasks=background_tasks,
+                cache_next=True,
                 client=app.requests_client
                 )
         else:
-            background_tasks.add_task(
-                write_cache_file,
-                item_id,
-                request_info,
-                request.headers,
-                client=app.requests_client
-                )
+            submit_cache_write(item_id, request_info, request.headers, app.requests_client, JobPriority.FOREGROUND)
 
-            logger.info("Started background task to write cache file.")
+            logger.debug("Queued cache file writing.")
             
             return await request_handler(
                 expected_status_code=302,
@@ -236,16 +286,14 @@ async def redirect(item_id, filename, request: fastapi.Request, background_tasks
                 )
         
     # 解析Range头，获取请求的起始字节
-    bytes_range = range_header.split('=')[1]
-    if bytes_range.endswith('-'):
-        start_byte = int(bytes_range[:-1])
-        end_byte = None
-    else:
-        start_byte, end_byte = map(int, bytes_range.split('-'))
+    start_byte, end_byte = parse_range_header(range_header)
+    if end_byte is not None and end_byte >= file_info.size:
+        end_byte = file_info.size - 1
         
-    logger.debug("Request Range Header: " + range_header)
+    logger.debug("Request Range Header: %s", range_header)
     request_info.start_byte = start_byte
     request_info.end_byte = end_byte
+    head_advisor.observe(file_info, ua, request.client.host if request.client else None, start_byte, end_byte)
     
     if start_byte >= file_info.size:
         logger.warning("Requested Range is out of file size.")
@@ -256,29 +304,23 @@ async def redirect(item_id, filename, request: fastapi.Request, background_tasks
             )
 
     cache_file_size = file_info.cache_file_size
+    # 同一视频的多个 Range 请求复用缓存目录哈希、缓存文件列表及响应头模板
+    item_state = item_states.for_file(file_info, item_info.item_type)
     
     # 应该走缓存的情况1：请求文件开头
     if start_byte < cache_file_size:
-        if end_byte is None or end_byte > cache_file_size:
+        # 缓存文件覆盖 0 ~ cache_file_size-1
+        if end_byte is None or end_byte >= cache_file_size:
             request_info.cache_status = CacheStatus.PARTIAL
         else:
             request_info.cache_status = CacheStatus.HIT
             
-        # 如果请求末尾在cache范围内
-        # 如果请求末尾在缓存文件大小之外，取缓存文件大小；否则取请求末尾
-        cache_end_byte = cache_file_size if request_info.cache_status == CacheStatus.PARTIAL else end_byte
-        resp_end_byte = file_info.size - 1 if end_byte is None or end_byte > cache_end_byte else cache_end_byte
+        # 请求末尾为空时响应到文件末尾；否则取请求末尾
+        resp_end_byte = file_info.size - 1 if end_byte is None else end_byte
         
-        if get_cache_status(request_info):
-            resp_headers = {
-                'Content-Type': get_content_type(file_info.container),
-                'Accept-Ranges': 'bytes',
-                'Content-Range': f"bytes {start_byte}-{resp_end_byte}/{file_info.size}",
-                'Content-Length': f'{resp_end_byte - start_byte + 1}',
-                'Cache-Control': 'private, no-transform, no-cache',
-                'X-EmbyToAList-Cache': 'Hit',
-            }
-            logger.info("Cached file exists and is valid")
+        if await lookup_cache(request_info):
+            resp_headers = item_state.range_headers(start_byte, resp_end_byte, file_info.size)
+            logger.debug("Cached file exists and is valid")
             # 返回缓存内容和调整后的响应头
             
             return await request_handler(
@@ -286,25 +328,19 @@ async def redirect(item_id, filename, request: fastapi.Request, background_tasks
                 cache=read_cache_file(request_info), 
                 request_info=request_info, 
                 resp_header=resp_headers, 
-                background_tasks=background_tasks, 
+                cache_next=True, 
                 client=app.requests_client
                 )
         else:
             # 后台任务缓存文件
-            background_tasks.add_task(
-                write_cache_file,
-                item_id,
-                request_info,
-                request.headers,
-                client=app.requests_client
-                )
-            logger.info("Started background task to write cache file.")
+            submit_cache_write(item_id, request_info, request.headers, app.requests_client, JobPriority.FOREGROUND)
+            logger.debug("Queued cache file writing.")
 
             # 重定向到原始URL
             return await request_handler(
                 expected_status_code=302,
                 request_info=request_info,
-                background_tasks=background_tasks,
+                cache_next=True,
                 client=app.requests_client
                 )
      
@@ -312,7 +348,7 @@ async def redirect(item_id, filename, request: fastapi.Request, background_tasks
     elif file_info.size - start_byte < 2 * 1024 * 1024:
         request_info.cache_status = CacheStatus.HIT_TAIL
         
-        if get_cache_status(request_info):
+        if await lookup_cache(request_info):
             if end_byte is None:
                 resp_end_byte = file_info.size - 1
                 resp_file_size = (resp_end_byte + 1) - start_byte
@@ -320,19 +356,11 @@ async def redirect(item_id, filename, request: fastapi.Request, background_tasks
                 resp_end_byte = end_byte
                 resp_file_size = end_byte - start_byte + 1
 
-            resp_headers = {
-                'Content-Type': get_content_type(file_info.container),
-                'Accept-Ranges': 'bytes',
-                'Content-Range': f"bytes {start_byte}-{resp_end_byte}/{file_info.size}",
-                'Content-Length': f'{resp_file_size}',
-                'Cache-Control': 'private, no-transform, no-cache',
-                'X-EmbyToAList-Cache': 'Hit',
-            }
+            resp_headers = item_state.range_headers(start_byte, resp_end_byte, file_info.size)
             
-            logger.info("Cached file exists and is valid")
+            logger.debug("Cached file exists and is valid")
             # 返回缓存内容和调整后的响应头
-            logger.debug("Response Range Header: " + f"bytes {start_byte}-{resp_end_byte}/{file_info.size}")
-            logger.debug("Response Content-Length: " + f'{resp_file_size}')
+            logger.debug("Response Range Header: bytes %s-%s/%s, Content-Length: %s", start_byte, resp_end_byte, file_info.size, resp_file_size)
             return fastapi.responses.StreamingResponse(
                 read_cache_file(request_info),
                 headers=resp_headers,
@@ -340,85 +368,374 @@ async def redirect(item_id, filename, request: fastapi.Request, background_tasks
                 )
         else:
             # 后台任务缓存文件
-            background_tasks.add_task(
-                write_cache_file, 
-                item_id=item_id,
-                request_info=request_info,
-                req_header=request.headers,
-                client=app.requests_client
-                )
-            logger.info("Started background task to write cache file.")
+            submit_cache_write(item_id, request_info, request.headers, app.requests_client, JobPriority.FOREGROUND)
+            logger.debug("Queued cache file writing.")
 
             # 重定向到原始URL
             return await request_handler(
                 expected_status_code=302, 
                 request_info=request_info,
-                background_tasks=background_tasks,
+                cache_next=True,
                 client=app.requests_client
                 )
+    # 应该走缓存的情况3：恢复播放位置附近的缓存
+    elif enable_resume_precache and await lookup_cache(request_info):
+        request_info.cache_range = request_info.cache_range or find_cache_range(request_info)
+        if end_byte is not None and end_byte <= request_info.cache_range[1]:
+            request_info.cache_status = CacheStatus.HIT
+        else:
+            request_info.cache_status = CacheStatus.PARTIAL
+        resp_end_byte = file_info.size - 1 if end_byte is None else end_byte
+        
+        resp_headers = item_state.range_headers(start_byte, resp_end_byte, file_info.size)
+        logger.debug("Resume cache %s-%s exists and is valid", *request_info.cache_range)
+        
+        return await request_handler(
+            expected_status_code=206, 
+            cache=read_cache_file(request_info), 
+            request_info=request_info, 
+            resp_header=resp_headers, 
+            cache_next=True, 
+            client=app.requests_client
+            )
     else:
         request_info.cache_status = CacheStatus.MISS
+        resp_end_byte = file_info.size - 1 if end_byte is None else end_byte
         
-        resp_headers = {
-            'Content-Type': get_content_type(file_info.container),
-            'Accept-Ranges': 'bytes',
-            'Content-Range': f'bytes {start_byte}-{file_info.size - 1}/{file_info.size}',
-            'Content-Length': f'{file_info.size - start_byte}',
-            'Cache-Control': 'private, no-transform, no-cache',
-            'X-EmbyToAList-Cache': 'Miss',
-        }
+        resp_headers = item_state.range_headers(start_byte, resp_end_byte, file_info.size, cache='Miss')
         
         # 这里用206是因为响应302后vlc可能会出bug，不会跟随重定向，而是继续无限重复请求
+        # 负载过高时会对其他客户端降级为302，见 redirect_incompatible_user_agents
         return await request_handler(
             expected_status_code=206, 
             request_info=request_info, 
             resp_header=resp_headers, 
-            background_tasks=background_tasks, 
+            cache_next=True, 
             client=app.requests_client
             )
 
+# 预解析 Raw Url 的任务，保持引用直到完成，避免被垃圾回收
+_preresolve_tasks = set()
+
+def _preresolve_done(task: asyncio.Task):
+    _preresolve_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"Pre-resolve Alist Raw Url failed: {task.exception()}")
+
+async def preresolve_playback_info(item_id, media_sources: list, host_url: str, headers, api_key: str, client: httpx.AsyncClient,
+                                   user_id: str = None, position_ticks: Optional[str] = None):
+    """
+    客户端请求 PlaybackInfo 后，提前解析各 MediaSource 的 Alist Raw Url，并可选地创建开头缓存及恢复播放位置附近的缓存
+
+    :param item_id: Emby Item ID
+    :param media_sources: PlaybackInfo 返回的 MediaSources
+    :param host_url: 请求的 host url，需要与之后视频请求的一致以命中 Raw Url 缓存
+    :param headers: 客户端请求头
+    :param api_key: Emby API Key
+    :param client: httpx异步请求客户端
+    :param user_id: Emby 用户 ID，用于获取播放进度
+    :param position_ticks: 客户端请求的起播位置（StartTimeTicks 的原始值），为空时从用户播放进度获取，无法解析时不缓存恢复播放位置
+    """
+    ua = headers.get('User-Agent')
+    # PlaybackInfo 可能是带 body 的 POST 请求，只保留请求直链所需的 UA
+    req_header = {'User-Agent': ua} if ua is not None else {}
+    item_info = None
+    resume_precache = enable_resume_precache
+    try:
+        position_ticks = int(position_ticks) if position_ticks else None
+    except ValueError:
+        logger.debug("Invalid StartTimeTicks: %s, skip resume precache.", position_ticks)
+        position_ticks = None
+        resume_precache = False
+
+    for media_source in media_sources:
+        if not media_source.get('Path'):
+            continue
+        file_info = build_file_info(media_source)
+        if not should_redirect_to_alist(file_info.path):
+            continue
+
+        raw_url_task = asyncio.create_task(
+            get_or_cache_alist_raw_url(
+                file_path=file_info.path,
+                host_url=host_url,
+                ua=ua,
+                client=client
+                )
+            )
+        _preresolve_tasks.add(raw_url_task)
+        raw_url_task.add_done_callback(_preresolve_done)
+        logger.debug("Pre-resolving Alist Raw Url for Item ID %s: %s", item_id, file_info.path)
+
+        if not enable_cache or not (playback_info_precache or enable_resume_precache):
+            continue
+
+        if item_info is None:
+            item_info = await get_item_info(item_id, api_key, client)
+            if item_info is None:
+                return
+        file_info = resolve_head_size(file_info, item_info.item_type, ua)
+
+        request_info = RequestInfo(
+            file_info=file_info,
+            item_info=item_info,
+            host_url=host_url,
+            start_byte=0,
+            cache_status=CacheStatus.PARTIAL,
+            api_key=api_key,
+            raw_url_task=raw_url_task,
+            headers=req_header,
+            )
+        
+        # 恢复播放时先缓存播放位置附近的内容
+        if resume_precache:
+            if not position_ticks and user_id is not None:
+                position_ticks = await get_playback_position_ticks(item_id, user_id, api_key, client)
+            cache_range = get_resume_cache_range(file_info, position_ticks) if position_ticks else None
+            if cache_range is not None:
+                resume_request_info = dataclasses.replace(request_info, start_byte=cache_range[0])
+                if not get_cache_status(resume_request_info):
+                    logger.debug("Precaching resume position %s-%s for Item ID %s", *cache_range, item_id)
+                    submit_cache_write(item_id, resume_request_info, req_header, client, JobPriority.PREFETCH, cache_range=cache_range)
+        
+        if playback_info_precache and not get_cache_status(request_info):
+            submit_cache_write(item_id, request_info, req_header, client, JobPriority.PREFETCH)
+
+# 透传 PlaybackInfo 请求到 Emby，同时在后台提前解析 Alist Raw Url
+@app.api_route('/Items/{item_id}/PlaybackInfo', methods=['GET', 'POST'])
+@app.api_route('/items/{item_id}/PlaybackInfo', methods=['GET', 'POST'])
+@app.api_route('/emby/Items/{item_id}/PlaybackInfo', methods=['GET', 'POST'])
+@app.api_route('/emby/items/{item_id}/PlaybackInfo', methods=['GET', 'POST'])
+async def playback_info(item_id, request: fastapi.Request, background_tasks: fastapi.BackgroundTasks):
+    url = f"{emby_server}{request.url.path}{'?' + request.url.query if request.url.query else ''}"
+    headers = {k: v for k, v in request.headers.items() if k.lower() not in {'host', 'content-length', 'accept-encoding'}}
+
+    try:
+        resp = await app.requests_client.request(request.method, url, headers=headers, content=await request.body(), timeout=30)
+    except Exception as e:
+        logger.error(f"Error: failed to forward PlaybackInfo to Emby server, {e}")
+        raise fastapi.HTTPException(status_code=502, detail="Failed to request Emby server")
+
+    resp_headers = {k: v for k, v in resp.headers.items() if k.lower() not in {'content-encoding', 'content-length', 'transfer-encoding', 'connection'}}
+
+    if enable_playback_info_preresolve and resp.status_code == 200:
+        try:
+            media_sources = resp.json().get('MediaSources') or []
+        except ValueError:
+            media_sources = []
+        background_tasks.add_task(
+            preresolve_playback_info,
+            item_id,
+            media_sources,
+            host_url=str(request.base_url),
+            headers=request.headers,
+            api_key=extract_api_key(request),
+            client=app.requests_client,
+            user_id=extract_user_id(request),
+            position_ticks=request.query_params.get('StartTimeTicks')
+            )
+
+    return fastapi.responses.Response(content=resp.content, status_code=resp.status_code, headers=resp_headers)
+
 @app.post('/webhook')
 async def webhook(request: fastapi.Request):
-    if not clean_cache_after_remove_media:
+    if not (clean_cache_after_remove_media or enable_webhook_precache):
         raise fastapi.HTTPException(status_code=400, detail="Webhook is not enabled")
     
     if 'application/json' not in request.headers.get('Content-Type', ''):
         raise fastapi.HTTPException(status_code=400, detail="Content-Type is not application/json")
     
     data = await request.json()
+    item = data.get('Item') or {}
+    is_folder = data.get('IsFolder') is True or item.get('IsFolder') is True
     
     match data.get('Event'):
         case "system.notificationtest":
             print("Webhook test successful.")
             return fastapi.responses.Response(status_code=200)
+        case "library.new":
+            if not (enable_webhook_precache and enable_cache):
+                raise fastapi.HTTPException(status_code=400, detail="Webhook precache is not enabled")
+            
+            if is_folder:
+                item_ids = await get_child_item_ids(item.get('Id'), emby_key, client=app.requests_client, limit=webhook_precache_max_items)
+            else:
+                item_ids = [item.get('Id')]
+            
+            for new_item_id in item_ids:
+                job_queue.submit(
+                    ('precache', str(new_item_id)),
+                    JobPriority.WARMUP,
+                    precache_item,
+                    new_item_id,
+                    host_url=str(request.base_url),
+                    req_header={'User-Agent': request.headers.get('User-Agent', 'EmbyToAlist')},
+                    client=app.requests_client
+                    )
+            logger.info(f"Queued precache for {len(item_ids)} new item(s) from Item ID {item.get('Id')}.")
+            return fastapi.responses.Response(status_code=200)
         case "library.deleted":
-            if data.get('IsFolder') is True:
-                raise fastapi.HTTPException(status_code=400, detail="Folder deletion is not supported.")
+            if not clean_cache_after_remove_media:
+                raise fastapi.HTTPException(status_code=400, detail="Clean cache after remove media is not enabled")
+            
+            deleted_path = item.get('Path')
+            if not deleted_path:
+                raise fastapi.HTTPException(status_code=400, detail="Item Path is missing")
+            
+            if is_folder:
+                # 文件夹内的 Item 已从 Emby 删除，通过缓存元数据中记录的源文件路径查找
+                cleaned = await clean_cache_by_path_prefix(transform_file_path(deleted_path))
+                logger.info(f"Cache for {cleaned} item(s) under {deleted_path} has been cleaned.")
+                return fastapi.responses.Response(status_code=200)
             
             deleted_file_info = FileInfo(
-                path=data.get('Item').get('Path'),
+                path=transform_file_path(deleted_path),
                 bitrate=0,
-                size=data.get('Item').get('Size'),
+                size=item.get('Size'),
                 container="",
                 cache_file_size=0
                 )
             deleted_item_info = ItemInfo(
-                item_id=data.get('Item').get('Id'),
-                item_type=data.get('Item').get('Type'),
+                item_id=item.get('Id'),
+                item_type='movie' if item.get('Type', '').lower() == 'movie' else 'episode',
                 # 电影：如果不存在SeasonId则为None
-                season_id=data.get('Item').get('SeasonId', None)
+                season_id=item.get('SeasonId', None)
                 )
             
-            if clean_cache(deleted_item_info, deleted_file_info):
+            if await clean_cache(deleted_file_info, deleted_item_info):
                 print(f"Cache for Item ID {deleted_item_info.item_id} has been cleaned.")
                 return fastapi.responses.Response(status_code=200)
             else:
                 logger.error(f"Failed to clean cache for Item ID {deleted_item_info.item_id}.")
+                raise fastapi.HTTPException(status_code=500, detail="Failed to clean cache")
             
         case _:
             raise fastapi.HTTPException(status_code=400, detail="Event not supported")
 
 
+# 集群内部接口，仅供其他节点调用，见 components/cluster.py
+@app.get('/internal/cache/{subdirname}/{dirname}')
+async def internal_cache_lookup(subdirname: str, dirname: str, request: fastapi.Request, start: int = 0):
+    """查询本机包含 start 的已完成缓存文件"""
+    cluster.verify(request, subdirname, dirname)
+    cache_range = find_cache_file_range(subdirname, dirname, start, complete_only=True)
+    if cache_range is None:
+        raise fastapi.HTTPException(status_code=404, detail="Cache not found")
+    return {'start': cache_range[0], 'end': cache_range[1]}
+
+@app.get('/internal/cache/{subdirname}/{dirname}/data')
+async def internal_cache_data(subdirname: str, dirname: str, request: fastapi.Request):
+    """读取本机缓存，Range 为文件中的位置，需位于同一个缓存文件内"""
+    cluster.verify(request, subdirname, dirname)
+    range_header = request.headers.get('Range', '')
+    try:
+        start, end = parse_range_header(range_header)
+    except (IndexError, ValueError):
+        raise fastapi.HTTPException(status_code=400, detail="Invalid Range header")
+    cache_range = find_cache_file_range(subdirname, dirname, start, complete_only=True)
+    file_dir = find_cache_dir(subdirname, dirname)
+    if cache_range is None or file_dir is None:
+        raise fastapi.HTTPException(status_code=404, detail="Cache not found")
+    end = cache_range[1] if end is None else min(end, cache_range[1])
+
+    tier_manager.touch(file_dir)
+    file = f'cache_file_{cache_range[0]}_{cache_range[1]}'
+    resp_headers = {
+        'Content-Range': f"bytes {start}-{end}/*",
+        'Content-Length': str(end - start + 1),
+    }
+    return fastapi.responses.StreamingResponse(
+        read_tiered_file(subdirname, dirname, file, start - cache_range[0], end - cache_range[0]),
+        headers=resp_headers,
+        status_code=206
+        )
+
+@app.post('/internal/cache/fill')
+async def internal_cache_fill(request: fastapi.Request):
+    """其他节点转发的缓存写入请求，在本机的后台任务队列中执行"""
+    cluster.verify(request)
+    data = await request.json()
+    try:
+        priority = JobPriority(data.get('priority', JobPriority.PREFETCH))
+    except ValueError:
+        raise fastapi.HTTPException(status_code=400, detail="Invalid job priority")
+    ua = data.get('user_agent')
+    item_info = ItemInfo(**data['item_info'])
+    file_info = resolve_head_size(FileInfo(**data['file_info']), item_info.item_type, ua)
+    cache_range = tuple(data['cache_range']) if data.get('cache_range') else None
+    request_info = RequestInfo(
+        file_info=file_info,
+        item_info=item_info,
+        host_url=data['host_url'],
+        start_byte=data['start_byte'],
+        cache_status=CacheStatus(data['cache_status']),
+        )
+    if get_cache_status(request_info):
+        return {'queued': False}
+
+    request_info.raw_url_task = asyncio.create_task(
+        get_or_cache_alist_raw_url(
+            file_path=file_info.path,
+            host_url=request_info.host_url,
+            ua=ua,
+            client=app.requests_client
+            )
+        )
+    request_info.raw_url_task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    req_header = {'User-Agent': ua} if ua is not None else {}
+    queued = submit_cache_write(data['item_id'], request_info, req_header, app.requests_client,
+                                priority, cache_range=cache_range, forward=False)
+    return {'queued': queued}
+
+@app.get('/admin/status')
+async def admin_status(request: fastapi.Request):
+    verify_admin_token(request)
+    return get_runtime_status()
+
+@app.get('/admin/jobs')
+async def admin_jobs(request: fastapi.Request):
+    """当前进程的后台任务队列：执行中、排队中的任务及累计统计"""
+    verify_admin_token(request)
+    return job_queue.status()
+
+@app.get('/admin/maintenance')
+async def admin_maintenance_status(request: fastapi.Request):
+    """最近一次在线缓存检查的结果"""
+    verify_admin_token(request)
+    return cache_maintenance.status()
+
+@app.post('/admin/maintenance')
+async def admin_maintenance(request: fastapi.Request, emby: bool = True, checksum: bool = False,
+                            remove_orphans: bool = False, dry_run: bool = False):
+    """在后台任务队列中以最低优先级执行缓存检查，参数同 tools/verify_cache.py"""
+    verify_admin_token(request)
+    queued = job_queue.submit(
+        ('maintenance',),
+        JobPriority.WARMUP,
+        cache_maintenance.run,
+        app.requests_client,
+        use_emby=emby,
+        checksum=checksum,
+        remove_orphans=remove_orphans and emby,
+        dry_run=dry_run
+        )
+    return {'queued': queued, 'running': cache_maintenance.running}
+
+@app.get('/admin/profile')
+async def admin_profile(request: fastapi.Request, seconds: float = 10, interval: float = 0.005):
+    """采样指定秒数，返回折叠栈格式的结果，可直接交给 flamegraph.pl 或 speedscope 生成火焰图"""
+    verify_admin_token(request)
+    if not 0 < seconds <= admin_profile_max_seconds:
+        raise fastapi.HTTPException(status_code=400, detail=f"seconds must be in (0, {admin_profile_max_seconds}]")
+    if stack_sampler.running:
+        raise fastapi.HTTPException(status_code=409, detail="Profiler is already running")
+    
+    stack_sampler.interval = min(max(interval, 0.001), 1)
+    logger.info(f"Profiling for {seconds} seconds.")
+    folded = await asyncio.to_thread(stack_sampler.run, seconds)
+    return fastapi.responses.PlainTextResponse(folded, headers={'X-Profile-Samples': str(stack_sampler.samples)})
+
+
 if __name__ == "__main__":
-    log_level = log_level.lower()
-    uvicorn.run(app, port=60001, host='0.0.0.0', log_config="logger_config.json", log_level=log_level)
\ No newline at end of file
+    from components.launcher import run
+    run(app)
\ No newline at end of file
@@ -0,0 +1,262 @@
+"""
+回放 enable_request_trace 记录的请求轨迹
+
+会在本地启动一个模拟的 Emby / Alist / 存储后端，按轨迹中的文件大小、码率、容器生成虚拟视频，
+然后按原时间间隔（可加速）向 EmbyToAlist 发起相同的 Range 请求，统计首字节延迟、状态码和缓存状态。
+
+测试用的 EmbyToAlist 配置需要将 emby_server 和 alist_server 指向模拟后端，例如：
+    emby_server = "http://127.0.0.1:60010"
+    alist_server = "http://127.0.0.1:60010"
+    alist_download_url_replacement_map = {}
+    mount_path_prefix_remove = "/"
+
+用法：
+    python tools/replay.py requests.jsonl --target http://127.0.0.1:60001 --speedup 4
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+import fastapi
+import httpx
+import uvicorn
+
+DEFAULT_SIZE = 1024 * 1024 * 1024
+DEFAULT_BITRATE = 27962026
+PATTERN = bytes(range(256)) * 4096
+
+
+def load_trace(path: str) -> List[dict]:
+    records = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    records.sort(key=lambda r: r['t'])
+    return records
+
+
+def build_items(records: List[dict]) -> Dict[str, dict]:
+    """将匿名化的 Item 映射为模拟后端中的数字 ID"""
+    items = {}
+    for record in records:
+        if record['item'] in items:
+            item = items[record['item']]
+        else:
+            item = items[record['item']] = {'id': str(100000 + len(items))}
+        # 请求在获取文件信息前失败时没有这些字段
+        for key in ('item_type', 'size', 'bitrate', 'container'):
+            if record.get(key) is not None:
+                item[key] = record[key]
+
+    for item in items.values():
+        item.setdefault('item_type', 'movie')
+        item.setdefault('size', DEFAULT_SIZE)
+        item.setdefault('bitrate', DEFAULT_BITRATE)
+        item.setdefault('container', 'mkv')
+        if item['item_type'] == 'movie':
+            item['path'] = f"/replay/movie/{item['id']}/{item['id']}.{item['container']}"
+        else:
+            item['path'] = f"/replay/series/{item['id']}/Season 1/{item['id']}.{item['container']}"
+    return items
+
+
+def create_stub(items: Dict[str, dict], stub_url: str, upstream_latency: float) -> fastapi.FastAPI:
+    """
+    模拟 Emby、Alist 和存储后端
+
+    存储中第 i 个字节的值为 i % 256
+    """
+    app = fastapi.FastAPI()
+    by_id = {item['id']: item for item in items.values()}
+    by_path = {item['path']: item for item in items.values()}
+
+    def emby_item(item_id: str) -> dict:
+        item = by_id.get(item_id)
+        if item is None:
+            raise fastapi.HTTPException(status_code=404, detail="Item not found")
+        return {
+            "Id": item['id'],
+            "Type": "Movie" if item['item_type'] == 'movie' else "Episode",
+            "SeasonId": item['id'],
+            "Path": item['path'],
+            "MediaSources": [{
+                "Id": f"ms{item['id']}",
+                "Path": item['path'],
+                "Bitrate": item['bitrate'],
+                "Size": item['size'],
+                "Container": item['container'],
+            }],
+            "UserData": {"PlaybackPositionTicks": 0},
+        }
+
+    @app.api_route('/emby/Items/{item_id}/PlaybackInfo', methods=['GET', 'POST'])
+    async def playback_info(item_id: str):
+        return {"MediaSources": emby_item(item_id)['MediaSources'], "PlaySessionId": "replay"}
+
+    @app.get('/emby/Items')
+    async def emby_items(Ids: str = "", ParentId: str = ""):
+        if ParentId:
+            return {"Items": [], "TotalRecordCount": 0}
+        result = [emby_item(i) for i in Ids.split(',') if i in by_id]
+        return {"Items": result, "TotalRecordCount": len(result)}
+
+    @app.get('/emby/Users/{user_id}/Items/{item_id}')
+    async def user_item(user_id: str, item_id: str):
+        return emby_item(item_id)
+
+    @app.post('/api/fs/get')
+    async def fs_get(body: dict):
+        if body.get('path') not in by_path:
+            return {"code": 404, "message": "object not found"}
+        return {"code": 200, "data": {"raw_url": f"{stub_url}/storage{body['path']}?Expires=9999999999"}}
+
+    @app.api_route('/storage/{path:path}', methods=['GET', 'HEAD'])
+    async def storage(path: str, request: fastapi.Request):
+        item = by_path.get('/' + path)
+        if item is None:
+            raise fastapi.HTTPException(status_code=404)
+        size = item['size']
+
+        range_header = request.headers.get('range')
+        if range_header:
+            start, end = range_header.split('=')[1].split('-')
+            start = int(start)
+            end = min(int(end), size - 1) if end else size - 1
+        else:
+            start, end = 0, size - 1
+
+        async def body():
+            if upstream_latency:
+                await asyncio.sleep(upstream_latency)
+            position = start
+            while position <= end:
+                offset = position % 256
+                chunk = PATTERN[offset:offset + min(end + 1 - position, len(PATTERN) - 256)]
+                position += len(chunk)
+                yield chunk
+
+        headers = {'Content-Length': str(end - start + 1), 'Accept-Ranges': 'bytes'}
+        if range_header:
+            headers['Content-Range'] = f"bytes {start}-{end}/{size}"
+        return fastapi.responses.StreamingResponse(
+            body(), status_code=206 if range_header else 200,
+            headers=headers, media_type='application/octet-stream'
+        )
+
+    @app.api_route('/', methods=['GET', 'HEAD'])
+    async def root():
+        return {}
+
+    return app
+
+
+async def replay_one(client: httpx.AsyncClient, target: str, record: dict, item: dict, max_read: int) -> dict:
+    url = f"{target}/emby/videos/{item['id']}/original.{item['container']}?MediaSourceId=ms{item['id']}"
+    headers = {'User-Agent': f"Replay {record.get('ua') or '-'}"}
+    if record.get('range'):
+        headers['Range'] = record['range']
+
+    started = time.perf_counter()
+    result = {'status': None, 'cache': None, 'ttfb': None, 'bytes': 0}
+    try:
+        async with client.stream('GET', url, headers=headers) as response:
+            result['status'] = response.status_code
+            result['cache'] = response.headers.get('X-EmbyToAList-Cache')
+            async for chunk in response.aiter_raw():
+                if result['ttfb'] is None:
+                    result['ttfb'] = time.perf_counter() - started
+                result['bytes'] += len(chunk)
+                if result['bytes'] >= max_read:
+                    break
+            if result['ttfb'] is None:
+                result['ttfb'] = time.perf_counter() - started
+    except httpx.HTTPError as e:
+        result['status'] = type(e).__name__
+    return result
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def report(records: List[dict], results: List[dict], elapsed: float):
+    ttfb = [r['ttfb'] * 1000 for r in results if r['ttfb'] is not None]
+    print(f"Replayed {len(results)} requests in {elapsed:.1f}s")
+    if ttfb:
+        print(f"TTFB ms: p50={percentile(ttfb, 0.5):.1f} p90={percentile(ttfb, 0.9):.1f} "
+              f"p99={percentile(ttfb, 0.99):.1f} max={max(ttfb):.1f} mean={statistics.mean(ttfb):.1f}")
+
+    print("Status:")
+    for status, count in Counter(str(r['status']) for r in results).most_common():
+        print(f"  {status}: {count}")
+
+    print("Cache (replay / trace):")
+    replayed = Counter(r['cache'] or '-' for r in results)
+    recorded = Counter(r.get('cache') or '-' for r in records)
+    for cache in sorted(set(replayed) | set(recorded)):
+        print(f"  {cache}: {replayed.get(cache, 0)} / {recorded.get(cache, 0)}")
+
+
+async def replay(args):
+    records = load_trace(args.trace)
+    if not records:
+        print("Trace is empty")
+        return
+    items = build_items(records)
+
+    server: Optional[uvicorn.Server] = None
+    server_task = None
+    if not args.no_stub:
+        stub_url = f"http://127.0.0.1:{args.stub_port}"
+        app = create_stub(items, stub_url, args.upstream_latency / 1000)
+        server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=args.stub_port, log_level='warning'))
+        server_task = asyncio.create_task(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.05)
+
+    async def scheduled(client, record, begin):
+        delay = record['t'] / args.speedup - (time.perf_counter() - begin)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return await replay_one(client, args.target.rstrip('/'), record, items[record['item']], args.max_read)
+
+    timeout = httpx.Timeout(60, connect=10)
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=100)
+    try:
+        async with httpx.AsyncClient(timeout=timeout, limits=limits, follow_redirects=False) as client:
+            # 轨迹时间从第一条记录开始计算
+            first = records[0]['t']
+            for record in records:
+                record['t'] -= first
+            begin = time.perf_counter()
+            results = await asyncio.gather(*(scheduled(client, record, begin) for record in records))
+            elapsed = time.perf_counter() - begin
+    finally:
+        if server is not None:
+            server.should_exit = True
+            await server_task
+
+    report(records, results, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a request trace recorded by EmbyToAlist")
+    parser.add_argument('trace', help="trace file written by enable_request_trace")
+    parser.add_argument('--target', default="http://127.0.0.1:60001", help="EmbyToAlist address")
+    parser.add_argument('--speedup', type=float, default=1.0, help="replay speed multiplier")
+    parser.add_argument('--stub-port', type=int, default=60010, help="port of the simulated Emby/Alist/storage backend")
+    parser.add_argument('--no-stub', action='store_true', help="do not start the simulated backend")
+    parser.add_argument('--max-read', type=int, default=4 * 1024 * 1024, help="max bytes read from each response")
+    parser.add_argument('--upstream-latency', type=float, default=0, help="simulated storage latency in ms")
+    asyncio.run(replay(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+离线检查并修复缓存目录
+
+并行遍历 cache_path（及 cache_cold_path）下的所有缓存，删除长度与文件名不符、超出源文件大小的缓存文件，
+残留的写入标记、空目录及中断的分层移动；可选地与 Emby 媒体库比对源文件大小并重建 meta.json，以及校验文件内容。
+服务运行时也可以通过 POST /admin/maintenance 在线执行。
+
+在项目根目录下运行，使用与服务相同的 config.py：
+    python tools/verify_cache.py --dry-run
+    python tools/verify_cache.py --emby --checksum
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+
+from config import *
+from components.maintenance import fetch_emby_index, verify_cache
+
+
+async def main(args: argparse.Namespace) -> dict:
+    emby_index = None
+    if args.emby:
+        async with httpx.AsyncClient() as client:
+            emby_index = await fetch_emby_index(client)
+        print(f"Fetched {len(emby_index)} media source(s) from Emby.", file=sys.stderr)
+    return await asyncio.to_thread(
+        verify_cache,
+        emby_index,
+        checksum=args.checksum,
+        dry_run=args.dry_run,
+        remove_orphans=args.remove_orphans,
+        workers=args.workers,
+        tag_max_age=args.tag_max_age,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Verify and repair the EmbyToAlist cache directory.")
+    parser.add_argument('--emby', action='store_true', help="compare with the Emby library and rebuild meta.json")
+    parser.add_argument('--remove-orphans', action='store_true', help="remove cache of media no longer in Emby, requires --emby")
+    parser.add_argument('--checksum', action='store_true', help="record SHA-256 on first run, verify on later runs")
+    parser.add_argument('--dry-run', action='store_true', help="report only, do not modify anything")
+    parser.add_argument('--workers', type=int, default=maintenance_workers)
+    parser.add_argument('--tag-max-age', type=float, default=maintenance_tag_max_age,
+                        help="seconds after which a write tag is considered orphaned")
+    args = parser.parse_args()
+    if args.remove_orphans and not args.emby:
+        parser.error("--remove-orphans requires --emby")
+
+    report = asyncio.run(main(args))
+    print(json.dumps(report, ensure_ascii=False, indent=2))